@@ -0,0 +1,91 @@
+###############################################################################
+# Bake a trained checkpoint into a sparse voxel grid and compare it to the MLP
+###############################################################################
+# usage: python bake.py --config configs/lego.txt [--bake_res 128] [--bake_sh_deg 2] [--render_factor 4]
+# the grid is written to <basedir>/<expname>/baked_<bake_res>.pth, render it with
+# python main.py --config ... --render_only --baked_path <grid>
+
+import time
+from os.path import join as path_join
+
+import numpy as np
+import torch
+import wandb
+
+import main
+from load import load_data_from_args
+from main import create_nerf, render
+from utils.baking import bake
+from utils.hash_encoding import get_scene_bbox
+from utils.parser import config_parser
+
+
+def render_timed(poses, H, W, K, chunk, render_kwargs):
+    """
+    Renders every pose, returns the images [N, H, W, 3] and frames per second.
+    """
+    rgbs = []
+    t = time.perf_counter()
+    with torch.no_grad():
+        for c2w in poses:
+            rgb, _, _, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], **render_kwargs)
+            rgbs.append(rgb.cpu().numpy())
+    return np.stack(rgbs, 0), len(rgbs) / (time.perf_counter() - t)
+
+
+psnr = lambda x, y : -10. * np.log10(np.mean((x - y) ** 2))
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--bake_eval_poses", type=int, default=3,
+                        help='number of test poses rendered for the comparison, if --render_poses_filter is not set')
+    args = parser.parse_args()
+    wandb.init(mode='disabled')
+    if torch.cuda.is_available():
+        main.device = torch.device(f'cuda:{args.gpu}')
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    images, poses, render_poses, hwf, K, i_split, near, far, aabb = load_data_from_args(args)
+    i_train, i_val, i_test = i_split
+    use_aabb = args.use_aabb and aabb is not None
+    bounding_box = aabb if use_aabb else get_scene_bbox(poses[i_train], hwf, K, near, far)
+    render_kwargs_train, render_kwargs_test, start, _, _ = create_nerf(args, bounding_box)
+    render_kwargs_test.update({'near' : near, 'far' : far, 'aabb' : aabb if use_aabb else None})
+    if start == 0:
+        raise ValueError(f'no checkpoint found for {args.expname}, nothing to bake')
+
+    # NDC scenes live in [-1, 1]^3
+    if render_kwargs_test.get('ndc', True):
+        bounding_box = ([-1., -1., -1.], [1., 1., 1.])
+    fine = render_kwargs_test['network_fine'] or render_kwargs_test['network_fn']
+    t = time.perf_counter()
+    baked = bake(render_kwargs_test['network_query_fn'], fine, bounding_box, resolution=args.bake_res,
+                 sh_deg=args.bake_sh_deg, n_dirs=args.bake_dirs, threshold=args.bake_threshold,
+                 use_viewdirs=args.use_viewdirs, chunk=args.netchunk // max(args.bake_dirs, 1))
+    print(f'[bake] {baked.density.shape[0]} of {args.bake_res**3} voxels kept in {time.perf_counter() - t:.1f} s')
+    # not .tar, create_nerf reloads every *tar* file of the experiment
+    out_path = path_join(args.basedir, args.expname, f'baked_{args.bake_res}.pth')
+    baked.save(out_path)
+    print(f'[bake] saved {out_path}')
+
+    # compare on (downsampled) test poses
+    H, W, _ = hwf
+    K = np.array(K, dtype=np.float32)
+    factor = max(args.render_factor, 1)
+    if factor > 1:
+        H, W = H // factor, W // factor
+        K[:2] /= factor
+    inds = np.array(i_test)[args.render_poses_filter or slice(args.bake_eval_poses)]
+    eval_poses = torch.Tensor(poses[inds]).to(main.device)
+
+    rgbs_mlp, fps_mlp = render_timed(eval_poses, H, W, K, args.chunk, render_kwargs_test)
+    baked_kwargs = dict(render_kwargs_test, **baked.render_kwargs(args.N_samples + args.N_importance))
+    rgbs_baked, fps_baked = render_timed(eval_poses, H, W, K, args.chunk, baked_kwargs)
+
+    print(f'[bake] {len(inds)} test poses at {W}x{H}')
+    print(f'  MLP    {fps_mlp:8.3f} fps')
+    print(f'  baked  {fps_baked:8.3f} fps  x{fps_baked/fps_mlp:.1f}  PSNR vs MLP: {psnr(rgbs_baked, rgbs_mlp):.2f}')
+    if factor == 1:
+        gts = images[inds][...,:3]
+        print(f'  PSNR vs ground truth: MLP {psnr(rgbs_mlp, gts):.2f}, baked {psnr(rgbs_baked, gts):.2f}')
@@ -0,0 +1,79 @@
+###############################################################################
+# CPU microbenchmarks for the rendering / training hot paths
+###############################################################################
+# usage: python benchmark.py embedder [--n_pts 196608] [--repeats 10]
+
+from argparse import ArgumentParser
+import time
+
+import torch
+
+from utils.nerf_helpers import Embedder, PositionalEncoder
+
+
+def timeit(fn, repeats=10, warmup=2):
+    """
+    Returns the best wall-clock time of 'fn()' in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return 1000. * min(times)
+
+
+def bench_embedder(args):
+    multires = args.multires
+    legacy = Embedder(include_input=True, input_dims=3, max_freq_log2=multires-1, num_freqs=multires,
+                      log_sampling=True, periodic_fns=[torch.sin, torch.cos])
+    encoders = {
+        'vectorized': PositionalEncoder(3, multires-1, multires),
+        'recurrence': PositionalEncoder(3, multires-1, multires, use_recurrence=True),
+        'analytic_grad': PositionalEncoder(3, multires-1, multires, analytic_grad=True),
+    }
+    x = torch.rand(args.n_pts, 3) * 2. - 1.
+
+    with torch.no_grad():
+        assert torch.equal(legacy.embed(x), encoders['vectorized'](x)), 'vectorized encoding is not bit-exact'
+        t_ref = timeit(lambda: legacy.embed(x), args.repeats)
+        print(f'[embedder] {args.n_pts} pts, multires={multires}, forward only')
+        print(f'  {"Embedder":<14} {t_ref:8.2f} ms')
+        for name, enc in encoders.items():
+            t = timeit(lambda: enc(x), args.repeats)
+            print(f'  {name:<14} {t:8.2f} ms  x{t_ref/t:.2f}')
+        workspace = torch.empty(args.n_pts * encoders['vectorized'].out_dim)
+        t = timeit(lambda: encoders['vectorized'](x, out=workspace), args.repeats)
+        print(f'  {"workspace":<14} {t:8.2f} ms  x{t_ref/t:.2f}')
+
+    def fwd_bwd(fn):
+        xg = x.clone().requires_grad_()
+        fn(xg).sum().backward()
+
+    t_ref = timeit(lambda: fwd_bwd(legacy.embed), args.repeats)
+    print(f'[embedder] {args.n_pts} pts, multires={multires}, forward + backward')
+    print(f'  {"Embedder":<14} {t_ref:8.2f} ms')
+    for name, enc in encoders.items():
+        t = timeit(lambda: fwd_bwd(enc), args.repeats)
+        print(f'  {name:<14} {t:8.2f} ms  x{t_ref/t:.2f}')
+
+
+BENCHMARKS = {
+    'embedder': bench_embedder,
+}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--n_pts', type=int, default=1024*192,
+                        help='number of points, default is N_rand * (N_samples + N_importance)')
+    parser.add_argument('--multires', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,71 @@
+###############################################################################
+# Extract a mesh from a trained checkpoint with marching cubes
+###############################################################################
+# usage: python extract_mesh.py --config configs/lego.txt [--mesh_res 256] [--mesh_level 50] [--mesh_out lego.ply]
+# the box is --mesh_bbox, else the loader's scene box, else [-1, 1]^3 in NDC, else the training frusta
+
+import time
+from os.path import join as path_join
+
+import torch
+import wandb
+
+import main
+from load import load_data_from_args
+from main import create_nerf, query_density
+from utils.hash_encoding import get_scene_bbox
+from utils.mesh import density_grid, extract_mesh, write_mesh
+from utils.parser import config_parser
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--mesh_res", type=int, default=256,
+                        help='grid points per axis')
+    parser.add_argument("--mesh_level", type=float, default=50.,
+                        help='density of the extracted surface')
+    parser.add_argument("--mesh_bbox", nargs=6, type=float, default=None,
+                        help='xmin ymin zmin xmax ymax zmax of the extracted region')
+    parser.add_argument("--mesh_out", type=str, default=None,
+                        help='.ply or .obj output, default <basedir>/<expname>/mesh_<mesh_res>.ply')
+    parser.add_argument("--mesh_sparse", action='store_true',
+                        help="only query points in occupied cells of the checkpoint's occupancy grid")
+    args = parser.parse_args()
+    wandb.init(mode='disabled')
+    if torch.cuda.is_available():
+        main.device = torch.device(f'cuda:{args.gpu}')
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    images, poses, render_poses, hwf, K, i_split, near, far, aabb = load_data_from_args(args)
+    scene_bbox = get_scene_bbox(poses[i_split[0]], hwf, K, near, far)
+    _, render_kwargs_test, start, _, _ = create_nerf(args, aabb if args.use_aabb and aabb is not None else scene_bbox)
+    if start == 0:
+        raise ValueError(f'no checkpoint found for {args.expname}, nothing to extract')
+
+    if args.mesh_bbox is not None:
+        bounding_box = (args.mesh_bbox[:3], args.mesh_bbox[3:])
+    elif aabb is not None:
+        bounding_box = aabb
+    elif render_kwargs_test.get('ndc', True):
+        bounding_box = ([-1., -1., -1.], [1., 1., 1.])
+    else:
+        bounding_box = scene_bbox
+    print('[mesh] bounding box', bounding_box)
+
+    network = render_kwargs_test['network_fine'] or render_kwargs_test['network_fn']
+    mask_fn = None
+    if args.mesh_sparse:
+        if render_kwargs_test['occupancy_grid'] is None:
+            raise ValueError('--mesh_sparse needs a checkpoint trained with --occupancy_grid')
+        mask_fn = render_kwargs_test['occupancy_grid'].occupied
+
+    t = time.perf_counter()
+    grid = density_grid(lambda pts: query_density(pts, render_kwargs_test, network), bounding_box,
+                        resolution=args.mesh_res, chunk=args.netchunk, mask_fn=mask_fn)
+    print(f'[mesh] {args.mesh_res}^3 densities in {time.perf_counter() - t:.1f} s, '
+          f'range [{grid.min():.2f}, {grid.max():.2f}]')
+    verts, faces = extract_mesh(grid, bounding_box, args.mesh_level)
+
+    out_path = args.mesh_out or path_join(args.basedir, args.expname, f'mesh_{args.mesh_res}.ply')
+    write_mesh(out_path, verts, faces)
+    print(f'[mesh] {len(verts)} vertices, {len(faces)} faces saved to {out_path}')
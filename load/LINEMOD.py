@@ -67,7 +67,7 @@ def load_LINEMOD_data(args):
                 print(f"{idx_test}th test frame: {fname}")
             imgs.append(imageio.imread(fname))
             poses.append(np.array(frame['transform_matrix']))
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+        imgs = np.array(imgs) # uint8, keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
         counts.append(counts[-1] + imgs.shape[0])
         all_imgs.append(imgs)
@@ -90,7 +90,7 @@ def load_LINEMOD_data(args):
         W = W//2
         focal = focal/2.
 
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 3))
+        imgs_half_res = np.zeros((imgs.shape[0], H, W, imgs.shape[-1]), dtype=np.uint8)
         for i, img in enumerate(imgs):
             imgs_half_res[i] = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
         imgs = imgs_half_res
@@ -98,5 +98,5 @@ def load_LINEMOD_data(args):
 
     near = np.floor(min(metas['train']['near'], metas['test']['near']))
     far = np.ceil(max(metas['train']['far'], metas['test']['far']))
-    return imgs, poses, render_poses, [H, W, focal], K, i_split, near, far
+    return imgs, poses, render_poses, [H, W, focal], K, i_split, near, far, None
 
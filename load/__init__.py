@@ -2,6 +2,7 @@ import numpy as np
 
 from .blender import load_blender_data
 from .deepvoxels import load_dv_data
+from .image_store import ImageStore
 from .LINEMOD import load_LINEMOD_data
 from .llff import load_llff_data
 from .pictures import load_pictures
@@ -23,12 +24,14 @@ def load_data_from_args(args):
     else:
         raise ValueError('Unknown data type: {}'.format(data_type))
     # unpacking
-    images, poses, render_poses, hwf, K, i_split, near, far = output
+    images, poses, render_poses, hwf, K, i_split, near, far, aabb = output
     _, _, i_test = i_split
     H, W, focal = hwf
     H, W = int(H), int(W)
     hwf = [H, W, focal]
     print('near far', near, far)
+    if aabb is not None:
+        print('aabb', aabb)
     if K is None:
         K = np.array([
             [focal, 0, 0.5*W],
@@ -43,8 +46,8 @@ def load_data_from_args(args):
 
     if args.white_bkgd and data_type != "pictures":
         print("Adding white background to synthetic images")
-        images = images[...,:3]*images[...,-1:] + (1.-images[...,-1:])
+        images = ImageStore(images[...,:3], images[...,-1], white_bkgd=True)
     else:
-        images = images[...,:3]
-        
-    return images, poses, render_poses, hwf, K, i_split, near, far
+        images = ImageStore(images[...,:3])
+
+    return images, poses, render_poses, hwf, K, i_split, near, far, aabb
@@ -65,7 +65,7 @@ def load_blender_data(args):
             fname = os.path.join(basedir, frame['file_path'] + '.png')
             imgs.append(imageio.imread(fname))
             poses.append(np.array(frame['transform_matrix']))
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+        imgs = np.array(imgs) # uint8, keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
         counts.append(counts[-1] + imgs.shape[0])
         all_imgs.append(imgs)
@@ -87,11 +87,13 @@ def load_blender_data(args):
         W = W//2
         focal = focal/2.
 
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4))
+        imgs_half_res = np.zeros((imgs.shape[0], H, W, imgs.shape[-1]), dtype=np.uint8)
         for i, img in enumerate(imgs):
             imgs_half_res[i] = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
         imgs = imgs_half_res
         # imgs = tf.image.resize_area(imgs, [400, 400]).numpy()
 
         
-    return imgs, poses, render_poses, [H, W, focal], None, i_split, 2., 6.
+    # the synthetic scenes fit in [-1.5, 1.5]^3
+    aabb = [[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]]
+    return imgs, poses, render_poses, [H, W, focal], None, i_split, 2., 6., aabb
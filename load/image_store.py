@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+
+def composite(rgb, alpha=None, white_bkgd=False):
+    """
+    uint8 rgb [..., 3] (and alpha [...]) to float32 in [0, 1], numpy or torch.
+    With white_bkgd the colour is composited over white with alpha.
+    """
+    if isinstance(rgb, torch.Tensor):
+        rgb = rgb.float() / 255.
+        alpha = None if alpha is None else alpha.float()[...,None] / 255.
+    else:
+        rgb = rgb.astype(np.float32) / 255.
+        alpha = None if alpha is None else alpha.astype(np.float32)[...,None] / 255.
+    if alpha is not None and white_bkgd:
+        rgb = rgb * alpha + (1. - alpha)
+    return rgb
+
+
+class ImageStore:
+    """
+    Dataset images kept as uint8 [N, H, W, 3], plus an alpha plane [N, H, W] when they are
+    composited over a white background. Indexing converts only the selected images to
+    float32, e.g. images[i_test] or images[img_i, rows, cols]; pixels() does the same on torch.
+    """
+    def __init__(self, rgb, alpha=None, white_bkgd=False):
+        self.rgb = np.ascontiguousarray(rgb)
+        self.alpha = None if alpha is None or not white_bkgd else np.ascontiguousarray(alpha)
+        self.white_bkgd = white_bkgd
+
+    @property
+    def shape(self):
+        return self.rgb.shape
+
+    def __len__(self):
+        return self.rgb.shape[0]
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        if len(idx) <= 3 and all(i is not None and i is not Ellipsis for i in idx):
+            # image, row and column indices select in uint8, only the selection is converted
+            return composite(self.rgb[idx], None if self.alpha is None else self.alpha[idx], self.white_bkgd)
+        first, rest = idx[0], idx[1:]
+        if first is None or first is Ellipsis:
+            return self[:][idx]
+        # an integer drops the image axis, anything else keeps it
+        if np.ndim(first) == 0 and not isinstance(first, slice):
+            return self[first][rest]
+        return self[first][(slice(None),) + rest]
+
+    def pixels(self, img, rows, cols, device=None):
+        """
+        float32 colours [N, 3] of pixels (img, rows, cols), converted on 'device'.
+        """
+        rgb = torch.from_numpy(self.rgb[img, rows, cols]).to(device)
+        alpha = None if self.alpha is None else torch.from_numpy(self.alpha[img, rows, cols]).to(device)
+        return composite(rgb, alpha, self.white_bkgd)
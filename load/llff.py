@@ -115,7 +115,7 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True):
         else:
             return imread(f)
         
-    imgs = imgs = [imread(f)[...,:3]/255. for f in img_files]
+    imgs = imgs = [imread(f)[...,:3] for f in img_files]  # uint8
     imgs = np.stack(imgs, -1)  
     
     print('Loaded image data', imgs.shape, poses[:,-1,0])
@@ -251,7 +251,7 @@ def load_llff_data(args, recenter=True, bd_factor=.75, spherify=False, path_zfla
     # Correct rotation matrix ordering and move variable dim to axis 0
     poses = np.concatenate([poses[:, 1:2, :], -poses[:, 0:1, :], poses[:, 2:, :]], 1)
     poses = np.moveaxis(poses, -1, 0).astype(np.float32)
-    imgs = np.moveaxis(imgs, -1, 0).astype(np.float32)
+    imgs = np.ascontiguousarray(np.moveaxis(imgs, -1, 0))
     images = imgs
     bds = np.moveaxis(bds, -1, 0).astype(np.float32)
     
@@ -312,7 +312,6 @@ def load_llff_data(args, recenter=True, bd_factor=.75, spherify=False, path_zfla
     i_test = np.argmin(dists)
     print('HOLDOUT view is', i_test)
     
-    images = images.astype(np.float32)
     poses = poses.astype(np.float32)
 
     hwf = poses[0,:3,-1]
@@ -339,6 +338,6 @@ def load_llff_data(args, recenter=True, bd_factor=.75, spherify=False, path_zfla
     print('NEAR FAR', near, far)
     i_split = [i_train, i_val, i_test]
     
-    return images, poses, render_poses, hwf, None, i_split, near, far
+    return images, poses, render_poses, hwf, None, i_split, near, far, None
 
 
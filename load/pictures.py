@@ -45,12 +45,12 @@ def load_pictures(args):
     imgs = [] 
     for fname in all_imgs:
         if fname is not None: 
-            img = imread(fname)/255
+            img = imread(fname)
             img = resize(img, (img.shape[0]//downsample,img.shape[1]//downsample))
         # else: raise ValueError('No image found for pose {}'.format(fname))
         imgs.append(img)
         
-    imgs = np.asarray(imgs).astype(np.float32)
+    imgs = np.asarray(imgs)  # uint8
 
     poses = []
     for fname in all_poses:
@@ -82,4 +82,5 @@ def load_pictures(args):
     # far = 5.
     # actual 0. , 6.
     
-    return imgs, poses, render_poses, [H, W, focal], K, i_split, near, far
+    aabb = [min_corner.tolist(), max_corner.tolist()]
+    return imgs, poses, render_poses, [H, W, focal], K, i_split, near, far, aabb
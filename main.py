@@ -12,41 +12,135 @@ from tqdm import tqdm, trange
 import wandb
 
 from load import load_data_from_args
+from utils.baking import load_baked
+from utils.hash_encoding import HashEmbedder, HybridAdam, get_scene_bbox
 from utils.nerf_helpers import *
+from utils.occupancy import OccupancyGrid
+from utils.packed import pack, segment_cumsum, segment_sum, unpack
 
 from utils.parser import config_parser
+from utils.render_cache import RenderCache, embed_settings, is_deterministic, settings_digest
+from utils.reprojection import reproject
+from utils.samplers import (CachedRaySampler, ErrorMapSampler, ImageRaySampler, PixelRaySampler, Prefetcher,
+                            RayBatchSampler, build_ray_cache)
+from utils.writers import AsyncWriter, DepthVideoWriter, VideoWriter, write_depth_png
 
 np.random.seed(0)
 DEBUG = False
+# overridden under __main__, set here so tools importing this module have a device
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# raw density of samples that are never queried, empty even with raw_noise_std noise added
+EMPTY_DENSITY = -1e4
 
 
-def batchify(fn, chunk):
+def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64, ray_idx=None):
     """
-    Constructs a version of 'fn' that applies to smaller batches.
+    Streams inputs through embed_fn and network 'fn' netchunk points at a time and writes
+    into a preallocated output, so the embedded inputs never exist for more than one chunk.
+    View directions are embedded once per ray and broadcast over the samples inside 'fn'.
+    With ray_idx [N], inputs [N, S, 3] belong to rays ray_idx of viewdirs, whose embeddings
+    are gathered per chunk.
     """
-    if chunk is None:
-        return fn
-    def ret(inputs):
-        return torch.cat([fn(inputs[i:i+chunk]) for i in range(0, inputs.shape[0], chunk)], 0)
-    return ret
+    if viewdirs is None:
+        queries = torch.reshape(inputs, [-1, inputs.shape[-1]])  # every point is its own query
+        step = netchunk
+    else:
+        queries = inputs  # chunks of whole rays, [N_rays, N_samples, 3]
+        embedded_dirs = embeddirs_fn(viewdirs)  # [N_rays, C_views]
+        step = None if netchunk is None else max(1, netchunk // inputs.shape[-2])
+    N = queries.shape[0]
+    step = max(N, 1) if step is None else step
+
+    # without autograd nothing keeps a chunk's embedding alive, so one workspace is reused
+    workspace = {}
+    if isinstance(embed_fn, PositionalEncoder) and not torch.is_grad_enabled():
+        chunk_pts = min(step, N) * int(np.prod(queries.shape[1:-1]))
+        workspace['out'] = inputs.new_empty(chunk_pts * embed_fn.out_dim)
+
+    outputs = None
+    for i in range(0, max(N, 1), step):
+        embedded = embed_fn(queries[i:i+step], **workspace)
+        if viewdirs is None:
+            out = fn(embedded)
+        else:
+            out = fn(embedded, embedded_dirs[i:i+step] if ray_idx is None else embedded_dirs[ray_idx[i:i+step]])
+        if outputs is None:
+            outputs = out.new_empty([N] + list(out.shape[1:]))
+        outputs[i:i+step] = out
+    return torch.reshape(outputs, list(inputs.shape[:-1]) + [outputs.shape[-1]])
 
 
-def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64):
+def query_occupied(network_query_fn, pts, viewdirs, network_fn, occupancy_grid=None):
+    """
+    network_query_fn restricted to samples in occupied cells of 'occupancy_grid'.
+    Skipped samples get raw = 0 with EMPTY_DENSITY as density, which stays empty under raw noise.
+    Returns:
+        raw: [N_rays, N_samples, C].
+        n_skipped: [N_rays]. Number of samples not sent to the network.
+    """
+    if occupancy_grid is None:
+        return network_query_fn(pts, viewdirs, network_fn), torch.zeros_like(pts[...,0,0])
+    mask = occupancy_grid.occupied(pts)  # [N_rays, N_samples]
+    ray_idx = torch.nonzero(mask)[:,0]
+    raw_occupied = network_query_fn(pts[mask][:,None], viewdirs, network_fn, ray_idx=ray_idx)
+    raw = raw_occupied.new_zeros(list(mask.shape) + [raw_occupied.shape[-1]])
+    raw[...,3] = EMPTY_DENSITY
+    raw[mask] = raw_occupied[:,0]
+    return raw, torch.sum(~mask, -1).float()
+
+
+def sample_dists(z_vals, rays_d):
     """
-    Prepares inputs and applies network 'fn'.
+    Distance from every sample to the next one along the ray, as in raw2outputs.
     """
-    inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
-    embedded = embed_fn(inputs_flat)
+    dists = z_vals[...,1:] - z_vals[...,:-1]
+    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)
+    return dists * torch.norm(rays_d[...,None,:], dim=-1)
 
-    if viewdirs is not None:
-        input_dirs = viewdirs[:,None].expand(inputs.shape)
-        input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-        embedded_dirs = embeddirs_fn(input_dirs_flat)
-        embedded = torch.cat([embedded, embedded_dirs], -1)
 
-    outputs_flat = batchify(fn, netchunk)(embedded)
-    outputs = torch.reshape(outputs_flat, list(inputs.shape[:-1]) + [outputs_flat.shape[-1]])
-    return outputs
+def march_network(network_query_fn, pts, z_vals, rays_d, viewdirs, network_fn, occupancy_grid=None,
+                  eps=1e-3, segment=16):
+    """
+    Queries samples front to back in segments and stops querying rays whose transmittance
+    fell below 'eps' (early ray termination). Unqueried samples get raw = 0 with EMPTY_DENSITY
+    as density, so compositing the result changes each ray by less than eps.
+    Returns:
+        raw: [N_rays, N_samples, C].
+        n_skipped: [N_rays]. Number of samples not sent to the network.
+    """
+    N_rays, N_samples = z_vals.shape
+    dists = sample_dists(z_vals, rays_d)
+
+    raw = None
+    log_trans = torch.zeros_like(z_vals[:,0])  # log transmittance in front of the segment
+    n_queried = torch.zeros_like(z_vals[:,0])
+    for i in range(0, N_samples, segment):
+        ray_idx = torch.nonzero(log_trans > np.log(eps))[:,0]
+        if ray_idx.numel() == 0:
+            break
+        raw_seg, n_skipped_seg = query_occupied(network_query_fn, pts[ray_idx, i:i+segment],
+                                                None if viewdirs is None else viewdirs[ray_idx],
+                                                network_fn, occupancy_grid)
+        if raw is None:
+            raw = raw_seg.new_zeros([N_rays, N_samples, raw_seg.shape[-1]])
+            raw[...,3] = EMPTY_DENSITY
+        raw[ray_idx, i:i+segment] = raw_seg
+        n_queried[ray_idx] += raw_seg.shape[1] - n_skipped_seg
+
+        # same transmittance as raw2outputs: prod(1 - alpha + 1e-10)
+        alpha = 1. - torch.exp(-relu_func(raw_seg[...,3]) * dists[ray_idx, i:i+segment])
+        log_trans[ray_idx] += torch.sum(torch.log(1. - alpha + 1e-10), -1)
+    return raw, N_samples - n_queried
+
+
+def query_density(pts, render_kwargs, network=None):
+    """
+    Density (after relu) at pts [..., 3] through the density-only path of 'network'
+    (default the coarse network), without the view branch.
+    """
+    fn = render_kwargs['network_fn'] if network is None else network
+    raw = render_kwargs['network_query_fn'](pts, None, fn.density)
+    return relu_func(raw[...,0])
 
 
 def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
@@ -65,32 +159,18 @@ def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
     return all_ret
 
 
-def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
-                near=0., far=1.,
-                use_viewdirs=False, c2w_staticcam=None,
-                  **kwargs):
+# render kwargs consumed by build_rays, everything else goes to render_rays
+RAY_KEYS = ['ndc', 'near', 'far', 'use_viewdirs', 'c2w_staticcam', 'aabb']
+
+
+def build_rays(H, W, K, rays=None, c2w=None, ndc=True, near=0., far=1.,
+               use_viewdirs=False, c2w_staticcam=None, aabb=None):
     """
-    Render rays
-    Args:
-        H: int. Height of image in pixels.
-        W: int. Width of image in pixels.
-            focal: float. Focal length of pinhole camera.
-            chunk: int. Maximum number of rays to process simultaneously. Used to
-            control maximum memory usage. Does not affect final results.
-        rays: array of shape [2, batch_size, 3]. Ray origin and direction for
-            each example in batch.
-        c2w: array of shape [3, 4]. Camera-to-world transformation matrix.
-        ndc: bool. If True, represent ray origin, direction in NDC coordinates.
-        near: float or array of shape [batch_size]. Nearest distance for a ray.
-        far: float or array of shape [batch_size]. Farthest distance for a ray.
-        use_viewdirs: bool. If True, use viewing direction of a point in space in model.
-        c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
-        camera while using other c2w argument for viewing directions.
+    Flat ray batch for render_rays, see render for the arguments.
     Returns:
-        rgb_map: [batch_size, 3]. Predicted RGB values for rays.
-        disp_map: [batch_size]. Disparity map. Inverse of depth.
-        acc_map: [batch_size]. Accumulated opacity (alpha) along a ray.
-        extras: dict with everything returned by render_rays().
+        rays: [N_rays, 8], or [N_rays, 11] with use_viewdirs. Origin, direction, near, far (and view direction).
+        hit: [N_rays] bool, rays that intersect 'aabb'. None if no box is used.
+        sh: shape of the ray directions before flattening, [..., 3].
     """
     if c2w is not None:
         # special case to render full image
@@ -118,12 +198,82 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
     rays_d = torch.reshape(rays_d, [-1,3]).float()
 
     near, far = near * torch.ones_like(rays_d[...,:1]), far * torch.ones_like(rays_d[...,:1])
+    hit = None
+    if aabb is not None and not ndc:
+        t_min, t_max = ray_aabb_intersect(rays_o, rays_d, aabb)
+        near, far = torch.maximum(near, t_min[...,None]), torch.minimum(far, t_max[...,None])
+        hit = far[...,0] > near[...,0]
     rays = torch.cat([rays_o, rays_d, near, far], -1)
     if use_viewdirs:
         rays = torch.cat([rays, viewdirs], -1)
 
+    return rays, hit, sh
+
+
+def scatter_hits(ret, hit, white_bkgd=False):
+    """
+    Scatters render_rays outputs of the rays in 'hit' back to all rays, missed rays get the background.
+    """
+    all_ret = {}
+    for k in ret:
+        all_ret[k] = ret[k].new_zeros([hit.shape[0]] + list(ret[k].shape[1:]))
+        if k in ['rgb_map', 'rgb0'] and white_bkgd:
+            all_ret[k][:] = 1.
+        if k == 'samples_skipped':
+            all_ret[k][:] = 1.
+        all_ret[k][hit] = ret[k]
+    return all_ret
+
+
+def batchify_hit_rays(rays_flat, hit, chunk=1024*32, **kwargs):
+    """
+    batchify_rays for the rays in 'hit' only, the others are filled in with the background.
+    """
+    if not torch.any(hit):
+        # render one ray for the output keys and shapes, then drop it
+        ret = batchify_rays(rays_flat[:1], chunk, **kwargs)
+        return scatter_hits({k : v[:0] for k, v in ret.items()}, hit, kwargs.get('white_bkgd', False))
+    return scatter_hits(batchify_rays(rays_flat[hit], chunk, **kwargs), hit, kwargs.get('white_bkgd', False))
+
+
+def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
+                near=0., far=1.,
+                use_viewdirs=False, c2w_staticcam=None,
+                aabb=None,
+                  **kwargs):
+    """
+    Render rays
+    Args:
+        H: int. Height of image in pixels.
+        W: int. Width of image in pixels.
+            focal: float. Focal length of pinhole camera.
+            chunk: int. Maximum number of rays to process simultaneously. Used to
+            control maximum memory usage. Does not affect final results.
+        rays: array of shape [2, batch_size, 3]. Ray origin and direction for
+            each example in batch.
+        c2w: array of shape [3, 4]. Camera-to-world transformation matrix.
+        ndc: bool. If True, represent ray origin, direction in NDC coordinates.
+        near: float or array of shape [batch_size]. Nearest distance for a ray.
+        far: float or array of shape [batch_size]. Farthest distance for a ray.
+        use_viewdirs: bool. If True, use viewing direction of a point in space in model.
+        c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
+        camera while using other c2w argument for viewing directions.
+        aabb: (min_corner, max_corner) of the scene. If given, [near, far] is clipped to the
+        box per ray and rays that miss it skip the network. Ignored in NDC.
+    Returns:
+        rgb_map: [batch_size, 3]. Predicted RGB values for rays.
+        disp_map: [batch_size]. Disparity map. Inverse of depth.
+        acc_map: [batch_size]. Accumulated opacity (alpha) along a ray.
+        extras: dict with everything returned by render_rays().
+    """
+    rays, hit, sh = build_rays(H, W, K, rays=rays, c2w=c2w, ndc=ndc, near=near, far=far,
+                               use_viewdirs=use_viewdirs, c2w_staticcam=c2w_staticcam, aabb=aabb)
+
     # Render and reshape
-    all_ret = batchify_rays(rays, chunk, **kwargs)
+    if hit is None:
+        all_ret = batchify_rays(rays, chunk, **kwargs)
+    else:
+        all_ret = batchify_hit_rays(rays, hit, chunk, **kwargs)
     for k in all_ret:
         k_sh = list(sh[:-1]) + list(all_ret[k].shape[1:])
         all_ret[k] = torch.reshape(all_ret[k], k_sh)
@@ -134,14 +284,248 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
     return ret_list + [ret_dict]
 
 
+def render_batch(H, W, K, c2ws, chunk=1024*32, **kwargs):
+    """
+    Renders several poses at once: their rays are packed into shared 'chunk'-sized batches,
+    so small (preview) frames do not each underfill a network batch.
+    Returns:
+        list with render's [rgb_map, disp_map, acc_map, extras] for every pose.
+    """
+    if len(c2ws) == 1:
+        return [render(H, W, K, chunk=chunk, c2w=c2ws[0], **kwargs)]
+    ray_kwargs = {k : kwargs.pop(k) for k in RAY_KEYS if k in kwargs}
+    built = [build_rays(H, W, K, c2w=c2w, **ray_kwargs) for c2w in c2ws]
+    rays = torch.cat([rays for rays, _, _ in built], 0)
+    if built[0][1] is None:
+        all_ret = batchify_rays(rays, chunk, **kwargs)
+    else:
+        all_ret = batchify_hit_rays(rays, torch.cat([hit for _, hit, _ in built], 0), chunk, **kwargs)
+
+    rets = []
+    n = H * W
+    for i in range(len(c2ws)):
+        ret = {k : torch.reshape(v[i*n:(i+1)*n], [H, W] + list(v.shape[1:])) for k, v in all_ret.items()}
+        rets.append([ret.pop('rgb_map'), ret.pop('disp_map'), ret.pop('acc_map'), ret])
+    return rets
+
+
+# outputs of render_reuse, every pass produces them
+REUSE_KEYS = ['rgb_map', 'disp_map', 'acc_map', 'depth_map']
+
+
+def render_interval(rays, t_near, t_far, network_query_fn, network_fn, N_samples, white_bkgd=False, chunk=1024*32):
+    """
+    Composites N_samples evenly spaced samples in [t_near, t_far] [N_rays] of every ray of 'rays'
+    (as built by build_rays), followed by an empty sample at the ray's far bound. Unlike
+    render_rays, whose last sample is infinitely long, the interval is not made opaque.
+    """
+    all_ret = {k : [] for k in REUSE_KEYS}
+    t = torch.linspace(0., 1., steps=N_samples)
+    for i in range(0, rays.shape[0], chunk):
+        batch = rays[i:i+chunk]
+        rays_o, rays_d, far = batch[:,0:3], batch[:,3:6], batch[:,7:8]
+        viewdirs = batch[:,8:11] if batch.shape[-1] > 8 else None
+        z_vals = t_near[i:i+chunk,None] + (t_far - t_near)[i:i+chunk,None] * t  # [N_rays, N_samples]
+        pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None]
+        raw = network_query_fn(pts, viewdirs, network_fn)
+        z_vals = torch.cat([z_vals, torch.maximum(far, z_vals[:,-1:])], -1)
+        raw = torch.cat([raw, torch.zeros_like(raw[:,:1])], 1)
+        rgb_map, disp_map, acc_map, _, depth_map = raw2outputs(raw, z_vals, rays_d, white_bkgd=white_bkgd)
+        for k, v in zip(REUSE_KEYS, [rgb_map, disp_map, acc_map, depth_map]):
+            all_ret[k].append(v)
+    return {k : torch.cat(v, 0) for k, v in all_ret.items()}
+
+
+def render_reuse(H, W, K, c2w, prev, chunk=1024*32, reuse_width=0.1, reuse_samples=16, acc_thresh=0.5, **kwargs):
+    """
+    Renders a frame from the previous frame of a camera path. Its depth is reprojected into c2w:
+    - pixels a surface lands on are rendered with 'reuse_samples' samples of the fine network
+      in [depth * (1 - reuse_width), depth * (1 + reuse_width)],
+    - pixels only background lands on get a coarse-only pass,
+    - the others (disocclusions), and pixels where the cheap passes find a new or no surface
+      (acc disagrees with the previous frame), get the full coarse + fine pass.
+    Not for NDC, where depth is not a camera distance.
+    Args:
+        prev: (c2w, depth_map, acc_map) of the previous frame, at the same H, W and K.
+    Returns:
+        render's [rgb_map, disp_map, acc_map, extras]. extras['reuse_passes'] is an int [H, W]
+        map of the pass used per pixel: 0 missed the aabb, 1 narrow, 2 coarse, 3 full.
+        extras['reuse_samples'] is the mean number of network samples per pixel.
+    """
+    ray_kwargs = {k : kwargs.pop(k) for k in RAY_KEYS if k in kwargs}
+    if ray_kwargs.get('ndc', True):
+        raise ValueError('render_reuse needs ndc=False')
+    rays, hit, _ = build_rays(H, W, K, c2w=c2w, **ray_kwargs)
+    if hit is None:
+        hit = torch.ones_like(rays[:,0], dtype=torch.bool)
+    prev_c2w, prev_depth, prev_acc = prev
+    surface_depth, background = reproject(prev_depth, prev_acc, prev_c2w, c2w, H, W, K,
+                                          ray_kwargs.get('far', 1.), acc_thresh)
+
+    white_bkgd = kwargs.get('white_bkgd', False)
+    out = scatter_hits({k : rays.new_zeros([0, 3] if k == 'rgb_map' else [0]) for k in REUSE_KEYS},
+                       torch.zeros_like(hit), white_bkgd)
+    passes = torch.zeros_like(hit, dtype=torch.long)
+    n_samples = 0
+
+    def run(mask, pass_id, samples_per_ray, render_fn):
+        nonlocal n_samples
+        if not torch.any(mask):
+            return None
+        ret = render_fn(rays[mask])
+        for k in REUSE_KEYS:
+            out[k][mask] = ret[k]
+        passes[mask] = pass_id
+        n_samples += int(mask.sum()) * samples_per_ray
+        return ret
+
+    # narrow interval around the reprojected surface
+    narrow = hit & torch.isfinite(surface_depth)
+    d = surface_depth[narrow]
+    ret = run(narrow, 1, reuse_samples, lambda rays: render_interval(
+        rays, torch.maximum(rays[:,6], d * (1. - reuse_width)), torch.minimum(rays[:,7], d * (1. + reuse_width)),
+        kwargs['network_query_fn'], kwargs.get('network_fine') or kwargs['network_fn'], reuse_samples,
+        white_bkgd, chunk))
+    full = hit & ~narrow & ~background
+    if ret is not None:
+        full[narrow.nonzero()[:,0][ret['acc_map'] < acc_thresh]] = True  # the surface moved out of the interval
+
+    # coarse pass where the previous frame saw background
+    coarse = hit & background
+    ret = run(coarse, 2, kwargs['N_samples'], lambda rays: batchify_rays(
+        rays, chunk, **dict(kwargs, N_importance=0, network_fine=None)))
+    if ret is not None:
+        full[coarse.nonzero()[:,0][ret['acc_map'] >= acc_thresh]] = True  # a surface came into view
+
+    run(full, 3, kwargs['N_samples'] + kwargs.get('N_importance', 0), lambda rays: batchify_rays(rays, chunk, **kwargs))
+    out = {k : v.reshape([H, W] + list(v.shape[1:])) for k, v in out.items()}
+    out['reuse_passes'] = passes.reshape(H, W)
+    out['reuse_samples'] = n_samples / (H * W)
+    return [out.pop('rgb_map'), out.pop('disp_map'), out.pop('acc_map'), out]
+
+
+def lattice(n, step):
+    """
+    Every step-th index of range(n), and the last one.
+    """
+    idx = torch.arange(0, n, step)
+    return idx if idx[-1] == n-1 else torch.cat([idx, torch.LongTensor([n-1])])
+
+
+def render_progressive(H, W, K, c2w, chunk=1024*32, step=4, ray_budget=None, time_budget=None, **kwargs):
+    """
+    Renders a lattice of every step-th pixel, then spends what is left of the budget on the
+    lattice cells with the largest colour, opacity and relative depth differences between their
+    corners, a chunk of rays at a time. Pixels not rendered are bilinearly interpolated from the lattice.
+    With neither budget, every pixel is rendered.
+    Args:
+        ray_budget: int. Maximum number of rays, the lattice is always rendered.
+        time_budget: float. Seconds after which no new chunk is started.
+    Returns:
+        render's [rgb_map, disp_map, acc_map, extras]. extras['rendered'] is a bool [H, W] map
+        of the pixels that were rendered, extras['n_rays'] their number.
+    """
+    t_start = time.perf_counter()
+    ray_kwargs = {k : kwargs.pop(k) for k in RAY_KEYS if k in kwargs}
+    rays, hit, _ = build_rays(H, W, K, c2w=c2w, **ray_kwargs)
+    rendered = torch.zeros_like(rays[:,0], dtype=torch.bool)
+    out = scatter_hits({k : rays.new_zeros([0, 3] if k == 'rgb_map' else [0]) for k in REUSE_KEYS},
+                       rendered, kwargs.get('white_bkgd', False))
+
+    def render_pixels(idx):
+        if hit is None:
+            ret = batchify_rays(rays[idx], chunk, **kwargs)
+        else:
+            ret = batchify_hit_rays(rays[idx], hit[idx], chunk, **kwargs)
+        for k in REUSE_KEYS:
+            out[k][idx] = ret[k]
+        rendered[idx] = True
+
+    ys, xs = lattice(H, step), lattice(W, step)
+    render_pixels((ys[:,None] * W + xs[None,:]).reshape(-1))
+    values = {k : v.reshape(H, W, -1)[ys][:,xs] for k, v in out.items()}  # [Ly, Lx, C]
+
+    # cell of every pixel and its bilinear weights
+    cy = torch.clamp(torch.searchsorted(ys, torch.arange(H), right=True) - 1, max=len(ys)-2)
+    cx = torch.clamp(torch.searchsorted(xs, torch.arange(W), right=True) - 1, max=len(xs)-2)
+    ty = ((torch.arange(H) - ys[cy]) / (ys[cy+1] - ys[cy]).float())[:,None,None]
+    tx = ((torch.arange(W) - xs[cx]) / (xs[cx+1] - xs[cx]).float())[None,:,None]
+    for k, v in values.items():
+        interp = (1-ty) * (1-tx) * v[cy][:,cx] + ty * (1-tx) * v[cy+1][:,cx] + \
+                 (1-ty) * tx * v[cy][:,cx+1] + ty * tx * v[cy+1][:,cx+1]
+        out[k][~rendered] = interp.reshape(H*W, -1).squeeze(-1)[~rendered]
+
+    # cells ranked by the spread of their corners
+    def spread(v):
+        c = torch.stack([v[:-1,:-1], v[1:,:-1], v[:-1,1:], v[1:,1:]], 0)
+        return c.max(0)[0] - c.min(0)[0], c.mean(0)
+    rgb_spread, _ = spread(values['rgb_map'])
+    acc_spread, _ = spread(values['acc_map'])
+    depth_spread, depth_mean = spread(values['depth_map'])
+    err = rgb_spread.max(-1)[0] + acc_spread[...,0] + depth_spread[...,0] / (depth_mean[...,0] + 1e-6)
+    rank = torch.empty_like(err.reshape(-1), dtype=torch.long)
+    rank[torch.argsort(err.reshape(-1), descending=True)] = torch.arange(err.numel())
+    cell = (cy[:,None] * (len(xs)-1) + cx[None,:]).reshape(-1)
+    todo = torch.nonzero(~rendered)[:,0]
+    todo = todo[torch.argsort(rank[cell[todo]], stable=True)]  # worst cell first
+
+    n_rays = int(rendered.sum())
+    budget = len(todo) if ray_budget is None else max(ray_budget - n_rays, 0)
+    for i in range(0, min(budget, len(todo)), chunk):
+        if time_budget is not None and time.perf_counter() - t_start > time_budget:
+            break
+        render_pixels(todo[i:min(i+chunk, budget)])
+    out = {k : v.reshape([H, W] + list(v.shape[1:])) for k, v in out.items()}
+    out['rendered'] = rendered.reshape(H, W)
+    out['n_rays'] = int(rendered.sum())
+    return [out.pop('rgb_map'), out.pop('disp_map'), out.pop('acc_map'), out]
+
+
 def render_path(render_poses, hwf, K, chunk, render_kwargs,
                 gt_imgs=None, 
                 savedir=None, 
                 render_factor=0, 
                 img_prefix='',
                 img_suffix='',
-                save_depths=False
+                save_depths=False,
+                video_path=None,
+                depth_video_path=None,
+                depth_range=None,
+                keep_frames=True,
+                depth_16bit=False,
+                io_workers=4,
+                cache=None,
+                batch_poses=1,
+                reuse_keyframe=0,
+                reuse_width=0.1,
+                reuse_samples=16,
+                preview_step=0,
+                preview_rays=1.,
+                preview_time=None
                 ):
+    """
+    Renders every pose, streaming each frame to the PNG / video writers as soon as it is done.
+    Args:
+        video_path: str. If given, rgb frames are appended to this video.
+        depth_video_path: str. If given, depth frames are appended to this video, normalized
+            by 'depth_range' (lo, hi), or by the max over all frames if it is None.
+        keep_frames: bool. If False, frames are not retained and (None, None, None) is returned,
+            so memory does not grow with the number of poses.
+        depth_16bit: bool. Save depth PNGs as 16 bit, normalized by 'depth_range' or [0, far].
+        io_workers: int. Threads encoding PNGs in the background. Videos are appended in order
+            on their own thread. Uploads to wandb are batched into one call at the end.
+        cache: RenderCache. If given, frames are served from it when the weights, pose and
+            render settings match, and rendered frames are added to it. Ignored for random renders.
+        batch_poses: int. Number of poses whose rays are rendered together, see render_batch.
+        reuse_keyframe: int. If > 0, every reuse_keyframe-th pose is rendered in full and the
+            others from the previous frame with render_reuse ('reuse_width', 'reuse_samples').
+            For smooth camera paths, disables 'cache' and 'batch_poses'. Ignored in NDC and with c2w_staticcam.
+        preview_step: int. If > 0, frames are rendered progressively with render_progressive from a
+            lattice of every preview_step-th pixel, with a budget of 'preview_rays' (fraction of the
+            pixels) and 'preview_time' (seconds) per frame. Disables 'cache', 'batch_poses' and reuse.
+    Returns:
+        rgbs, disps, depths: [N, H, W, ...] arrays of all frames, if keep_frames.
+    """
 
     H, W, focal = hwf
 
@@ -154,47 +538,127 @@ def render_path(render_poses, hwf, K, chunk, render_kwargs,
     rgbs = []
     disps = []
     depths = []
+    skipped = []
+    sq_err = 0.
+
+    rgb_video = VideoWriter(video_path) if video_path is not None else None
+    depth_video = DepthVideoWriter(depth_video_path, depth_range) if depth_video_path is not None else None
+    png_writer = AsyncWriter(num_workers=io_workers)
+    video_writer = AsyncWriter(num_workers=1)  # one thread keeps the frames in order
+    uploads = {}
+    png_depth_range = depth_range or (0., render_kwargs.get('far', 1.))
+    if preview_step > 0:
+        cache, batch_poses, reuse_keyframe = None, 1, 0  # previews are approximations of the full render
+    n_preview_rays = 0
+    if reuse_keyframe > 0 and (render_kwargs.get('ndc', True) or render_kwargs.get('c2w_staticcam') is not None):
+        print('[Temporal reuse] not available in NDC or with c2w_staticcam, rendering every frame in full')
+        reuse_keyframe = 0
+    if reuse_keyframe > 0:
+        cache, batch_poses = None, 1  # reused frames are approximations of the full render
+    prev = None
+    spp = []
+    digest = settings_digest(render_kwargs, cache.settings) if cache is not None and is_deterministic(render_kwargs) else None
+    n_hits = 0
+
+    keys = [None] * len(render_poses)
+    if digest is not None:
+        keys = [cache.key(digest, c2w[:3,:4], H, W, K, render_factor) for c2w in render_poses]
+    rendered = {}  # frames rendered ahead by render_batch
 
     t = time.time()
     for i, c2w in enumerate(tqdm(render_poses,desc='Rendering poses: ')):
         if DEBUG:
             print(i, time.time() - t)
         t = time.time()
-        rgb, disp, acc, ret = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], **render_kwargs)
-        rgbs.append(rgb.cpu().numpy())
-        disps.append(disp.cpu().numpy())
-        depths.append(ret['depth_map'].cpu().numpy())
-        # print(torch.max(rgb), type(rgb))
-        # print(torch.max(disp), type(disp))
-        # print(ret['depth_map'].shape, type(ret['depth_map']))
-        # print(torch.max(ret['depth_map']))
+        key = keys[i]
+        entry = cache.get(key) if key is not None else None
+        if entry is not None:
+            rgb, disp, depth = entry['rgb'], entry['disp'], entry['depth']
+            n_hits += 1
+        elif preview_step > 0:
+            rgb, disp, acc, ret = render_progressive(H, W, K, c2w[:3,:4], chunk, preview_step, int(preview_rays * H * W),
+                                                     preview_time, **render_kwargs)
+            n_preview_rays += ret['n_rays']
+            rgb, disp, depth = rgb.cpu().numpy(), disp.cpu().numpy(), ret['depth_map'].cpu().numpy()
+        elif prev is not None and i % reuse_keyframe != 0:
+            rgb, disp, acc, ret = render_reuse(H, W, K, c2w[:3,:4], prev, chunk, reuse_width, reuse_samples,
+                                               **render_kwargs)
+            prev = (c2w[:3,:4], ret['depth_map'], acc)
+            spp.append(ret['reuse_samples'])
+            rgb, disp, depth = rgb.cpu().numpy(), disp.cpu().numpy(), ret['depth_map'].cpu().numpy()
+        else:
+            if i not in rendered:
+                # this and the next cache misses, up to batch_poses of them
+                group = [i]
+                for j in range(i + 1, len(render_poses)):
+                    if len(group) == batch_poses:
+                        break
+                    if keys[j] is None or keys[j] not in cache:
+                        group.append(j)
+                c2ws = [render_poses[j][:3,:4] for j in group]
+                rendered.update(zip(group, render_batch(H, W, K, c2ws, chunk=chunk, **render_kwargs)))
+            rgb, disp, acc, ret = rendered.pop(i)
+            if reuse_keyframe > 0:
+                prev = (c2w[:3,:4], ret['depth_map'], acc)
+                spp.append(render_kwargs['N_samples'] + render_kwargs['N_importance'])
+            rgb, disp, depth = rgb.cpu().numpy(), disp.cpu().numpy(), ret['depth_map'].cpu().numpy()
+            if 'samples_skipped' in ret:
+                skipped.append(ret['samples_skipped'].mean().item())
+            if key is not None:
+                png_writer.submit(cache.put, key, rgb=rgb, disp=disp, depth=depth)
+        if keep_frames:
+            rgbs.append(rgb)
+            disps.append(disp)
+            depths.append(depth)
+        if gt_imgs is not None and render_factor==0:
+            gt = gt_imgs[i].cpu().numpy() if isinstance(gt_imgs,torch.Tensor) else np.asarray(gt_imgs[i])
+            sq_err += np.mean((rgb-gt)**2)
         
-        # assert False, "BREAK"
         if DEBUG and i==0:
             print(rgb.shape, disp.shape)
 
+        if rgb_video is not None:
+            video_writer.submit(rgb_video.append, rgb)
+        if depth_video is not None:
+            video_writer.submit(depth_video.append, depth)
         if savedir is not None:
-            rgb8 = to8b(rgbs[-1])
             filename = path_join(savedir, img_prefix+'{:03d}.png'.format(i))
-            imageio.imwrite(filename, rgb8)
-            wandb.log({img_prefix+'{:03d}.png'.format(i): wandb.Image(filename)})
+            png_writer.submit(imageio.imwrite, filename, to8b(rgb))
+            uploads[img_prefix+'{:03d}.png'.format(i)] = filename
             if save_depths:
                 filename = path_join(savedir, img_prefix+'{:03d}_depth.png'.format(i))
-                imageio.imwrite(filename, to8b(depths[-1]))
-                wandb.log({
-                    img_prefix+'{:03d}_depth.png'.format(i): wandb.Image(filename)
-                    })
-    
-    rgbs = np.stack(rgbs, 0)
-    disps = np.stack(disps, 0)
-    depths = np.stack(depths, 0)
+                png_writer.submit(write_depth_png, filename, depth, png_depth_range, depth_16bit)
+                uploads[img_prefix+'{:03d}_depth.png'.format(i)] = filename
+
+    # only block here, while the writers drain
+    png_writer.close()
+    video_writer.close()
+    if rgb_video is not None:
+        rgb_video.close()
+    if depth_video is not None:
+        depth_video.close()
+    if uploads:
+        wandb.log({k: wandb.Image(filename) for k, filename in uploads.items()})
+    if keep_frames:
+        rgbs = np.stack(rgbs, 0)
+        disps = np.stack(disps, 0)
+        depths = np.stack(depths, 0)
+    else:
+        rgbs, disps, depths = None, None, None
+    if skipped:
+        print(f'[Render] skipped {np.mean(skipped):.3f} of samples')
+    if n_preview_rays:
+        print(f'[Preview] rendered {n_preview_rays / (len(render_poses) * H * W):.3f} of pixels')
+    if spp:
+        print(f'[Temporal reuse] {np.mean(spp):.1f} network samples per pixel, '
+              f'{render_kwargs["N_samples"] + render_kwargs["N_importance"]} without reuse')
+    if digest is not None:
+        print(f'[Render cache] {n_hits} of {len(render_poses)} frames served from {cache.cache_dir}')
 
     if gt_imgs is not None and render_factor==0:
         with torch.no_grad():
-            if isinstance(gt_imgs,torch.Tensor):
-                gt_imgs = gt_imgs.cpu()
-            gts = np.stack(gt_imgs,0)
-            val_loss = np.mean((rgbs-gts)**2)
+            # every frame has the same size, so the mean of the per-frame errors is the overall mse
+            val_loss = sq_err / len(render_poses)
             val_psnr = -10. * np.log10(val_loss)
             output = f'[{img_prefix}] Iter: {img_suffix} Loss: {val_loss:.3f} {img_prefix} PSNR: {val_psnr:.3f}'
 
@@ -208,37 +672,79 @@ def render_path(render_poses, hwf, K, chunk, render_kwargs,
     return rgbs, disps, depths
 
 
-def create_nerf(args):
+def create_nerf(args, bounding_box=None):
     """
     Instantiate NeRF's MLP model.
+    bounding_box: (min_corner, max_corner) of the scene, needed by the hash grid (i_embed=1).
+    Replaced by the [-1, 1] cube in NDC.
     """
-    embed_fn, input_ch = get_embedder(args.multires, args.i_embed)
+    if args.packed and args.ert_eps > 0.:
+        raise ValueError('--packed does not support early ray termination, set --ert_eps 0')
+    embed_kwargs = {'use_recurrence' : args.pe_recurrence}
+    # NDC scenes are sampled inside the [-1, 1] cube
+    ndc = args.dataset_type == 'llff' and not args.no_ndc
+    if ndc:
+        bounding_box = ([-1.]*3, [1.]*3)
+    if args.i_embed == 1:
+        embed_fn = HashEmbedder(bounding_box, n_levels=args.n_levels,
+                                n_features_per_level=args.n_features_per_level,
+                                log2_hashmap_size=args.log2_hashmap_size,
+                                base_resolution=args.base_res, finest_resolution=args.finest_res,
+                                sparse=args.sparse_hash).to(device)
+        input_ch = embed_fn.out_dim
+    else:
+        embed_fn, input_ch = get_embedder(args.multires, args.i_embed, **embed_kwargs)
 
     input_ch_views = 0
     embeddirs_fn = None
     if args.use_viewdirs:
-        embeddirs_fn, input_ch_views = get_embedder(args.multires_views, args.i_embed)
+        # the hash grid only encodes positions, directions keep the frequency encoding
+        i_embed_views = 0 if args.i_embed == 1 else args.i_embed
+        embeddirs_fn, input_ch_views = get_embedder(args.multires_views, i_embed_views, **embed_kwargs)
     output_ch = 5 if args.N_importance > 0 else 4
     skips = [4]
-    model = NeRF(D=args.netdepth, W=args.netwidth,
-                    input_ch=input_ch, output_ch=output_ch, skips=skips,
-                    input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+    if args.i_embed == 1:
+        # the coarse model owns the shared hash tables so they are optimized and checkpointed once
+        model = NeRFSmall(input_ch=input_ch, input_ch_views=input_ch_views,
+                          use_viewdirs=args.use_viewdirs, embedder=embed_fn).to(device)
+    else:
+        model = NeRF(D=args.netdepth, W=args.netwidth,
+                        input_ch=input_ch, output_ch=output_ch, skips=skips,
+                        input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
     grad_vars = list(model.parameters())
 
     model_fine = None
     if args.N_importance > 0:
-        model_fine = NeRF(D=args.netdepth_fine, W=args.netwidth_fine,
-                            input_ch=input_ch, output_ch=output_ch, skips=skips,
-                            input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+        if args.i_embed == 1:
+            model_fine = NeRFSmall(input_ch=input_ch, input_ch_views=input_ch_views,
+                                   use_viewdirs=args.use_viewdirs).to(device)
+        else:
+            model_fine = NeRF(D=args.netdepth_fine, W=args.netwidth_fine,
+                                input_ch=input_ch, output_ch=output_ch, skips=skips,
+                                input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
         grad_vars += list(model_fine.parameters())
 
-    network_query_fn = lambda inputs, viewdirs, network_fn : run_network(inputs, viewdirs, network_fn,
+    network_query_fn = lambda inputs, viewdirs, network_fn, ray_idx=None : run_network(inputs, viewdirs, network_fn,
                                                                 embed_fn=embed_fn,
                                                                 embeddirs_fn=embeddirs_fn,
-                                                                netchunk=args.netchunk)
+                                                                netchunk=args.netchunk,
+                                                                ray_idx=ray_idx)
+
+    occupancy_grid = None
+    if args.occupancy_grid:
+        occupancy_grid = OccupancyGrid(bounding_box,
+                                       resolution=args.occ_res, decay=args.occ_decay,
+                                       threshold=args.occ_threshold).to(device)
 
     # Create optimizer
-    optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
+    if args.i_embed == 1 and args.sparse_hash:
+        hash_params = list(embed_fn.parameters())
+        dense_params = [p for p in grad_vars if all(p is not q for q in hash_params)]
+        optimizer = HybridAdam(dense_params, hash_params, lr=args.lrate, betas=(0.9, 0.99), eps=1e-15)
+    elif args.i_embed == 1:
+        optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.99), eps=1e-15)
+    else:
+        optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
 
     start = 0
     basedir = args.basedir
@@ -257,7 +763,7 @@ def create_nerf(args):
         ckpt_path = ckpts[-1]
         print('Reloading from', ckpt_path)
         wandb.log({'Reloading from': ckpt_path})
-        ckpt = torch.load(ckpt_path)
+        ckpt = torch.load(ckpt_path, map_location=device)
 
         start = ckpt['global_step']
         optimizer.load_state_dict(ckpt['optimizer_state_dict'])
@@ -266,6 +772,8 @@ def create_nerf(args):
         model.load_state_dict(ckpt['network_fn_state_dict'])
         if model_fine is not None:
             model_fine.load_state_dict(ckpt['network_fine_state_dict'])
+        if occupancy_grid is not None and 'occupancy_grid_state_dict' in ckpt:
+            occupancy_grid.load_state_dict(ckpt['occupancy_grid_state_dict'])
 
     ##########################
 
@@ -279,6 +787,8 @@ def create_nerf(args):
         'use_viewdirs' : args.use_viewdirs,
         'white_bkgd' : args.white_bkgd,
         'raw_noise_std' : args.raw_noise_std,
+        'occupancy_grid' : occupancy_grid,
+        'packed' : args.packed,
     }
 
     # NDC only good for LLFF-style forward facing data
@@ -290,8 +800,11 @@ def create_nerf(args):
     render_kwargs_test = {k : render_kwargs_train[k] for k in render_kwargs_train}
     render_kwargs_test['perturb'] = False
     render_kwargs_test['raw_noise_std'] = 0.
+    render_kwargs_test['ert_eps'] = args.ert_eps
+    render_kwargs_test['ert_segment'] = args.ert_segment
 
-    wandb.watch(model,log='all')
+    if wandb.run is not None and not wandb.run.disabled:
+        wandb.watch(model,log='all')
     # change render_kwargs_train
     return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
 
@@ -344,6 +857,65 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
     return rgb_map, disp_map, acc_map, weights, depth_map
 
 
+def raw2outputs_packed(raw, z_vals, dists, ray_indices, offsets, counts, raw_noise_std=0, white_bkgd=False):
+    """
+    raw2outputs for packed samples (see utils/packed.py).
+    Args:
+        raw: [M, 4]. Prediction from model.
+        z_vals: [M]. Integration time.
+        dists: [M]. Distance to the next sample, already scaled by the ray direction's norm.
+        ray_indices, offsets, counts: packing from utils.packed.pack.
+    Returns:
+        rgb_map, disp_map, acc_map, depth_map: [num_rays, ...] as in raw2outputs.
+        weights: [M]. Weights assigned to each packed sample.
+    """
+    N_rays = counts.shape[0]
+    rgb = torch.sigmoid(raw[...,:3])  # [M, 3]
+    noise = 0.
+    if raw_noise_std > 0.:
+        noise = torch.randn(raw[...,3].shape) * raw_noise_std
+
+    alpha = 1.-torch.exp(-relu_func(raw[...,3] + noise)*dists)  # [M]
+    # exclusive cumprod(1.-alpha + 1e-10) per ray, as a segment cumsum in log space
+    log_trans = segment_cumsum(torch.log(1.-alpha + 1e-10), ray_indices, offsets, exclusive=True)
+    weights = alpha * torch.exp(log_trans)
+    rgb_map = segment_sum(weights[...,None] * rgb, ray_indices, N_rays)  # [N_rays, 3]
+
+    depth_map = segment_sum(weights * z_vals, ray_indices, N_rays)
+    acc_map = segment_sum(weights, ray_indices, N_rays)
+    disp_map = depth2dist(depth_map, acc_map[...,None])
+
+    if white_bkgd:
+        rgb_map = rgb_map + (1.-acc_map[...,None])
+
+    return rgb_map, disp_map, acc_map, weights, depth_map
+
+
+def composite_packed(network_query_fn, pts, z_vals, rays_d, viewdirs, network_fn, occupancy_grid=None,
+                     raw_noise_std=0., white_bkgd=False):
+    """
+    Queries and composites only the samples of 'pts' that lie in occupied cells, in packed form.
+    Returns:
+        rgb_map, disp_map, acc_map, depth_map: [N_rays, ...] as in raw2outputs.
+        weights: [N_rays, N_samples]. Zero for skipped samples.
+        raw: [N_rays, N_samples, C]. Zero with EMPTY_DENSITY as density for skipped samples.
+        n_skipped: [N_rays]. Number of samples not sent to the network.
+    """
+    if occupancy_grid is None:
+        mask = torch.ones_like(z_vals, dtype=torch.bool)
+    else:
+        mask = occupancy_grid.occupied(pts)  # [N_rays, N_samples]
+    ray_indices, offsets, counts = pack(mask)
+    dists = sample_dists(z_vals, rays_d)[mask]  # gaps to the next sample, kept or not
+
+    raw = network_query_fn(pts[mask][:,None], viewdirs, network_fn, ray_idx=ray_indices)[:,0]
+    rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs_packed(
+        raw, z_vals[mask], dists, ray_indices, offsets, counts, raw_noise_std, white_bkgd)
+    raw = unpack(raw, mask)
+    raw[...,3][~mask] = EMPTY_DENSITY
+    return rgb_map, disp_map, acc_map, unpack(weights, mask), depth_map, raw, (z_vals.shape[-1] - counts).float()
+
+
 def render_rays(ray_batch,
                 network_fn,
                 network_query_fn,
@@ -355,6 +927,10 @@ def render_rays(ray_batch,
                 network_fine=None,
                 white_bkgd=False,
                 raw_noise_std=0.,
+                occupancy_grid=None,
+                ert_eps=0.,
+                ert_segment=16,
+                packed=False,
                 verbose=False,
                 pytest=False):
     """Volumetric rendering.
@@ -375,6 +951,12 @@ def render_rays(ray_batch,
         network_fine: "fine" network with same spec as network_fn.
         white_bkgd: bool. If True, assume a white background.
         raw_noise_std: ...
+        occupancy_grid: OccupancyGrid. If given, samples in empty cells skip the network.
+        ert_eps: float. If > 0 and autograd is off, stop querying rays once their
+            transmittance is below ert_eps (early ray termination).
+        ert_segment: int. Samples queried per ray and step of early ray termination.
+        packed: bool. If True, drop skipped samples and composite the rest in packed form
+            instead of as dense [num_rays, num_samples] tensors. Not compatible with ert_eps > 0.
         verbose: bool. If True, print more debugging info.
     Returns:
         rgb_map: [num_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
@@ -386,6 +968,8 @@ def render_rays(ray_batch,
         acc0: See acc_map. Output for coarse model.
         z_std: [num_rays]. Standard deviation of distances along ray for each
             sample.
+        samples_skipped: [num_rays]. Fraction of samples skipped by occupancy_grid or
+            early ray termination.
     """
     N_rays = ray_batch.shape[0]
     rays_o, rays_d = ray_batch[:,0:3], ray_batch[:,3:6] # [N_rays, 3] each
@@ -421,8 +1005,26 @@ def render_rays(ray_batch,
 
 
 #     raw = run_network(pts)
-    raw = network_query_fn(pts, viewdirs, network_fn)
-    rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+    if packed and ert_eps > 0.:
+        raise ValueError('packed rendering does not support early ray termination, set ert_eps to 0')
+    # early ray termination only makes sense without gradients
+    march = ert_eps > 0. and not torch.is_grad_enabled()
+    if march:
+        query_fn = lambda pts, z_vals, fn: march_network(network_query_fn, pts, z_vals, rays_d, viewdirs, fn,
+                                                         occupancy_grid, eps=ert_eps, segment=ert_segment)
+    else:
+        query_fn = lambda pts, z_vals, fn: query_occupied(network_query_fn, pts, viewdirs, fn, occupancy_grid)
+
+    def composite(pts, z_vals, fn):
+        if packed:
+            return composite_packed(network_query_fn, pts, z_vals, rays_d, viewdirs, fn, occupancy_grid,
+                                    raw_noise_std, white_bkgd)
+        raw, n_skipped = query_fn(pts, z_vals, fn)
+        rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+        return rgb_map, disp_map, acc_map, weights, depth_map, raw, n_skipped
+
+    rgb_map, disp_map, acc_map, weights, depth_map, raw, n_skipped = composite(pts, z_vals, network_fn)
+    n_total = N_samples
 
     if N_importance > 0:
 
@@ -437,9 +1039,9 @@ def render_rays(ray_batch,
 
         run_fn = network_fn if network_fine is None else network_fine
 #         raw = run_network(pts, fn=run_fn)
-        raw = network_query_fn(pts, viewdirs, run_fn)
-
-        rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+        rgb_map, disp_map, acc_map, weights, depth_map, raw, n_skipped_fine = composite(pts, z_vals, run_fn)
+        n_skipped = n_skipped + n_skipped_fine
+        n_total = n_total + N_samples + N_importance
 
     ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'depth_map' : depth_map}
     if ret_raw:
@@ -449,6 +1051,8 @@ def render_rays(ray_batch,
         ret['disp0'] = disp_map_0
         ret['acc0'] = acc_map_0
         ret['z_std'] = torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
+    if occupancy_grid is not None or march or packed:
+        ret['samples_skipped'] = n_skipped / n_total
 
     for k in ret:
         if (torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any()) and DEBUG:
@@ -461,7 +1065,7 @@ def train(args):
     # TODO: add depthmapping
     # https://keras.io/examples/vision/nerf/
 
-    images, poses, render_poses, hwf, K, i_split, near, far = load_data_from_args(args)
+    images, poses, render_poses, hwf, K, i_split, near, far, aabb = load_data_from_args(args)
     i_train, i_val, i_test = i_split
     H, W, _ = hwf 
     if args.render_poses_filter and np.max(args.render_poses_filter) > len(i_test):
@@ -489,16 +1093,27 @@ def train(args):
     )
     # Create nerf model
     # grad_vars unused
-    render_kwargs_train, render_kwargs_test, start, _, nerf_optimizer = create_nerf(args)
+    if args.use_aabb and aabb is None:
+        print('--use_aabb: the loader gives no scene box, rays are not clipped')
+    use_aabb = args.use_aabb and aabb is not None
+    bounding_box = aabb if use_aabb else get_scene_bbox(poses[i_train], hwf, K, near, far)
+    render_kwargs_train, render_kwargs_test, start, _, nerf_optimizer = create_nerf(args, bounding_box)
     global_step = start
 
     bds_dict = {
         'near' : near,
         'far' : far,
+        'aabb' : aabb if use_aabb else None,
     }
     render_kwargs_train.update(bds_dict)
     render_kwargs_test.update(bds_dict)
 
+    if args.baked_path is not None:
+        # render from a grid written by bake.py instead of the networks
+        baked = load_baked(args.baked_path, device)
+        render_kwargs_test.update(baked.render_kwargs(args.N_samples + args.N_importance))
+        print(f'Rendering from baked grid {args.baked_path}')
+
     # Move testing data to GPU
     render_poses = torch.Tensor(render_poses).to(device)
 
@@ -513,23 +1128,32 @@ def train(args):
                 # Default is smoother render_poses path
                 images = None
 
+            if args.render_poses_filter:
+                render_poses = render_poses[args.render_poses_filter]
+                if images is not None:
+                    images = images[args.render_poses_filter]
+
             testsavedir = path_join(basedir, expname, 'renderonly_{}_{:06d}'.format('test' if args.render_test else 'path', start))
             makedirs(testsavedir, exist_ok=True)
-            print('test poses shape', render_poses[args.render_poses_filter].shape)
-
-            rgbs, _, depths = render_path(render_poses[args.render_poses_filter], hwf, K, args.chunk, render_kwargs_test, gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor)
-
-            depths = np.repeat(np.expand_dims(depths,axis=3),3,axis=3)
-            # because rgbs may be slightly over 1
-            imageio.mimwrite(path_join(testsavedir, 'rbgs_video.mp4'), to8b(rgbs/np.max(rgbs)), fps=30, quality=8)
-            imageio.mimwrite(path_join(testsavedir, 'depths_video.mp4'), to8b(depths/np.max(depths)), fps=30, quality=8)
+            print('test poses shape', render_poses.shape)
+
+            cache = None
+            if args.render_cache:
+                cache = RenderCache(path_join(basedir, expname, 'render_cache'), args.render_cache_size * 1024**2,
+                                    settings=embed_settings(args))
+            rgb_path, depth_path = path_join(testsavedir, 'rbgs_video.mp4'), path_join(testsavedir, 'depths_video.mp4')
+            render_path(render_poses, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor,
+                        video_path=rgb_path, depth_video_path=depth_path, depth_range=args.depth_range, keep_frames=False,
+                        save_depths=args.save_depths, depth_16bit=args.depth_16bit, io_workers=args.io_workers,
+                        cache=cache, batch_poses=args.render_batch_poses,
+                        reuse_keyframe=0 if args.render_test else args.temporal_reuse, reuse_width=args.reuse_width, reuse_samples=args.reuse_samples)
             # logs
             wandb.log(
                 {
-                    "render_only_rbgs_gif": wandb.Video(rgbs, fps=30, format='gif'),
-                    "render_only_depths_gif": wandb.Video(depths, fps=30, format='gif'),
-                    "render_only_rbgs_mp4": wandb.Video(path_join(testsavedir, 'rbgs_video.mp4'), fps=10, format='mp4'),
-                    "render_only_depths_mp4": wandb.Video(path_join(testsavedir, 'depths_video.mp4'), fps=10, format='mp4'),
+                    "render_only_rbgs_gif": wandb.Video(rgb_path, fps=30, format='gif'),
+                    "render_only_depths_gif": wandb.Video(depth_path, fps=30, format='gif'),
+                    "render_only_rbgs_mp4": wandb.Video(rgb_path, fps=10, format='mp4'),
+                    "render_only_depths_mp4": wandb.Video(depth_path, fps=10, format='mp4'),
                 }
             )
             # early break
@@ -538,29 +1162,36 @@ def train(args):
     # Prepare raybatch tensor if batching random rays
     N_rand = args.N_rand
     use_batching = not args.no_batching
-    if use_batching:
+    # the error map sampler (built below) draws its own rays
+    ray_source = None if args.error_map else args.ray_sampler
+    # samplers draw from generators of their own, seeded here so runs stay reproducible with --prefetch
+    sampler_seed = int(np.random.randint(2**31))
+    if use_batching and ray_source == 'cache':
+        # rays streamed to disk one image at a time, read back batch by batch
+        ray_cache_dir = args.ray_cache_dir or path_join(basedir, 'ray_cache')
+        ray_sampler = CachedRaySampler(build_ray_cache(ray_cache_dir, images, poses, K, H, W, i_train), N_rand, device,
+                                       seed=sampler_seed)
+    elif use_batching and ray_source == 'pixels':
+        # only uint8 images and poses, rays are built per batch
+        ray_sampler = PixelRaySampler(images, poses, K, i_train, N_rand, device, seed=sampler_seed)
+    elif use_batching and ray_source == 'memory':
         # For random ray batching
         print('get rays')
         rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0) # [N, ro+rd, H, W, 3]
         print('done, concats')
         # added for bottles dataset
-        if rays.shape[0] > images[:,None].shape[0]:
-            rays = rays[:images[:,None].shape[0]]
-        # print(rays.shape, images[:,None].shape)
+        if rays.shape[0] > len(images):
+            rays = rays[:len(images)]
         rays_rgb = np.concatenate([rays, images[:,None]], 1) # [N, ro+rd+rgb, H, W, 3]
         rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb, 3]
         rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0) # train images only
         rays_rgb = np.reshape(rays_rgb, [-1,3,3]) # [(N-1)*H*W, ro+rd+rgb, 3]
         rays_rgb = rays_rgb.astype(np.float32)
-        print('shuffle rays')
-        np.random.shuffle(rays_rgb)
-
         print('done')
-        i_batch = 0
 
         # Move training data to GPU
-        images = torch.Tensor(images).to(device)
-        rays_rgb = torch.Tensor(rays_rgb).to(device)
+        ray_sampler = RayBatchSampler(torch.Tensor(rays_rgb).to(device), N_rand, seed=sampler_seed)
+        del rays_rgb
 
 
     poses = torch.Tensor(poses).to(device)
@@ -579,58 +1210,27 @@ def train(args):
     # writer = SummaryWriter(path_join(basedir, 'summaries', expname))
     
     start = start + 1
+    if not use_batching:
+        # Random from one image
+        ray_sampler = ImageRaySampler(images, poses, K, i_train, N_rand, H, W, args.precrop_iters,
+                                      args.precrop_frac, start, device, seed=sampler_seed)
+    error_sampler = None
+    if args.error_map:
+        # rays drawn where the error is, uniformly over the precrop window until precrop_iters
+        error_sampler = ErrorMapSampler(images, poses.cpu().numpy(), K, i_train, N_rand, device, res=args.error_map_res,
+                                        uniform=args.error_map_uniform, per_image=not use_batching,
+                                        warmup=None if use_batching else ray_sampler,
+                                        warmup_iters=0 if use_batching else args.precrop_iters, seed=sampler_seed + 1)
+        ray_sampler = error_sampler
+    if args.prefetch > 0:
+        # batches of the next steps are prepared on a background thread
+        ray_sampler = Prefetcher(ray_sampler, start, N_iters, depth=args.prefetch)
     for i in range(start, N_iters):
         time0 = time.time()
 
         # Sample random ray batch
-        if use_batching:
-            # Random over all images
-            batch = rays_rgb[i_batch:i_batch+N_rand] # [B, 2+1, 3*?]
-            batch = torch.transpose(batch, 0, 1)
-            batch_rays, target_s = batch[:2], batch[2]
-
-            i_batch += N_rand
-            if i_batch >= rays_rgb.shape[0]:
-                print("Shuffle data after an epoch!")
-                rand_idx = torch.randperm(rays_rgb.shape[0])
-                rays_rgb = rays_rgb[rand_idx]
-                i_batch = 0
+        batch_rays, target_s = ray_sampler.sample(i)
 
-        else:
-            # Random from one image
-            img_i = np.random.choice(i_train)
-            target = images[img_i]
-            target = torch.Tensor(target).to(device)
-            pose = poses[img_i, :3,:4]
-
-            if N_rand is not None:
-                rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
-                if i < args.precrop_iters:
-                    dH = int(H//2 * args.precrop_frac)
-                    dW = int(W//2 * args.precrop_frac)
-                    coords = torch.stack(
-                        torch.meshgrid(
-                            torch.linspace(H//2 - dH, H//2 + dH - 1, 2*dH), 
-                            torch.linspace(W//2 - dW, W//2 + dW - 1, 2*dW),
-                            indexing = 'ij'
-                        ), -1)
-                    if i == start:
-                        print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")                
-                else:
-                    coords = torch.stack(torch.meshgrid(
-                                            torch.linspace(0, H-1, H), 
-                                            torch.linspace(0, W-1, W),
-                                            indexing='ij')
-                                        , -1)  # (H, W, 2)
-
-                coords = torch.reshape(coords, [-1,2])  # (H * W, 2)
-                select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-                select_coords = coords[select_inds].long()  # (N_rand, 2)
-                rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                batch_rays = torch.stack([rays_o, rays_d], 0)
-                target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
 
         #####  Core optimization loop  #####
         rgb, disp, acc_map, extras = render(H, W, K, chunk=args.chunk, rays=batch_rays,
@@ -642,14 +1242,30 @@ def train(args):
         trans = extras['raw'][...,-1]
         train_loss = img_loss
         train_psnr = mse2psnr(img_loss)
+        # importance weights only enter the optimized loss, PSNR stays the plain batch MSE
+        weights = None if error_sampler is None else error_sampler.weights(i)
+        if weights is not None:
+            ray_loss = torch.mean((rgb - target_s) ** 2, -1)
+            train_loss = torch.mean(weights * ray_loss)
         
         if 'rgb0' in extras:
             img_loss0 = img2mse(extras['rgb0'], target_s)
-            train_loss = train_loss + img_loss0
+            if weights is None:
+                train_loss = train_loss + img_loss0
+            else:
+                train_loss = train_loss + torch.mean(weights * torch.mean((extras['rgb0'] - target_s) ** 2, -1))
             psnr0 = mse2psnr(img_loss0)
 
         train_loss.backward()
         nerf_optimizer.step()
+        if weights is not None:
+            error_sampler.update(i, ray_loss)
+
+        occupancy_grid = render_kwargs_train['occupancy_grid']
+        if occupancy_grid is not None and i >= args.occ_warmup and i % args.occ_update_every == 0:
+            density_fn = lambda pts: query_density(pts, render_kwargs_train)
+            occupancy_grid.update(density_fn, chunk=args.netchunk)
+            tqdm.write(f"[Occupancy] Iter: {i} occupied cells: {occupancy_grid.occupancy():.3f}")
 
         # NOTE: IMPORTANT!
         ###   update learning rate   ###
@@ -668,23 +1284,33 @@ def train(args):
 
         if i%args.i_print==0:
             outstring =f"[TRAIN] Iter: {i} Loss: {train_loss.item()} PSNR: {train_psnr.item()} Iter time: {dt:.05f}" 
-            tqdm.write(outstring)
-            wandb.log({
+            logs = {
                 "TRAIN/Iter": i,
                 "TRAIN/Loss": train_loss.item(),
                 "TRAIN/PSNR": train_psnr.item(),
                 "TRAIN/Iter time": dt
-            })
+            }
+            if 'samples_skipped' in extras:
+                logs["TRAIN/Skipped samples"] = extras['samples_skipped'].mean().item()
+                outstring += f" Skipped samples: {logs['TRAIN/Skipped samples']:.3f}"
+            if args.prefetch > 0:
+                logs["TRAIN/Data waits"], logs["TRAIN/Data wait time"] = ray_sampler.stats()
+                outstring += f" Data waits: {logs['TRAIN/Data waits']:.3f}"
+            tqdm.write(outstring)
+            wandb.log(logs)
 
         # logging weights
         if i%args.i_weights==0:
             path = path_join(basedir, expname, '{:06d}.tar'.format(i))
-            torch.save({
+            ckpt = {
                 'global_step': global_step,
                 'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
                 'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
                 'optimizer_state_dict': nerf_optimizer.state_dict(),
-            }, path)
+            }
+            if render_kwargs_train['occupancy_grid'] is not None:
+                ckpt['occupancy_grid_state_dict'] = render_kwargs_train['occupancy_grid'].state_dict()
+            torch.save(ckpt, path)
             wandb.save("model_iter_{:06d}.tar".format(i))
             print('Saved checkpoints at', path)
 
@@ -692,13 +1318,14 @@ def train(args):
         if i%args.i_video==0 and i > 0:
             # Turn on testing mode
             print('video')
-            with torch.no_grad():
-                rgbs, _, depths = render_path(render_poses, hwf, K, args.chunk, render_kwargs_test)
-
-            print('Done, saving', rgbs.shape, depths.shape)
             moviebase = path_join(basedir, expname, '{}_spiral_{:06d}_'.format(expname, i))
-            imageio.mimwrite(moviebase + 'rgb.mp4', to8b(rgbs), fps=30, quality=8)
-            imageio.mimwrite(moviebase + 'depth.mp4', to8b(depths / np.max(depths)), fps=30, quality=8)
+            with torch.no_grad():
+                render_path(render_poses, hwf, K, args.chunk, render_kwargs_test, video_path=moviebase + 'rgb.mp4',
+                            depth_video_path=moviebase + 'depth.mp4', depth_range=args.depth_range, keep_frames=False,
+                            batch_poses=args.render_batch_poses,
+                            reuse_keyframe=args.temporal_reuse, reuse_width=args.reuse_width, reuse_samples=args.reuse_samples,
+                            preview_step=args.preview_step, preview_rays=args.preview_rays, preview_time=args.preview_time)
+            print('Done, saved', moviebase)
             wandb.log({
                 '{}_spiral_{:06d}_'.format(expname, i)+'rgb.gif': wandb.Video(moviebase + 'rgb.mp4', format='gif'),
                 '{}_spiral_{:06d}_'.format(expname, i)+'disp.gif': wandb.Video(moviebase + 'depth.mp4', format='gif'),
@@ -709,10 +1336,13 @@ def train(args):
                 print('static video')
                 render_kwargs_test['c2w_staticcam'] = render_poses[30][:3,:4]
                 with torch.no_grad():
-                    rgbs_still, *_ = render_path(render_poses, hwf, K ,args.chunk, render_kwargs_test)
+                    render_path(render_poses, hwf, K ,args.chunk, render_kwargs_test,
+                                video_path=moviebase + 'rgb_still.mp4', keep_frames=False,
+                                batch_poses=args.render_batch_poses,
+                                reuse_keyframe=args.temporal_reuse, reuse_width=args.reuse_width, reuse_samples=args.reuse_samples,
+                                preview_step=args.preview_step, preview_rays=args.preview_rays, preview_time=args.preview_time)
 
                 render_kwargs_test['c2w_staticcam'] = None
-                imageio.mimwrite(moviebase + 'rgb_still.mp4', to8b(rgbs_still), fps=30, quality=8)
                 wandb.log({
                     '{}_spiral_{:06d}_'.format(expname, i)+'rgb_still.gif': wandb.Video(moviebase + 'rgb_still.mp4', format='gif'),
                     '{}_spiral_{:06d}_'.format(expname, i)+'rgb_still.mp4': wandb.Video(moviebase + 'rgb_still.mp4'),
@@ -728,7 +1358,9 @@ def train(args):
                 pose_filter = torch.Tensor(poses[inds]).to(device)
                 render_path(pose_filter, hwf, K, args.chunk, render_kwargs_test,
                                 # gt_imgs=images[i_test], 
-                                savedir=testsavedir)
+                                savedir=testsavedir, keep_frames=False, depth_range=args.depth_range,
+                                save_depths=args.save_depths, depth_16bit=args.depth_16bit, io_workers=args.io_workers,
+                                batch_poses=args.render_batch_poses)
                 pose_filter = pose_filter.cpu()
                 del pose_filter
             print('Saved test set')
@@ -742,7 +1374,13 @@ def train(args):
                                             gt_imgs=val_imgs,
                                             img_prefix=f'VAL',
                                             img_suffix=i,
-                                            savedir=filename
+                                            savedir=filename,
+                                            keep_frames=False,
+                                            io_workers=args.io_workers,
+                                            batch_poses=args.render_batch_poses,
+                                            preview_step=args.preview_step,
+                                            preview_rays=args.preview_rays,
+                                            preview_time=args.preview_time
                                             )
 
     
@@ -788,6 +1426,9 @@ def train(args):
 
         global_step += 1
 
+    if args.prefetch > 0:
+        ray_sampler.close()
+
 
 if __name__=='__main__':
     parser = config_parser()
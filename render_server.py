@@ -0,0 +1,251 @@
+###############################################################################
+# Local render server: one resident checkpoint, rays of concurrent requests
+# share chunk-sized network batches
+###############################################################################
+# usage: python render_server.py --config configs/lego.txt [--port 8000 | --unix_socket /tmp/nerf.sock]
+#   curl -X POST localhost:8000/render -d '{"c2w": [[...], [...], [...]], "H": 400, "W": 400, "focal": 555.5}' > frame.png
+#   curl localhost:8000/stats
+# POST /render takes a JSON body with
+#   c2w: 3x4 or 4x4 camera-to-world matrix.
+#   H, W: image size, and K (3x3 intrinsics) or focal.
+#   near, far: optional, default --near/--far (0 and 1 in NDC).
+#   format: 'png' (rgb, default) or 'npz' (float32 rgb, disp, acc, depth).
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import time
+
+import imageio
+import numpy as np
+import torch
+import wandb
+
+import main
+from main import RAY_KEYS, build_rays, create_nerf, render_rays, scatter_hits
+from utils.nerf_helpers import to8b
+from utils.parser import config_parser
+
+# outputs returned per request, with their per-ray shape
+OUTPUTS = {'rgb_map' : [3], 'disp_map' : [], 'acc_map' : [], 'depth_map' : []}
+
+
+class RenderJob:
+    """
+    One request: its rays, the outputs rendered so far and a future resolved when all rays are done.
+    """
+    def __init__(self, rays, hit, H, W):
+        self.rays = rays if hit is None else rays[hit]
+        self.hit = hit
+        self.H, self.W = H, W
+        self.outputs = {k : torch.empty([self.rays.shape[0]] + dims) for k, dims in OUTPUTS.items()}
+        self.scheduled = 0  # rays handed to a batch
+        self.rendered = 0
+        self.future = asyncio.get_running_loop().create_future()
+        self.t_start = time.perf_counter()
+
+
+class RenderServer:
+    """
+    Keeps the networks resident and renders the rays of all pending jobs in FIFO order,
+    'chunk' rays per network batch regardless of which request they come from.
+    """
+    def __init__(self, render_kwargs, ray_kwargs, chunk):
+        self.render_kwargs = render_kwargs
+        self.ray_kwargs = ray_kwargs
+        self.chunk = chunk
+        self.jobs = deque()
+        self.pending = asyncio.Event()
+        self.renderer = ThreadPoolExecutor(max_workers=1)  # networks run on one thread
+        self.t_start = time.perf_counter()
+        self.latencies = []
+        self.n_rays = 0
+        self.n_batches = 0
+        self.busy = 0.
+
+    async def render(self, H, W, K, c2w, near, far):
+        """
+        Renders one frame, returns OUTPUTS as [H, W, ...] numpy arrays.
+        """
+        loop = asyncio.get_running_loop()
+        ray_kwargs = dict(self.ray_kwargs, near=near, far=far)
+        rays, hit, _ = await loop.run_in_executor(None, lambda: build_rays(H, W, K, c2w=c2w, **ray_kwargs))
+        job = RenderJob(rays, hit, H, W)
+        if job.rays.shape[0] == 0:
+            job.future.set_result(None)
+        else:
+            self.jobs.append(job)
+            self.pending.set()
+        await job.future
+
+        outputs = job.outputs
+        if job.hit is not None:
+            outputs = scatter_hits(outputs, job.hit, self.render_kwargs.get('white_bkgd', False))
+        self.latencies.append(time.perf_counter() - job.t_start)
+        return {k : v.reshape([H, W] + OUTPUTS[k]).cpu().numpy() for k, v in outputs.items()}
+
+    def _render_batch(self, rays):
+        with torch.no_grad():
+            return render_rays(rays, **self.render_kwargs)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.jobs:
+                self.pending.clear()
+                await self.pending.wait()
+
+            # fill one batch from the queued jobs in arrival order
+            pieces, n = [], 0
+            while self.jobs and n < self.chunk:
+                job = self.jobs[0]
+                take = min(self.chunk - n, job.rays.shape[0] - job.scheduled)
+                pieces.append((job, job.scheduled, job.scheduled + take))
+                job.scheduled += take
+                n += take
+                if job.scheduled == job.rays.shape[0]:
+                    self.jobs.popleft()
+
+            rays = torch.cat([job.rays[i0:i1] for job, i0, i1 in pieces], 0)
+            t = time.perf_counter()
+            try:
+                ret = await loop.run_in_executor(self.renderer, self._render_batch, rays)
+            except Exception as e:
+                for job, _, _ in pieces:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                self.jobs = deque(job for job in self.jobs if not job.future.done())
+                continue
+            self.busy += time.perf_counter() - t
+            self.n_rays += n
+            self.n_batches += 1
+
+            offset = 0
+            for job, i0, i1 in pieces:
+                for k in OUTPUTS:
+                    job.outputs[k][i0:i1] = ret[k][offset:offset + i1 - i0]
+                offset += i1 - i0
+                job.rendered += i1 - i0
+                if job.rendered == job.rays.shape[0] and not job.future.done():
+                    job.future.set_result(None)
+
+    def stats(self):
+        lat = np.array(self.latencies) if self.latencies else np.zeros(1)
+        uptime = time.perf_counter() - self.t_start
+        return {
+            'requests' : len(self.latencies),
+            'latency_mean_s' : float(lat.mean()),
+            'latency_p50_s' : float(np.percentile(lat, 50)),
+            'latency_p95_s' : float(np.percentile(lat, 95)),
+            'rays' : self.n_rays,
+            'batches' : self.n_batches,
+            'mean_batch_fill' : self.n_rays / max(self.n_batches, 1) / self.chunk,
+            'rays_per_s' : self.n_rays / max(self.busy, 1e-9),
+            'requests_per_s' : len(self.latencies) / max(uptime, 1e-9),
+            'uptime_s' : uptime,
+        }
+
+
+def parse_request(body, default_near, default_far):
+    req = json.loads(body)
+    H, W = int(req['H']), int(req['W'])
+    if 'K' in req:
+        K = np.array(req['K'], dtype=np.float32)
+    else:
+        focal = float(req['focal'])
+        K = np.array([[focal, 0, 0.5*W], [0, focal, 0.5*H], [0, 0, 1]], dtype=np.float32)
+    c2w = torch.Tensor(np.array(req['c2w'], dtype=np.float32)[:3,:4])
+    fmt = req.get('format', 'png')
+    if fmt not in ['png', 'npz']:
+        raise ValueError(f"format must be 'png' or 'npz', got {fmt}")
+    return H, W, K, c2w, float(req.get('near', default_near)), float(req.get('far', default_far)), fmt
+
+
+def encode(outputs, fmt):
+    buf = io.BytesIO()
+    if fmt == 'png':
+        imageio.imwrite(buf, to8b(outputs['rgb_map']), format='png')
+        return buf.getvalue(), 'image/png'
+    np.savez(buf, **{k.replace('_map', '') : v for k, v in outputs.items()})
+    return buf.getvalue(), 'application/octet-stream'
+
+
+def make_handler(server, default_near, default_far):
+    async def handle(reader, writer):
+        status, body, content_type = 200, b'', 'application/json'
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            data = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if method == 'GET' and path == '/stats':
+                body = json.dumps(server.stats()).encode()
+            elif method == 'POST' and path == '/render':
+                try:
+                    H, W, K, c2w, near, far, fmt = parse_request(data, default_near, default_far)
+                except (KeyError, ValueError, TypeError) as e:
+                    raise ValueError(f'bad request: {e!r}')
+                t = time.perf_counter()
+                outputs = await server.render(H, W, K, c2w, near, far)
+                body, content_type = await asyncio.get_running_loop().run_in_executor(None, encode, outputs, fmt)
+                print(f'[server] {W}x{H} {fmt} in {time.perf_counter() - t:.3f} s')
+            else:
+                status, body = 404, b'{"error": "not found"}'
+        except ValueError as e:
+            status, body = 400, json.dumps({'error' : str(e)}).encode()
+        except Exception as e:
+            status, body = 500, json.dumps({'error' : repr(e)}).encode()
+
+        reason = {200 : 'OK', 400 : 'Bad Request', 404 : 'Not Found', 500 : 'Internal Server Error'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+        writer.close()
+    return handle
+
+
+async def serve(args, render_kwargs, ray_kwargs):
+    server = RenderServer(render_kwargs, ray_kwargs, args.chunk)
+    default_near, default_far = (0., 1.) if ray_kwargs.get('ndc', True) else (args.near, args.far)
+    handle = make_handler(server, default_near, default_far)
+    if args.unix_socket is not None:
+        listener = await asyncio.start_unix_server(handle, path=args.unix_socket)
+        print(f'[server] listening on {args.unix_socket}')
+    else:
+        listener = await asyncio.start_server(handle, args.host, args.port)
+        print(f'[server] listening on http://{args.host}:{args.port}')
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), server.run())
+
+
+if __name__ == '__main__':
+    parser = config_parser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None,
+                        help='listen on this unix socket instead of host:port')
+    parser.add_argument("--near", type=float, default=2.,
+                        help='default near bound of requests, ignored in NDC')
+    parser.add_argument("--far", type=float, default=6.,
+                        help='default far bound of requests, ignored in NDC')
+    args = parser.parse_args()
+    wandb.init(mode='disabled')
+    if torch.cuda.is_available():
+        main.device = torch.device(f'cuda:{args.gpu}')
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    # hash grid and occupancy bounds are buffers, they come from the checkpoint
+    placeholder_box = ([-1., -1., -1.], [1., 1., 1.])
+    _, render_kwargs_test, start, _, _ = create_nerf(args, placeholder_box)
+    if start == 0:
+        raise ValueError(f'no checkpoint found for {args.expname}, nothing to serve')
+    ray_kwargs = {k : render_kwargs_test.pop(k) for k in RAY_KEYS if k in render_kwargs_test}
+    asyncio.run(serve(args, render_kwargs_test, ray_kwargs))
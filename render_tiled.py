@@ -0,0 +1,157 @@
+###############################################################################
+# Out-of-core tiled rendering on CPU worker processes
+###############################################################################
+# usage: python render_tiled.py --config configs/lego.txt [--tiled_scale 8] [--tile 256] [--tiled_workers 8]
+# renders render_poses[--tiled_pose] at --tiled_scale times the dataset resolution into
+# <basedir>/<expname>/tiled_<pose>_{rgb,depth}.npy, memory-mapped arrays written tile by tile.
+# Workers are forked after the checkpoint is loaded and share its weights, memory per worker is
+# bounded by --tile and --chunk.
+
+import os
+from os.path import join as path_join
+import time
+
+import imageio
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+import wandb
+
+import main
+from main import create_nerf, render
+from utils.nerf_helpers import get_rays, to8b
+from utils.parser import config_parser
+
+
+def tiles(H, W, tile):
+    """
+    (y0, x0, h, w) of every tile of an H x W image, row by row.
+    """
+    return [(y0, x0, min(tile, H - y0), min(tile, W - x0)) for y0 in range(0, H, tile) for x0 in range(0, W, tile)]
+
+
+def tile_rays(K, c2w, y0, x0, h, w):
+    """
+    Rays of the pixels [y0:y0+h, x0:x0+w] of a camera with intrinsics K, [h, w, 3] each.
+    """
+    K = np.array(K, dtype=np.float32)
+    K[0,2] -= x0
+    K[1,2] -= y0
+    return get_rays(h, w, K, c2w)
+
+
+def share_modules(render_kwargs):
+    """
+    Moves every module of render_kwargs to shared memory, including the ones a function
+    closes over or is bound to (the embedders behind network_query_fn, a baked grid).
+    """
+    for v in render_kwargs.values():
+        candidates = [v, getattr(v, '__self__', None)]
+        candidates += [cell.cell_contents for cell in getattr(v, '__closure__', None) or []]
+        for m in candidates:
+            if isinstance(m, torch.nn.Module):
+                m.share_memory()
+
+
+# set in every worker by _init_worker, inherited from the parent through fork
+_worker = {}
+
+
+def _init_worker(H, W, K, c2w, chunk, render_kwargs, rgb_path, depth_path, num_threads):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    _worker.update(H=H, W=W, K=K, c2w=c2w, chunk=chunk, render_kwargs=render_kwargs,
+                   rgb=np.load(rgb_path, mmap_mode='r+'), depth=np.load(depth_path, mmap_mode='r+'))
+
+
+def _render_tile(tile):
+    """
+    Renders one tile into the memory-mapped outputs, returns its number of pixels.
+    """
+    y0, x0, h, w = tile
+    w_ = _worker
+    with torch.no_grad():
+        rays = tile_rays(w_['K'], w_['c2w'], y0, x0, h, w)
+        # the full H, W and K keep NDC rays the same as in an untiled render
+        rgb, _, _, extras = render(w_['H'], w_['W'], w_['K'], chunk=w_['chunk'], rays=rays, **w_['render_kwargs'])
+    w_['rgb'][y0:y0+h, x0:x0+w] = to8b(rgb.cpu().numpy())
+    w_['depth'][y0:y0+h, x0:x0+w] = extras['depth_map'].cpu().numpy()
+    return h * w
+
+
+def render_tiled(H, W, K, c2w, render_kwargs, out_prefix, tile=256, num_workers=4, chunk=1024*32):
+    """
+    Renders an H x W image tile by tile on 'num_workers' forked processes, into
+    <out_prefix>_rgb.npy (uint8 [H, W, 3]) and <out_prefix>_depth.npy (float32 [H, W]).
+    The modules are moved to shared memory first, so workers do not copy the weights.
+    With num_workers = 0 tiles are rendered in this process.
+    Returns:
+        rgb_path, depth_path.
+    """
+    if render_kwargs.get('c2w_staticcam') is not None:
+        raise ValueError('render_tiled does not support c2w_staticcam')
+    rgb_path, depth_path = out_prefix + '_rgb.npy', out_prefix + '_depth.npy'
+    np.lib.format.open_memmap(rgb_path, mode='w+', dtype=np.uint8, shape=(H, W, 3)).flush()
+    np.lib.format.open_memmap(depth_path, mode='w+', dtype=np.float32, shape=(H, W)).flush()
+    share_modules(render_kwargs)
+
+    todo = tiles(H, W, tile)
+    # workers split the cores, the main process keeps its own threads
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers) if num_workers > 0 else None
+    worker_args = (H, W, K, c2w, chunk, render_kwargs, rgb_path, depth_path, num_threads)
+    t = time.perf_counter()
+    if num_workers == 0:
+        _init_worker(*worker_args)
+        for tile_ in tqdm(todo, desc='Rendering tiles: '):
+            _render_tile(tile_)
+        _worker.clear()
+    else:
+        with mp.get_context('fork').Pool(num_workers, initializer=_init_worker, initargs=worker_args) as pool:
+            for _ in tqdm(pool.imap_unordered(_render_tile, todo), total=len(todo), desc='Rendering tiles: '):
+                pass
+    dt = time.perf_counter() - t
+    print(f'[tiled] {W}x{H} in {len(todo)} tiles on {max(num_workers, 1)} processes, '
+          f'{dt:.1f} s, {H * W / dt:.0f} rays/s')
+    return rgb_path, depth_path
+
+
+if __name__ == '__main__':
+    from load import load_data_from_args
+    from utils.hash_encoding import get_scene_bbox
+
+    parser = config_parser()
+    parser.add_argument("--tiled_pose", type=int, default=0,
+                        help='index into render_poses of the rendered view')
+    parser.add_argument("--tiled_scale", type=float, default=4.,
+                        help='output resolution relative to the dataset images')
+    parser.add_argument("--tile", type=int, default=256,
+                        help='tile size in pixels, bounds the memory of a worker')
+    parser.add_argument("--tiled_workers", type=int, default=os.cpu_count(),
+                        help='worker processes, 0 renders in the main process')
+    parser.add_argument("--tiled_png", action='store_true',
+                        help='also save the rgb output as a PNG (holds the image in memory once)')
+    args = parser.parse_args()
+    wandb.init(mode='disabled')
+
+    # workers are forked, the networks stay on the CPU
+    main.device = torch.device('cpu')
+    images, poses, render_poses, hwf, K, i_split, near, far, aabb = load_data_from_args(args)
+    use_aabb = args.use_aabb and aabb is not None
+    bounding_box = aabb if use_aabb else get_scene_bbox(poses[i_split[0]], hwf, K, near, far)
+    _, render_kwargs_test, start, _, _ = create_nerf(args, bounding_box)
+    if start == 0:
+        raise ValueError(f'no checkpoint found for {args.expname}, nothing to render')
+    render_kwargs_test.update({'near' : near, 'far' : far, 'aabb' : aabb if use_aabb else None})
+
+    H, W = int(hwf[0] * args.tiled_scale), int(hwf[1] * args.tiled_scale)
+    K = np.array(K, dtype=np.float32)
+    K[:2] *= args.tiled_scale
+    c2w = torch.Tensor(render_poses[args.tiled_pose])[:3,:4]
+    out_prefix = path_join(args.basedir, args.expname, f'tiled_{args.tiled_pose:03d}')
+    rgb_path, depth_path = render_tiled(H, W, K, c2w, render_kwargs_test, out_prefix, tile=args.tile,
+                                        num_workers=args.tiled_workers, chunk=args.chunk)
+    print(f'[tiled] saved {rgb_path} and {depth_path}')
+    if args.tiled_png:
+        imageio.imwrite(out_prefix + '.png', np.load(rgb_path, mmap_mode='r'))
+        print(f'[tiled] saved {out_prefix}.png')
@@ -357,3 +357,711 @@ def test_render():
     # For disp_map, tf turns `nan` into 1e+10. We only need to compare valid values.
     idxs = ret_tf[1].numpy() != 1e+10
     assert np.allclose(ret_tf[1].numpy()[idxs], ret_torch[1].detach().numpy()[idxs], atol=1e-3)
+
+
+def test_positional_encoder_matches_embedder():
+    from utils.nerf_helpers import Embedder, PositionalEncoder
+
+    multires = 10
+    x = torch.rand(64, 16, 3) * 4. - 2.
+    embedder = Embedder(include_input=True, input_dims=3, max_freq_log2=multires-1, num_freqs=multires,
+                        log_sampling=True, periodic_fns=[torch.sin, torch.cos])
+    y_ref = embedder.embed(x)
+
+    encoder = PositionalEncoder(3, multires-1, multires)
+    with torch.no_grad():
+        assert torch.equal(encoder(x), y_ref)
+        workspace = torch.empty(x.numel() * multires * 2 + x.numel())
+        assert torch.equal(encoder(x, out=workspace), y_ref)
+
+    # gradients of the autograd and analytic paths agree with the reference
+    grad_out = torch.randn(y_ref.shape)
+    x_ref = x.clone().requires_grad_()
+    (embedder.embed(x_ref) * grad_out).sum().backward()
+    for kwargs in [{}, {'analytic_grad': True}]:
+        x_enc = x.clone().requires_grad_()
+        y = PositionalEncoder(3, multires-1, multires, **kwargs)(x_enc)
+        assert torch.equal(y, y_ref)
+        (y * grad_out).sum().backward()
+        assert torch.allclose(x_enc.grad, x_ref.grad, rtol=1e-5, atol=1e-2)
+
+    # double-angle recurrence is only approximately equal
+    with torch.no_grad():
+        y_rec = PositionalEncoder(3, multires-1, multires, use_recurrence=True)(x)
+    assert torch.allclose(y_rec, y_ref, atol=1e-3)
+
+
+def test_hash_embedder():
+    from utils.hash_encoding import HashEmbedder
+
+    embedder = HashEmbedder(([-1., -1., -1.], [1., 1., 1.]), n_levels=4, n_features_per_level=2,
+                            log2_hashmap_size=10, base_resolution=4, finest_resolution=32, sparse=True)
+    # coarse levels fit in the table and are indexed densely, fine levels are hashed
+    assert embedder.embeddings[0].num_embeddings == (4+1)**3
+    assert embedder.embeddings[-1].num_embeddings == 2**10
+
+    x = torch.rand(128, 3) * 2.4 - 1.2  # some points outside the box are clamped
+    y = embedder(x)
+    assert y.shape == (128, embedder.out_dim)
+    y.sum().backward()
+    assert all(e.weight.grad.is_sparse for e in embedder.embeddings)
+
+    # a point on a grid vertex only reads that vertex
+    with torch.no_grad():
+        vertex = torch.Tensor([[-1., -1., -1.]])
+        expected = torch.cat([e.weight[0] for e in embedder.embeddings])
+        assert torch.allclose(embedder(vertex)[0], expected)
+
+
+def test_per_ray_viewdirs():
+    from utils.nerf_helpers import NeRF, NeRFSmall
+
+    pts = torch.rand(6, 5, 63)
+    views = torch.rand(6, 27)
+    per_sample = torch.cat([pts, views[:, None].expand(6, 5, 27)], -1)
+    for model in [NeRF(input_ch=63, input_ch_views=27, use_viewdirs=True),
+                  NeRFSmall(input_ch=63, input_ch_views=27, use_viewdirs=True)]:
+        with torch.no_grad():
+            assert torch.allclose(model(per_sample), model(pts, views), atol=1e-6)
+
+
+def test_occupancy_grid():
+    from utils.occupancy import OccupancyGrid
+
+    grid = OccupancyGrid(([-1., -1., -1.], [1., 1., 1.]), resolution=16)
+    pts = torch.Tensor([[0., 0., 0.], [0.9, 0.9, 0.9], [2., 0., 0.]])
+    assert grid.occupied(pts).tolist() == [True, True, True]  # starts full, outside is never skipped
+
+    # density of a ball of radius 0.5
+    grid.update(lambda x: 10. * (torch.norm(x, dim=-1) < 0.5).float())
+    assert grid.occupied(pts).tolist() == [True, False, True]
+    assert 0. < grid.occupancy() < 0.1
+
+
+def test_occupancy_skipped_samples():
+    from main import render_rays, run_network
+    from utils.nerf_helpers import get_embedder
+    from utils.occupancy import OccupancyGrid
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        # nothing but empty space
+        return torch.cat([torch.zeros_like(pts), -1e4 * torch.ones_like(pts[...,:1])], -1)
+
+    N_rays = 32
+    rays_o = torch.rand(N_rays, 3) - 0.5
+    rays_d = torch.nn.functional.normalize(torch.randn(N_rays, 3), dim=-1)
+    ray_batch = torch.cat([rays_o, rays_d, 0.1 * torch.ones(N_rays, 1), 2. * torch.ones(N_rays, 1)], -1)
+    grid = OccupancyGrid(([-3., -3., -3.], [3., 3., 3.]), resolution=32)  # holds every sample
+    grid.update(lambda x: (torch.norm(x, dim=-1) < 0.3).float())
+    kwargs = dict(network_fn=None, network_query_fn=network_query_fn, N_samples=32, perturb=0., white_bkgd=True,
+                  occupancy_grid=grid, raw_noise_std=1.)
+
+    # skipped samples stay empty under raw noise, in the dense, marched and packed paths
+    with torch.no_grad():
+        for extra in [{}, {'ert_eps' : 1e-3}, {'packed' : True}]:
+            ret = render_rays(ray_batch, **kwargs, **extra)
+            assert ret['samples_skipped'].mean() > 0.5
+            assert torch.all(ret['acc_map'] == 0.) and torch.all(ret['rgb_map'] == 1.), extra
+
+    # per-sample queries gather the view embedding of their ray
+    embed_fn, _ = get_embedder(2, 0)
+    embeddirs_fn, _ = get_embedder(2, 0)
+    def fn(x, views):
+        return x[...,:1] + views[:,None,:1] * views[:,None,-1:]
+    viewdirs = torch.nn.functional.normalize(torch.randn(5, 3), dim=-1)
+    ray_idx = torch.Tensor([0, 0, 3, 4, 4, 4]).long()
+    pts = torch.randn(6, 1, 3)
+    out = run_network(pts, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=4, ray_idx=ray_idx)
+    ref = run_network(pts, viewdirs[ray_idx], fn, embed_fn, embeddirs_fn, netchunk=4)
+    assert torch.allclose(out, ref)
+
+    # baked grids stand in for network_query_fn and take the same ray index
+    from main import query_occupied
+    from utils.baking import bake
+    ball = lambda p: 10. * (torch.norm(p, dim=-1, keepdim=True) < 0.6).float()
+    baked = bake(lambda p, v, f: torch.cat([p + v[:,None], ball(p)], -1), None,
+                 ([-1., -1., -1.], [1., 1., 1.]), resolution=8, sh_deg=1, n_dirs=8)
+    pts = 0.9 * (2. * torch.rand(5, 4, 3) - 1.)
+    raw, n_skipped = query_occupied(baked.query, pts, viewdirs, None, baked)
+    occupied = baked.occupied(pts)
+    assert 0 < n_skipped.sum() < pts.shape[0] * pts.shape[1]
+    assert torch.allclose(raw[occupied], baked.query(pts, viewdirs)[occupied])
+    assert torch.allclose(baked.query(pts[ray_idx], viewdirs, ray_idx=ray_idx), baked.query(pts[ray_idx], viewdirs[ray_idx]))
+
+
+def test_early_ray_termination():
+    import main
+    from main import render_rays
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        # opaque slab at z > 0.5 behind a thin fog, colour varies with position
+        sigma = torch.where(pts[...,2:3] > 0.5, 100. * torch.ones_like(pts[...,2:3]), 0.1 * torch.ones_like(pts[...,2:3]))
+        return torch.cat([pts, sigma], -1)
+
+    N_rays = 64
+    rays_o = torch.rand(N_rays, 3) * 0.1
+    rays_d = torch.Tensor([0., 0., 1.]).expand(N_rays, 3)
+    ray_batch = torch.cat([rays_o, rays_d, torch.zeros(N_rays, 1), torch.ones(N_rays, 1)], -1)
+    kwargs = dict(network_fn=None, network_query_fn=network_query_fn, N_samples=64, perturb=0.,
+                  N_importance=32, network_fine=None, white_bkgd=True)
+
+    with torch.no_grad():
+        ref = render_rays(ray_batch, **kwargs)
+        ert = render_rays(ray_batch, ert_eps=1e-4, ert_segment=8, **kwargs)
+    for k in ['rgb_map', 'acc_map', 'depth_map']:
+        assert torch.allclose(ref[k], ert[k], atol=1e-3), k
+    assert ert['samples_skipped'].min() > 0.2
+    assert 'samples_skipped' not in ref
+
+
+def test_packed_render_rays():
+    from main import render_rays
+    from utils.occupancy import OccupancyGrid
+    from utils.packed import pack, segment_cumsum
+
+    mask = torch.Tensor([[1, 0, 1], [0, 0, 0], [1, 1, 1]]).bool()
+    ray_indices, offsets, counts = pack(mask)
+    assert ray_indices.tolist() == [0, 0, 2, 2, 2] and counts.tolist() == [2, 0, 3]
+    assert segment_cumsum(torch.ones(5), ray_indices, offsets, exclusive=True).tolist() == [0, 1, 0, 1, 2]
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        return fn(pts)
+    network_fn = torch.nn.Linear(3, 4)
+
+    N_rays = 32
+    rays_o = torch.rand(N_rays, 3) - 0.5
+    rays_d = torch.nn.functional.normalize(torch.randn(N_rays, 3), dim=-1)
+    ray_batch = torch.cat([rays_o, rays_d, 0.1 * torch.ones(N_rays, 1), 2. * torch.ones(N_rays, 1)], -1)
+    grid = OccupancyGrid(([-3., -3., -3.], [3., 3., 3.]), resolution=32)  # holds every sample
+    grid.update(lambda x: (torch.norm(x, dim=-1) < 0.8).float())
+    kwargs = dict(network_fn=network_fn, network_query_fn=network_query_fn, N_samples=32, perturb=0.,
+                  N_importance=16, white_bkgd=True, occupancy_grid=grid, ret_raw=True)
+
+    dense = render_rays(ray_batch, **kwargs)
+    packed = render_rays(ray_batch, packed=True, **kwargs)
+    for k in ['rgb_map', 'acc_map', 'depth_map', 'rgb0', 'raw', 'samples_skipped']:
+        assert torch.allclose(dense[k], packed[k], atol=1e-5), k
+
+    grads = []
+    for ret in [dense, packed]:
+        network_fn.zero_grad()
+        ret['rgb_map'].sum().backward()
+        grads.append(network_fn.weight.grad.clone())
+    assert torch.allclose(grads[0], grads[1], atol=1e-4)
+
+    with torch.no_grad(), pytest.raises(ValueError):
+        render_rays(ray_batch, packed=True, ert_eps=1e-3, **kwargs)
+
+
+def test_bake():
+    from utils.baking import bake
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        # ball of radius 0.5, colour linear in the view direction (exact for sh_deg >= 1)
+        sigma = 10. * (torch.norm(pts, dim=-1, keepdim=True) < 0.5).float()
+        rgb = pts + viewdirs[:,None,:]
+        return torch.cat([rgb, sigma], -1)
+
+    baked = bake(network_query_fn, None, ([-1., -1., -1.], [1., 1., 1.]), resolution=16, sh_deg=1, n_dirs=16)
+    assert 0 < baked.density.shape[0] < 16**3 // 4
+
+    pts = (torch.arange(16.) + 0.5) / 8. - 1.  # voxel centres
+    pts = torch.stack(torch.meshgrid(pts, pts, pts, indexing='ij'), -1).reshape(-1, 1, 3)
+    viewdirs = torch.nn.functional.normalize(torch.randn(pts.shape[0], 3), dim=-1)
+    ref = network_query_fn(pts, viewdirs, None)
+    raw = baked.query(pts, viewdirs)
+    inside = ref[...,3] > 0
+    assert torch.equal(baked.occupied(pts), inside)
+    assert torch.allclose(raw[inside], ref[inside], atol=1e-4)
+    assert torch.all(raw[~inside][...,3] == 0)
+
+    # baked renders go through render_rays with the grid as network and occupancy grid
+    from main import render_rays
+    N_rays = 16
+    rays_o = torch.Tensor([0., 0., -2.]) + 0.3 * torch.randn(N_rays, 3)
+    rays_d = torch.nn.functional.normalize(-rays_o + 0.1 * torch.randn(N_rays, 3), dim=-1)
+    ray_batch = torch.cat([rays_o, rays_d, 0.5 * torch.ones(N_rays, 1), 4. * torch.ones(N_rays, 1), rays_d], -1)
+    with torch.no_grad():
+        for extra in [{}, {'ert_eps' : 1e-3}, {'packed' : True}]:
+            ret = render_rays(ray_batch, network_fn=None, white_bkgd=True, **baked.render_kwargs(64), **extra)
+            assert ret['rgb_map'].shape == (N_rays, 3) and torch.all(torch.isfinite(ret['rgb_map'])), extra
+            assert ret['acc_map'].max() > 0.5, extra
+
+
+def test_aabb_clipping():
+    from main import render
+    from utils.nerf_helpers import ray_aabb_intersect
+
+    aabb = ([-1., -1., -1.], [1., 1., 1.])
+    rays_o = torch.Tensor([[0., 0., -3.], [0., 3., -3.], [0., 0., 0.]])
+    rays_d = torch.Tensor([[0., 0., 2.], [0., 0., 1.], [1., 0., 0.]])
+    t_min, t_max = ray_aabb_intersect(rays_o, rays_d, aabb)
+    assert torch.allclose(t_min[[0, 2]], torch.Tensor([1., -1.])) and torch.allclose(t_max[[0, 2]], torch.Tensor([2., 1.]))
+    assert (t_max > t_min).tolist() == [True, False, True]
+
+    queried = []
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        queried.append(pts.reshape(-1, 3))
+        return torch.cat([torch.zeros_like(pts), torch.ones_like(pts[...,:1])], -1)
+
+    rgb, disp, acc, extras = render(1, 3, None, rays=(rays_o, rays_d), ndc=False, near=0., far=10., aabb=aabb,
+                                    network_fn=None, network_query_fn=network_query_fn, N_samples=8,
+                                    white_bkgd=True)
+    queried = torch.cat(queried, 0)
+    assert torch.all(torch.abs(queried) <= 1. + 1e-5)  # every sample inside the box
+    assert rgb[1].tolist() == [1., 1., 1.] and acc[1] == 0.
+    assert acc[0] > 0. and acc[2] > 0.
+
+    # no ray hits the box, every ray is background
+    queried = []
+    rgb, disp, acc, extras = render(1, 2, None, rays=(rays_o[[1, 1]], rays_d[[1, 1]]), ndc=False, near=0., far=10.,
+                                    aabb=aabb, network_fn=None, network_query_fn=network_query_fn, N_samples=8,
+                                    white_bkgd=True)
+    assert rgb.tolist() == [[1., 1., 1.]] * 2 and acc.tolist() == [0., 0.]
+
+
+def test_depth_video_writer(tmp_path):
+    import imageio
+    from utils.writers import DepthVideoWriter
+
+    path = str(tmp_path / 'depth.mp4')
+    with DepthVideoWriter(path) as writer:
+        for d in [1., 2., 4.]:
+            writer.append(d * np.ones([32, 32], dtype=np.float32))
+    assert not (tmp_path / 'depth.mp4.spool').exists()
+    frames = [f[...,0].mean() for f in imageio.get_reader(path)]
+    assert len(frames) == 3
+    assert np.allclose(frames, [255 / 4, 255 / 2, 255], atol=3)  # normalized by the max over all frames
+
+
+def test_async_writer():
+    from utils.writers import AsyncWriter
+
+    done = []
+    with AsyncWriter(num_workers=1, max_pending=2) as writer:
+        for i in range(8):
+            writer.submit(done.append, i)
+    assert done == list(range(8))  # one worker keeps the submission order
+
+    writer = AsyncWriter(num_workers=2)
+    writer.submit(lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        writer.close()
+
+
+def test_render_cache(tmp_path):
+    import os
+    from utils.parser import config_parser
+    from utils.render_cache import RenderCache, embed_settings, settings_digest
+
+    model = torch.nn.Linear(3, 4)
+    kwargs = {'network_fn' : model, 'network_query_fn' : lambda *a: None, 'N_samples' : 64, 'perturb' : 0.}
+    digest = settings_digest(kwargs)
+    assert settings_digest(dict(kwargs, N_samples=32)) != digest
+    with torch.no_grad():
+        model.bias += 1.
+    assert settings_digest(kwargs) != digest  # new weights, new key
+    args = config_parser().parse_args([])
+    settings = embed_settings(args)
+    args.multires = 4
+    assert settings_digest(kwargs, embed_settings(args)) != settings_digest(kwargs, settings)  # embedder held in a closure
+
+    frame = np.zeros([8, 8, 3], dtype=np.float32)
+    cache = RenderCache(str(tmp_path), max_bytes=2 * 1024)  # room for one entry
+    keys = [cache.key(digest, torch.eye(4)[:3] * s, 8, 8, np.eye(3), 0) for s in [1., 2.]]
+    assert cache.get(keys[0]) is None
+    cache.put(keys[0], rgb=frame)
+    assert np.array_equal(cache.get(keys[0])['rgb'], frame)
+    cache.put(keys[1], rgb=frame)  # evicts the least recently used first entry
+    assert cache.get(keys[0]) is None and cache.get(keys[1]) is not None
+    assert not os.path.exists(cache.path(keys[0]))
+    assert list(RenderCache(str(tmp_path), max_bytes=2 * 1024).sizes) == [keys[1]]  # index rebuilt from disk
+
+
+def test_render_server_coalescing():
+    import asyncio
+    from main import render
+    from render_server import RenderServer
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        return fn(pts)
+    render_kwargs = dict(network_fn=torch.nn.Linear(3, 4), network_query_fn=network_query_fn, N_samples=8)
+    K = np.array([[8., 0., 4.], [0., 8., 4.], [0., 0., 1.]])
+    poses = [torch.eye(4)[:3] + torch.Tensor([[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, s]]) for s in [2., 3.]]
+
+    async def run():
+        server = RenderServer(render_kwargs, {'ndc' : False}, chunk=48)  # batches span both requests
+        requests = [asyncio.ensure_future(server.render(8, 8, K, c2w, 0., 4.)) for c2w in poses]
+        while len(server.jobs) < len(poses):
+            await asyncio.sleep(0.01)
+        worker = asyncio.ensure_future(server.run())
+        outputs = await asyncio.gather(*requests)
+        worker.cancel()
+        return server, outputs
+
+    server, outputs = asyncio.run(run())
+    assert server.n_rays == 2 * 64 and server.n_batches == 3
+    with torch.no_grad():
+        for c2w, out in zip(poses, outputs):
+            rgb, disp, acc, extras = render(8, 8, K, c2w=c2w, ndc=False, near=0., far=4., **render_kwargs)
+            assert np.allclose(out['rgb_map'], rgb.numpy(), atol=1e-6)
+            assert np.allclose(out['depth_map'], extras['depth_map'].numpy(), atol=1e-5)
+
+
+def test_render_batch():
+    from main import render, render_batch
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        return fn(pts)
+    kwargs = dict(network_fn=torch.nn.Linear(3, 4), network_query_fn=network_query_fn, N_samples=8,
+                  ndc=False, near=0., far=4., white_bkgd=True, aabb=([-1., -1., -1.], [1., 1., 1.]))
+    K = np.array([[8., 0., 4.], [0., 8., 4.], [0., 0., 1.]])
+    c2ws = [torch.eye(4)[:3] + torch.Tensor([[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, s]]) for s in [2., 3., 5.]]
+
+    with torch.no_grad():
+        rets = render_batch(6, 8, K, c2ws, chunk=100, **kwargs)
+        for c2w, ret in zip(c2ws, rets):
+            ref = render(6, 8, K, chunk=100, c2w=c2w, **kwargs)
+            for x, y in zip(ref[:3], ret[:3]):
+                assert x.shape == y.shape and torch.allclose(x, y, atol=1e-6, equal_nan=True)
+            assert torch.allclose(ref[3]['depth_map'], ret[3]['depth_map'], atol=1e-5)
+
+
+def test_density_mesh(tmp_path):
+    from utils.nerf_helpers import NeRF
+    from utils.mesh import density_grid, extract_mesh, write_mesh
+    from utils.occupancy import OccupancyGrid
+    pytest.importorskip('skimage')
+
+    model = NeRF(D=4, W=32, input_ch=6, input_ch_views=3, skips=[2], use_viewdirs=True)
+    x = torch.randn(10, 9)
+    assert torch.allclose(model.density(x[:,:6]), model(x)[:,3:], atol=1e-6)
+    model = NeRF(D=4, W=32, input_ch=6, output_ch=5, input_ch_views=0, skips=[2], use_viewdirs=False)
+    assert model.density(x[:,:6]).shape == (10, 1)
+    assert torch.allclose(model.density(x[:,:6]), model(x[:,:6])[:,3:4], atol=1e-6)
+
+    # sphere of radius 0.5, density falls off linearly through the surface
+    grid = density_grid(lambda pts: 0.5 - torch.norm(pts, dim=-1), ([-1., -1., -1.], [1., 1., 1.]),
+                        resolution=32, chunk=1000)
+    verts, faces = extract_mesh(grid, ([-1., -1., -1.], [1., 1., 1.]), 0.)
+    assert np.allclose(np.linalg.norm(verts, axis=-1), 0.5, atol=1e-2)
+    write_mesh(str(tmp_path / 'sphere.ply'), verts, faces)
+    assert (tmp_path / 'sphere.ply').stat().st_size > 0
+
+    # a full occupancy grid over the same box masks nothing, including the slices on box_max
+    occupancy = OccupancyGrid(([-1., -1., -1.], [1., 1., 1.]), resolution=8)
+    sparse = density_grid(lambda pts: 0.5 - torch.norm(pts, dim=-1), ([-1., -1., -1.], [1., 1., 1.]),
+                          resolution=32, chunk=1000, mask_fn=occupancy.occupied)
+    assert np.array_equal(sparse, grid)
+
+
+def test_render_reuse():
+    from main import render, render_reuse
+    from utils.reprojection import reproject
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        # opaque ball of radius 0.5, colour varies with position
+        sigma = 100. * (torch.norm(pts, dim=-1, keepdim=True) < 0.5).float()
+        return torch.cat([3. * pts, sigma], -1)
+    kwargs = dict(network_fn=None, network_query_fn=network_query_fn, N_samples=64, N_importance=64,
+                  ndc=False, near=1., far=5., white_bkgd=True)
+    K = np.array([[16., 0., 8.], [0., 16., 8.], [0., 0., 1.]])
+
+    def orbit(theta):
+        c, s = np.cos(theta), np.sin(theta)
+        return torch.Tensor([[c, 0, s, 3 * s], [0, 1, 0, 0], [-s, 0, c, 3 * c]])
+
+    # a semi-transparent surface at ray parameter 2 is reprojected there, not at depth_map
+    acc = torch.full([16, 16], 0.6)
+    surface_depth, background = reproject(2. * acc, acc, orbit(0.), orbit(0.), 16, 16, K, far=5.)
+    assert torch.allclose(surface_depth, torch.full([256], 2.), atol=1e-5) and not torch.any(background)
+
+    with torch.no_grad():
+        rgb0, _, acc0, extras0 = render(16, 16, K, chunk=100, c2w=orbit(0.), **kwargs)
+        rgb, _, acc, extras = render_reuse(16, 16, K, orbit(0.05), (orbit(0.), extras0['depth_map'], acc0),
+                                           chunk=100, reuse_samples=16, **kwargs)
+        ref, _, ref_acc, _ = render(16, 16, K, chunk=100, c2w=orbit(0.05), **kwargs)
+    passes = extras['reuse_passes']
+    assert torch.any(passes == 1) and torch.any(passes == 2)
+    assert extras['reuse_samples'] < 64 + 64
+    assert torch.allclose(acc, ref_acc, atol=0.05)
+    assert torch.mean((rgb - ref)**2) < 1e-3
+
+
+def test_render_progressive():
+    from main import render, render_progressive
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        sigma = 100. * (torch.norm(pts, dim=-1, keepdim=True) < 0.5).float()
+        return torch.cat([3. * pts, sigma], -1)
+    kwargs = dict(network_fn=None, network_query_fn=network_query_fn, N_samples=64,
+                  ndc=False, near=1., far=5., white_bkgd=True)
+    K = np.array([[16., 0., 8.], [0., 16., 8.], [0., 0., 1.]])
+    c2w = torch.Tensor([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 3]])
+
+    with torch.no_grad():
+        ref, _, _, ref_extras = render(17, 15, K, chunk=50, c2w=c2w, **kwargs)
+        rgb, _, _, extras = render_progressive(17, 15, K, c2w, chunk=50, step=4, **kwargs)
+        assert torch.allclose(rgb, ref, atol=1e-6) and torch.allclose(extras['depth_map'], ref_extras['depth_map'], atol=1e-5)
+        assert extras['rendered'].all()
+
+        rgb, _, _, extras = render_progressive(17, 15, K, c2w, chunk=20, step=4, ray_budget=120, **kwargs)
+    assert extras['n_rays'] == 120 and extras['rendered'][::4, ::4].all()
+    # refinement goes to the silhouette, not the flat background
+    assert extras['rendered'][8, 4:11].all() and not extras['rendered'][:2, :].all()
+    assert torch.mean((rgb - ref)**2) < torch.mean((render_progressive(17, 15, K, c2w, chunk=20, step=4, ray_budget=0,
+                                                                       **kwargs)[0] - ref)**2)
+
+
+def test_render_tiled(tmp_path):
+    from main import render
+    from render_tiled import render_tiled, tile_rays, tiles
+    from utils.nerf_helpers import get_rays, to8b
+
+    K = np.array([[16., 0., 8.], [0., 16., 7.], [0., 0., 1.]])
+    c2w = torch.Tensor([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 3]])
+    rays_o, rays_d = get_rays(13, 17, K, c2w)
+    assert sum(h * w for _, _, h, w in tiles(13, 17, 5)) == 13 * 17
+    for y0, x0, h, w in tiles(13, 17, 5):
+        assert torch.allclose(tile_rays(K, c2w, y0, x0, h, w)[1], rays_d[y0:y0+h, x0:x0+w])
+
+    def network_query_fn(pts, viewdirs, fn, **kwargs):
+        sigma = 100. * (torch.norm(pts, dim=-1, keepdim=True) < 0.5).float()
+        return torch.cat([3. * pts, sigma], -1)
+    kwargs = dict(network_fn=None, network_query_fn=network_query_fn, N_samples=32,
+                  ndc=False, near=1., far=5., white_bkgd=True)
+    with torch.no_grad():
+        ref, _, _, extras = render(13, 17, K, chunk=64, c2w=c2w, **kwargs)
+    for num_workers in [0, 2]:
+        rgb_path, depth_path = render_tiled(13, 17, K, c2w, kwargs, str(tmp_path / f'w{num_workers}'),
+                                            tile=5, num_workers=num_workers, chunk=16)
+        assert np.array_equal(np.load(rgb_path), to8b(ref.numpy()))
+        assert np.allclose(np.load(depth_path), extras['depth_map'].numpy(), atol=1e-5)
+
+
+def test_ray_cache(tmp_path):
+    from utils.nerf_helpers import get_rays_np
+    from utils.samplers import CachedRaySampler, build_ray_cache
+
+    H, W = 6, 5
+    K = np.array([[4., 0., 2.5], [0., 4., 3.], [0., 0., 1.]])
+    images = np.random.rand(4, H, W, 3).astype(np.float32)
+    poses = np.random.rand(4, 4, 4).astype(np.float32)
+    i_train = [0, 2, 3]
+
+    path = build_ray_cache(str(tmp_path), images, poses, K, H, W, i_train)
+    assert build_ray_cache(str(tmp_path), images, poses, K, H, W, i_train) == path
+    assert build_ray_cache(str(tmp_path), images, poses, K, H, W, [0, 2]) != path
+    # same rays as the in-memory pipeline before shuffling
+    rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0)
+    rays_rgb = np.transpose(np.concatenate([rays, images[:,None]], 1), [0,2,3,1,4])[i_train].reshape(-1, 3, 3)
+    assert np.allclose(np.load(path), rays_rgb)
+
+    sampler = CachedRaySampler(path, 10, torch.device('cpu'))
+    seen = []
+    for i in range(len(rays_rgb) // 10):
+        batch_rays, target_s = sampler.sample(i)
+        assert batch_rays.shape == (2, 10, 3) and target_s.shape == (10, 3)
+        seen.append(torch.cat([batch_rays[0], batch_rays[1], target_s], -1).numpy())
+    # one epoch visits every ray once
+    seen = np.concatenate(seen, 0)
+    assert np.allclose(np.sort(seen, 0), np.sort(rays_rgb.reshape(-1, 9), 0))
+
+
+def test_pixel_ray_sampler():
+    from load.image_store import ImageStore
+    from utils.nerf_helpers import get_rays
+    from utils.samplers import PixelRaySampler
+
+    H, W = 6, 5
+    K = np.array([[4., 0., 2.5], [0., 4., 3.], [0., 0., 1.]])
+    store = ImageStore(np.random.randint(0, 256, [3, H, W, 3], dtype=np.uint8),
+                       np.random.randint(0, 256, [3, H, W], dtype=np.uint8), white_bkgd=True)
+    images = store[:]
+    poses = np.random.rand(3, 4, 4).astype(np.float32)
+    sampler = PixelRaySampler(store, poses, K, [0, 2], 64, torch.device('cpu'))
+    batch_rays, target_s = sampler.sample(0)
+    assert batch_rays.shape == (2, 64, 3) and target_s.shape == (64, 3)
+
+    # every drawn ray is the ray of a training pixel with that pixel's colour
+    rays = {}
+    for i in [0, 2]:
+        rays_o, rays_d = get_rays(H, W, K, torch.Tensor(poses[i,:3,:4]))
+        rays[i] = (torch.cat([rays_o, rays_d], -1).reshape(-1, 6), torch.Tensor(images[i]).reshape(-1, 3))
+    for ray, target in zip(torch.cat([batch_rays[0], batch_rays[1]], -1), target_s):
+        match = [torch.nonzero(torch.all(torch.isclose(r, ray, atol=1e-5), -1))[:,0] for r, _ in rays.values()]
+        assert any(torch.allclose(c[m[0]], target, atol=1e-6) for m, (_, c) in zip(match, rays.values()) if len(m))
+
+
+def test_image_store():
+    from load.image_store import ImageStore
+
+    rgb = np.random.randint(0, 256, [4, 6, 5, 3], dtype=np.uint8)
+    alpha = np.random.randint(0, 256, [4, 6, 5], dtype=np.uint8)
+    # the float composite load_data_from_args used to build
+    rgba = np.concatenate([rgb, alpha[...,None]], -1) / 255.
+    ref = (rgba[...,:3] * rgba[...,-1:] + (1. - rgba[...,-1:])).astype(np.float32)
+
+    images = ImageStore(rgb, alpha, white_bkgd=True)
+    assert images.shape == (4, 6, 5, 3) and len(images) == 4
+    assert images[2].dtype == np.float32 and np.allclose(images[2], ref[2])
+    assert np.allclose(images[[0, 3]], ref[[0, 3]]) and np.allclose(images[1:3], ref[1:3])
+    assert np.allclose(images[:,None], ref[:,None]) and np.allclose(images[2][...,:2], ref[2][...,:2])
+    rows, cols = np.array([0, 5, 3]), np.array([4, 0, 2])
+    assert np.allclose(images[1, rows, cols], ref[1, rows, cols])
+    assert np.allclose(images.pixels(1, rows, cols).numpy(), ref[1, rows, cols])
+    assert np.allclose(ImageStore(rgb)[3], rgb[3] / 255.)
+
+
+def test_feistel_permutation():
+    from utils.samplers import FeistelPermutation, RayBatchSampler
+
+    for n in [1, 2, 7, 1000, 4097]:
+        perm = FeistelPermutation(n)
+        idx = perm(torch.arange(n))
+        assert torch.equal(torch.sort(idx)[0], torch.arange(n))
+        perm.reseed()
+        assert n < 7 or not torch.equal(perm(torch.arange(n)), idx)
+
+    # every element lands in every position about equally often, as with randperm
+    n, trials = 8, 4000
+    counts = torch.zeros(n, n)
+    perm = FeistelPermutation(n)
+    for _ in range(trials):
+        perm.reseed()
+        counts[torch.arange(n), perm(torch.arange(n))] += 1
+    assert torch.all((counts - trials / n).abs() < 5 * (trials / n)**0.5)
+
+    rays_rgb = torch.arange(50 * 9.).reshape(50, 3, 3)
+    sampler = RayBatchSampler(rays_rgb, 8)
+    seen = torch.cat([sampler.sample(i)[1][:,0] for i in range(7)])
+    assert torch.equal(torch.sort(seen)[0], rays_rgb[:,2,0])
+    assert sampler.i_batch == 0 and torch.equal(sampler.rays_rgb, rays_rgb)
+
+
+def test_prefetcher():
+    import time
+    from load.image_store import ImageStore
+    from utils.samplers import ImageRaySampler, PixelRaySampler, Prefetcher
+
+    H, W, N_rand = 12, 10, 16
+    K = np.array([[8., 0, W/2], [0, 8., H/2], [0, 0, 1]])
+    rgb = np.random.randint(0, 256, (3, H, W, 3), dtype=np.uint8)
+    poses = torch.Tensor(np.stack([np.eye(4)[:3] + 0.1 * i for i in range(3)], 0))
+
+    def batches(sampler, steps):
+        out = []
+        for i in steps:
+            out.append(sampler.sample(i))
+            # the training loop draws from the global generators meanwhile
+            np.random.rand(3), torch.rand(3)
+        if isinstance(sampler, Prefetcher):
+            sampler.close()
+        return out
+
+    steps = range(1, 21)
+    for make in [lambda: ImageRaySampler(ImageStore(rgb), poses, K, [0, 2], N_rand, H, W, precrop_iters=5, start=1,
+                                         seed=3),
+                 lambda: PixelRaySampler(ImageStore(rgb), poses.numpy(), K, [0, 2], N_rand, 'cpu', seed=3)]:
+        inline = batches(make(), steps)
+        prefetched = batches(Prefetcher(make(), 1, 21, depth=3), steps)
+        # the same batches in the same order, the sampler only runs on another thread
+        for (rays0, target0), (rays1, target1) in zip(inline, prefetched):
+            assert rays0.shape == (2, N_rand, 3) and target0.shape == (N_rand, 3)
+            assert torch.equal(rays0, rays1) and torch.equal(target0, target1)
+
+    class Slow:
+        def sample(self, i):
+            time.sleep(0.01)
+            return i
+
+    prefetcher = Prefetcher(Slow(), 0, 5)
+    assert [prefetcher.sample(i) for i in range(5)] == list(range(5))
+    waits, wait_time = prefetcher.stats()
+    assert 0 < waits <= 1 and wait_time > 0
+    prefetcher.close()
+
+    class Broken:
+        def sample(self, i):
+            raise RuntimeError('broken sampler')
+
+    with pytest.raises(RuntimeError):
+        Prefetcher(Broken(), 0, 5).sample(0)
+
+
+def test_image_ray_sampler():
+    from load.image_store import ImageStore
+    from utils.nerf_helpers import get_rays
+    from utils.samplers import ImageRaySampler
+
+    H, W, N_rand = 40, 30, 64
+    K = np.array([[25., 0, W/2], [0, 25., H/2], [0, 0, 1]])
+    # every pixel's colour is its (image, row, column)
+    rgb = np.stack(np.meshgrid(np.arange(3), np.arange(H), np.arange(W), indexing='ij'), -1).astype(np.uint8)
+    images = ImageStore(rgb)
+    poses = torch.Tensor(np.stack([np.eye(4)[:3] + 0.1 * i for i in range(3)], 0))
+    sampler = ImageRaySampler(images, poses, K, [0, 2], N_rand, H, W, precrop_iters=10, precrop_frac=.5)
+
+    for i in [0, 20]:
+        batch_rays, target_s = sampler.sample(i)
+        assert batch_rays.shape == (2, N_rand, 3) and target_s.shape == (N_rand, 3)
+        # the targets give back the image and pixels, rays match the full-image get_rays
+        img, rows, cols = np.round(target_s.numpy() * 255).astype(int).T
+        assert len(set(img)) == 1 and img[0] in [0, 2]
+        assert len(set(zip(rows, cols))) == N_rand
+        if i < 10:
+            assert rows.min() >= 10 and rows.max() < 30 and cols.min() >= 8 and cols.max() < 22
+        rays_o, rays_d = get_rays(H, W, K, poses[img[0]])
+        assert torch.allclose(batch_rays[0], rays_o[rows, cols]) and torch.allclose(batch_rays[1], rays_d[rows, cols], atol=1e-6)
+
+    # a window barely larger than N_rand still gives distinct pixels
+    sampler.N_rand = 390
+    assert len(np.unique(sampler.draw(400))) == 390
+    with pytest.raises(ValueError):
+        sampler.draw(300)
+
+
+def test_error_map_sampler():
+    from load.image_store import ImageStore
+    from utils.nerf_helpers import get_rays
+    from utils.samplers import ErrorMapSampler
+
+    H, W, N_rand = 21, 17, 4096
+    K = np.array([[15., 0, W/2], [0, 15., H/2], [0, 0, 1]])
+    # every pixel's colour is its (image, row, column)
+    rgb = np.stack(np.meshgrid(np.arange(3), np.arange(H), np.arange(W), indexing='ij'), -1).astype(np.uint8)
+    poses = np.stack([np.eye(4) + 0.1 * i for i in range(3)], 0)
+    sampler = ErrorMapSampler(ImageStore(rgb), poses, K, [0, 2], N_rand, 'cpu', res=4, uniform=.2)
+    assert sampler.error.shape == (2, 4, 4) and sampler.cell_pixels.sum() == H * W
+
+    # all the error in one cell of the second image
+    sampler.error.fill_(1e-3)
+    sampler.error[1, 2, 3] = 1.
+    batch_rays, target_s = sampler.sample(0)
+    img, rows, cols = np.round(target_s.numpy() * 255).astype(int).T
+    assert set(img) <= {0, 2}
+    in_cell = (img == 2) & (rows >= 11) & (rows < 16) & (cols >= 13)
+    assert in_cell.mean() > 0.7
+    rays_o, rays_d = get_rays(H, W, K, torch.Tensor(poses[2,:3,:4]))
+    assert torch.allclose(batch_rays[1][in_cell], rays_d[rows[in_cell], cols[in_cell]], atol=1e-6)
+
+    # the weighted mean of any per-pixel quantity estimates its uniform mean
+    weights = sampler.weights(0)
+    value = torch.Tensor(rows * 1.5 + cols + img)
+    uniform_mean = np.mean(np.arange(H)) * 1.5 + np.mean(np.arange(W)) + 1
+    assert abs(torch.mean(weights * value).item() - uniform_mean) < 0.1 * uniform_mean
+
+    # losses of the drawn rays move their cells towards them
+    sampler.update(0, torch.full([N_rand], 0.5))
+    assert 0 not in sampler.pending and sampler.weights(0) is None
+    assert torch.allclose(sampler.error[1, 2, 3], torch.tensor(0.75))
+
+    class Warmup:
+        def sample(self, i):
+            return 'warmup'
+
+    sampler = ErrorMapSampler(ImageStore(rgb), poses, K, [0, 1, 2], 64, 'cpu', res=4, per_image=True,
+                              warmup=Warmup(), warmup_iters=5)
+    assert sampler.sample(4) == 'warmup' and sampler.weights(4) is None
+    _, target_s = sampler.sample(5)
+    assert len(set(np.round(target_s[:,0].numpy() * 255))) == 1
@@ -0,0 +1,180 @@
+###############################################################################
+# Baking a trained NeRF into a sparse voxel grid of density + SH colour
+###############################################################################
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.functional import relu as relu_func
+
+# real spherical harmonics constants up to degree 2
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792, -1.0925484305920792, 0.31539156525252005, -1.0925484305920792, 0.5462742152960396]
+
+
+def sh_basis(dirs, sh_deg):
+    """
+    Real spherical harmonics of unit directions [..., 3] -> [..., (sh_deg+1)**2].
+    """
+    if sh_deg > 2:
+        raise ValueError(f'sh_deg must be <= 2, got {sh_deg}')
+    basis = [SH_C0 * torch.ones_like(dirs[...,0])]
+    if sh_deg >= 1:
+        x, y, z = dirs[...,0], dirs[...,1], dirs[...,2]
+        basis += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if sh_deg >= 2:
+        basis += [SH_C2[0] * x * y, SH_C2[1] * y * z, SH_C2[2] * (2. * z * z - x * x - y * y),
+                  SH_C2[3] * x * z, SH_C2[4] * (x * x - y * y)]
+    return torch.stack(basis, -1)
+
+
+def fibonacci_directions(n):
+    """
+    n roughly uniform unit directions on the sphere, [n, 3].
+    """
+    i = torch.arange(n, dtype=torch.float32) + 0.5
+    phi = torch.acos(1. - 2. * i / n)
+    theta = np.pi * (1. + 5.**0.5) * i
+    return torch.stack([torch.cos(theta) * torch.sin(phi), torch.sin(theta) * torch.sin(phi), torch.cos(phi)], -1)
+
+
+class BakedGrid(nn.Module):
+    """
+    Sparse voxel grid: a dense index volume pointing into per-voxel density and
+    SH coefficients of the pre-sigmoid colour. Looked up at the nearest voxel.
+    Args:
+        bounding_box: (min_corner, max_corner) of the grid.
+        index: long tensor [R, R, R]. Row into density / sh, -1 for empty voxels.
+        density: [K]. Density after relu.
+        sh: [K, 3, (sh_deg+1)**2]. SH coefficients per colour channel.
+    """
+    def __init__(self, bounding_box, index, density, sh):
+        super(BakedGrid, self).__init__()
+        self.resolution = index.shape[0]
+        self.sh_deg = int(round(sh.shape[-1]**0.5)) - 1
+        self.register_buffer('box_min', torch.Tensor(bounding_box[0]))
+        self.register_buffer('box_max', torch.Tensor(bounding_box[1]))
+        self.register_buffer('index', index.reshape(-1))
+        self.register_buffer('density', density)
+        self.register_buffer('sh', sh)
+
+    def voxel(self, pts):
+        """
+        Row of every point [..., 3] into density / sh, -1 for empty voxels and points outside the grid.
+        """
+        x = (pts - self.box_min) / (self.box_max - self.box_min)
+        inside = torch.all((x >= 0.) & (x < 1.), -1)
+        ijk = torch.clamp((x * self.resolution).long(), 0, self.resolution-1)
+        R = self.resolution
+        row = self.index[ijk[...,0] + R * (ijk[...,1] + R * ijk[...,2])]
+        return torch.where(inside, row, -torch.ones_like(row))
+
+    def occupied(self, pts):
+        """
+        Boolean mask [...] of pts [..., 3] in non-empty voxels, so the grid can act as render_rays' occupancy_grid.
+        """
+        return self.voxel(pts) >= 0
+
+    def query(self, pts, viewdirs=None, fn=None, ray_idx=None):
+        """
+        Drop-in replacement for network_query_fn: raw [..., 4] at pts [N_rays, N_samples, 3]
+        for view directions [N_rays, 3]. With ray_idx [N], pts [N, S, 3] belong to rays
+        ray_idx of viewdirs, as in run_network. 'fn' is ignored.
+        """
+        if viewdirs is not None and ray_idx is not None:
+            viewdirs = viewdirs[ray_idx]
+        row = self.voxel(pts)
+        valid = row >= 0
+        row = torch.clamp(row, min=0)
+        sh = self.sh[row]  # [..., 3, C]
+        if viewdirs is None or self.sh_deg == 0:
+            rgb = sh[...,0] * SH_C0
+        else:
+            dirs = viewdirs / torch.norm(viewdirs, dim=-1, keepdim=True)
+            basis = sh_basis(dirs, self.sh_deg)[...,None,None,:]  # [N_rays, 1, 1, C]
+            rgb = torch.sum(sh * basis, -1)
+        sigma = torch.where(valid, self.density[row], torch.zeros_like(row, dtype=self.density.dtype))
+        return torch.cat([rgb, sigma[...,None]], -1)
+
+    def render_kwargs(self, N_samples):
+        """
+        render_rays overrides that render from the grid instead of the networks.
+        """
+        return {
+            'network_query_fn' : self.query,
+            'occupancy_grid' : self,
+            'N_samples' : N_samples,
+            'N_importance' : 0,
+            'network_fine' : None,
+        }
+
+    def save(self, path):
+        torch.save({
+            'bounding_box' : [self.box_min.tolist(), self.box_max.tolist()],
+            'index' : self.index.reshape([self.resolution]*3).int().cpu(),
+            'density' : self.density.half().cpu(),
+            'sh' : self.sh.half().cpu(),
+        }, path)
+
+
+def load_baked(path, device=None):
+    """
+    Loads a BakedGrid written by BakedGrid.save.
+    """
+    ckpt = torch.load(path, map_location=device)
+    return BakedGrid(ckpt['bounding_box'], ckpt['index'].long(), ckpt['density'].float(), ckpt['sh'].float()).to(device)
+
+
+@torch.no_grad()
+def bake(network_query_fn, network_fn, bounding_box, resolution=128, sh_deg=2, n_dirs=32,
+         threshold=1., use_viewdirs=True, chunk=1024*32):
+    """
+    Samples a trained network into a BakedGrid.
+    Density is evaluated at every voxel centre (through network_fn.density if the network
+    has a density-only path), and voxels below 'threshold' are dropped.
+    Colour is fitted per kept voxel by least squares over 'n_dirs' view directions.
+    Args:
+        network_query_fn, network_fn: as in render_kwargs (pass the fine network).
+        bounding_box: (min_corner, max_corner) to bake.
+        chunk: int. Voxels evaluated at once.
+    """
+    box_min, box_max = torch.Tensor(bounding_box[0]), torch.Tensor(bounding_box[1])
+    R = resolution
+    if not use_viewdirs:
+        sh_deg = 0
+    dirs = fibonacci_directions(n_dirs) if use_viewdirs else torch.zeros(1, 3)
+    # least squares fit of SH coefficients: coeffs = pinv(basis) @ values
+    fit = torch.linalg.pinv(sh_basis(dirs, sh_deg) if use_viewdirs else torch.full((1, 1), SH_C0))  # [C, D]
+
+    index = -torch.ones(R**3, dtype=torch.long)
+    density, sh = [], []
+    K = 0
+    for i in range(0, R**3, chunk):
+        idx = torch.arange(i, min(i+chunk, R**3))
+        ijk = torch.stack([idx % R, (idx // R) % R, idx // (R*R)], -1)
+        pts = box_min + (ijk + 0.5) / R * (box_max - box_min)  # voxel centres, [n, 3]
+
+        if hasattr(network_fn, 'density'):
+            sigma = relu_func(network_query_fn(pts, None, network_fn.density)[:,0])
+        else:
+            viewdirs = torch.zeros_like(pts) if use_viewdirs else None  # density ignores the view
+            sigma = relu_func(network_query_fn(pts[:,None], viewdirs, network_fn)[:,0,3])
+        keep = sigma > threshold
+        if not torch.any(keep):
+            continue
+        pts, n = pts[keep], int(keep.sum())
+
+        # every (voxel, direction) pair is a one-sample ray
+        query_pts = pts[:,None].expand(n, dirs.shape[0], 3).reshape(-1, 1, 3)
+        query_dirs = dirs.expand(n, -1, -1).reshape(-1, 3) if use_viewdirs else None
+        rgb = network_query_fn(query_pts, query_dirs, network_fn)[:,0,:3].reshape(n, -1, 3)  # [n, D, 3]
+        sh.append(torch.einsum('cd,ndk->nkc', fit, rgb))
+
+        index[idx[keep]] = torch.arange(K, K+n)
+        density.append(sigma[keep])
+        K += n
+
+    if K == 0:
+        raise ValueError(f'no voxel has density above threshold={threshold}')
+    return BakedGrid(bounding_box, index.reshape(R, R, R), torch.cat(density), torch.cat(sh))
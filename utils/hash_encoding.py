@@ -0,0 +1,130 @@
+###############################################################################
+# Multiresolution hash encoding, inspired by Instant-NGP (Muller et al. 2022)
+###############################################################################
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# xor-hash primes from the Instant-NGP paper, first one is 1 for cache coherence
+PRIMES = [1, 2654435761, 805459861]
+
+# corner offsets of a voxel, [8, 3]
+BOX_OFFSETS = [[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+
+
+def get_scene_bbox(poses, hwf, K, near, far):
+    """
+    Axis aligned box around every training frustum between near and far.
+    Args:
+        poses: array of shape [N, 3+, 4]. Camera-to-world matrices.
+        hwf: [H, W, focal].
+        K: array of shape [3, 3]. Intrinsics.
+    Returns:
+        (min_corner, max_corner): two lists of 3 floats.
+    """
+    H, W, _ = hwf
+    corners = np.array([[0, 0], [W-1, 0], [0, H-1], [W-1, H-1]], dtype=np.float32)
+    dirs = np.stack([(corners[:,0]-K[0][2])/K[0][0], -(corners[:,1]-K[1][2])/K[1][1], -np.ones(4)], -1)
+    pts = []
+    for c2w in np.asarray(poses, dtype=np.float32):
+        rays_d = dirs @ c2w[:3,:3].T
+        rays_d = rays_d / np.linalg.norm(rays_d, axis=-1, keepdims=True)
+        for t in (near, far):
+            pts.append(c2w[:3,-1] + t * rays_d)
+    pts = np.concatenate(pts, 0)
+    return pts.min(0).tolist(), pts.max(0).tolist()
+
+
+class HashEmbedder(nn.Module):
+    """
+    Multiresolution hash grid: n_levels trainable feature tables, trilinearly interpolated.
+    Levels whose dense grid fits in the table are indexed directly instead of hashed.
+    Args:
+        bounding_box: (min_corner, max_corner). Points outside are clamped onto the box.
+        n_levels: int. Number of grid resolutions.
+        n_features_per_level: int. Feature width F of every table entry.
+        log2_hashmap_size: int. log2 of the table size T per level.
+        base_resolution: int. Coarsest grid resolution.
+        finest_resolution: int. Finest grid resolution.
+        sparse: bool. Produce sparse gradients for the tables (see HybridAdam).
+    """
+    def __init__(self, bounding_box, n_levels=16, n_features_per_level=2, log2_hashmap_size=19,
+                 base_resolution=16, finest_resolution=512, sparse=False):
+        super(HashEmbedder, self).__init__()
+        self.n_levels = n_levels
+        self.n_features_per_level = n_features_per_level
+        self.log2_hashmap_size = log2_hashmap_size
+        self.out_dim = n_levels * n_features_per_level
+
+        self.register_buffer('box_min', torch.Tensor(bounding_box[0]))
+        self.register_buffer('box_max', torch.Tensor(bounding_box[1]))
+        self.register_buffer('box_offsets', torch.tensor(BOX_OFFSETS, dtype=torch.long))
+        self.register_buffer('primes', torch.tensor(PRIMES, dtype=torch.long))
+
+        b = np.exp((np.log(finest_resolution) - np.log(base_resolution)) / max(n_levels-1, 1))
+        self.resolutions = [int(np.floor(base_resolution * b**i)) for i in range(n_levels)]
+
+        table_size = 2**log2_hashmap_size
+        self.embeddings = nn.ModuleList([
+            nn.Embedding(min(table_size, (res+1)**3), n_features_per_level, sparse=sparse)
+            for res in self.resolutions])
+        for embedding in self.embeddings:
+            nn.init.uniform_(embedding.weight, a=-1e-4, b=1e-4)
+
+    def grid_index(self, corners, level):
+        """
+        Table index of integer grid corners [..., 3] at 'level'.
+        """
+        res = self.resolutions[level]
+        if (res+1)**3 <= self.embeddings[level].num_embeddings:
+            return corners[...,0] + (res+1) * (corners[...,1] + (res+1) * corners[...,2])
+        h = corners * self.primes
+        h = h[...,0] ^ h[...,1] ^ h[...,2]
+        return h & ((1 << self.log2_hashmap_size) - 1)
+
+    def forward(self, x):
+        x = (x - self.box_min) / (self.box_max - self.box_min)
+        x = torch.clamp(x, 0., 1.)
+
+        embedded = []
+        for level, res in enumerate(self.resolutions):
+            pos = x * res
+            pos0 = torch.clamp(torch.floor(pos), max=res-1)
+            w = pos - pos0  # [..., 3] trilinear weights towards the upper corner
+            corners = pos0.long()[...,None,:] + self.box_offsets  # [..., 8, 3]
+            feats = self.embeddings[level](self.grid_index(corners, level))  # [..., 8, F]
+
+            w_corner = torch.where(self.box_offsets.bool(), w[...,None,:], 1. - w[...,None,:])
+            w_corner = torch.prod(w_corner, -1)  # [..., 8]
+            embedded.append(torch.sum(w_corner[...,None] * feats, -2))
+        return torch.cat(embedded, -1)
+
+
+class HybridAdam:
+    """
+    Adam for dense parameters plus SparseAdam for sparse-gradient hash tables,
+    behind the single-optimizer interface used by train (step, zero_grad, param_groups, state dicts).
+    """
+    def __init__(self, dense_params, sparse_params, lr, betas=(0.9, 0.999), eps=1e-8):
+        self.dense = torch.optim.Adam(params=dense_params, lr=lr, betas=betas, eps=eps)
+        self.sparse = torch.optim.SparseAdam(params=sparse_params, lr=lr, betas=betas, eps=eps)
+
+    @property
+    def param_groups(self):
+        return self.dense.param_groups + self.sparse.param_groups
+
+    def zero_grad(self, set_to_none=True):
+        self.dense.zero_grad(set_to_none=set_to_none)
+        self.sparse.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        self.dense.step()
+        self.sparse.step()
+
+    def state_dict(self):
+        return {'dense': self.dense.state_dict(), 'sparse': self.sparse.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        self.dense.load_state_dict(state_dict['dense'])
+        self.sparse.load_state_dict(state_dict['sparse'])
@@ -0,0 +1,88 @@
+###############################################################################
+# Density grids and mesh export
+###############################################################################
+
+import numpy as np
+import torch
+
+
+@torch.no_grad()
+def density_grid(density_fn, bounding_box, resolution=256, chunk=1024*64, mask_fn=None):
+    """
+    Evaluates density_fn on a resolution^3 lattice spanning bounding_box (corners included),
+    one slab of z-slices at a time so memory stays bounded by 'chunk' points.
+    Args:
+        density_fn: function mapping pts [N, 3] to density [N].
+        mask_fn: function mapping pts [N, 3] to a bool mask [N], e.g. OccupancyGrid.occupied.
+            Points outside the mask get density 0 without being queried (sparse evaluation).
+    Returns:
+        float32 array [R, R, R], indexed [x, y, z].
+    """
+    R = resolution
+    box_min, box_max = torch.Tensor(bounding_box[0]), torch.Tensor(bounding_box[1])
+    axes = [torch.linspace(box_min[d], box_max[d], R) for d in range(3)]
+    xy = torch.stack(torch.meshgrid(axes[0], axes[1], indexing='ij'), -1).reshape(-1, 2)  # [R*R, 2]
+    grid = np.zeros([R, R, R], dtype=np.float32)
+    slab = max(1, chunk // (R * R))
+    for k in range(0, R, slab):
+        z = axes[2][k:k+slab]
+        pts = torch.cat([xy[None].expand(len(z), -1, -1), z[:,None,None].expand(-1, R*R, 1)], -1).reshape(-1, 3)
+        sigma = torch.zeros(pts.shape[0])
+        mask = torch.ones_like(sigma, dtype=torch.bool) if mask_fn is None else mask_fn(pts)
+        if torch.any(mask):
+            sigma[mask] = density_fn(pts[mask]).float()
+        grid[:, :, k:k+slab] = sigma.reshape(len(z), R, R).permute(1, 2, 0).cpu().numpy()
+    return grid
+
+
+def extract_mesh(grid, bounding_box, level):
+    """
+    Marching cubes on a density grid from density_grid.
+    Returns:
+        verts: [V, 3] float32 in world coordinates.
+        faces: [F, 3] int32.
+    """
+    try:
+        from skimage.measure import marching_cubes
+    except ImportError:
+        raise ImportError('mesh extraction needs scikit-image, pip install scikit-image')
+    if not grid.min() < level < grid.max():
+        raise ValueError(f'level={level} is outside the density range [{grid.min():.3f}, {grid.max():.3f}]')
+    verts, faces, _, _ = marching_cubes(grid, level=level)
+    box_min, box_max = np.array(bounding_box[0]), np.array(bounding_box[1])
+    verts = box_min + verts / (np.array(grid.shape) - 1) * (box_max - box_min)
+    return verts.astype(np.float32), faces.astype(np.int32)
+
+
+def write_ply(path, verts, faces):
+    """
+    Binary little endian PLY.
+    """
+    header = (f'ply\nformat binary_little_endian 1.0\nelement vertex {len(verts)}\n'
+              'property float x\nproperty float y\nproperty float z\n'
+              f'element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n')
+    face_data = np.empty(len(faces), dtype=[('n', 'u1'), ('idx', '<i4', (3,))])
+    face_data['n'] = 3
+    face_data['idx'] = faces
+    with open(path, 'wb') as f:
+        f.write(header.encode())
+        f.write(np.asarray(verts, dtype='<f4').tobytes())
+        f.write(face_data.tobytes())
+
+
+def write_obj(path, verts, faces):
+    with open(path, 'w') as f:
+        np.savetxt(f, verts, fmt='v %.6f %.6f %.6f')
+        np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+def write_mesh(path, verts, faces):
+    """
+    Writes a PLY or OBJ file depending on the extension of 'path'.
+    """
+    if path.endswith('.ply'):
+        write_ply(path, verts, faces)
+    elif path.endswith('.obj'):
+        write_obj(path, verts, faces)
+    else:
+        raise ValueError(f'unknown mesh format {path}, use .ply or .obj')
@@ -51,25 +51,152 @@ class Embedder:
         return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
 
 
-def get_embedder(multires, i=0):
+def positional_encode(inputs, freq_bands, include_input=True, use_recurrence=False, out=None):
+    """
+    Positional encoding [x, sin(f_0 x), cos(f_0 x), ..., sin(f_L x), cos(f_L x)] of inputs [..., d].
+    Works feature-major so every op runs over one contiguous row of all points; the result is a
+    transposed view [..., C] of a [C, N] buffer, which matmuls consume without a copy.
+    Not differentiable. 'out' is an optional flat workspace (>= C*N elements) to reuse.
+    """
+    d = inputs.shape[-1]
+    L = freq_bands.shape[0]
+    x = torch.reshape(inputs, [-1, d]).t()  # [d, N]
+    N = x.shape[1]
+    offset = d if include_input else 0
+    C = offset + 2*L*d
+    buf = (inputs.new_empty(C*N) if out is None else out[:C*N]).view(C, N)
+    if include_input:
+        buf[:d] = x
+    enc = buf[offset:].view(L, 2, d, N)
+
+    if use_recurrence:
+        # only the first octave is transcendental, the rest use double-angle identities
+        scaled = x * freq_bands[0]
+        torch.sin(scaled, out=enc[0, 0])
+        torch.cos(scaled, out=enc[0, 1])
+        for k in range(1, L):
+            s, c = enc[k-1, 0], enc[k-1, 1]
+            torch.mul(s, c, out=enc[k, 0]).mul_(2.)    # sin(2a) = 2 sin(a) cos(a)
+            torch.mul(c - s, c + s, out=enc[k, 1])      # cos(2a) = cos(a)^2 - sin(a)^2
+    else:
+        # stage f*x in the sin slots, so no [L, d, N] temporary is allocated
+        torch.mul(freq_bands[:, None, None], x, out=enc[:, 0])
+        torch.cos(enc[:, 0], out=enc[:, 1])
+        torch.sin_(enc[:, 0])
+    return torch.reshape(buf.t(), list(inputs.shape[:-1]) + [C])
+
+
+class _AnalyticPositionalEncoding(torch.autograd.Function):
+    """
+    Positional encoding with a closed-form backward: d sin(fx) = f cos(fx), d cos(fx) = -f sin(fx).
+    Only the encoded output is saved, instead of every sin/cos input autograd would keep.
+    """
+    @staticmethod
+    def forward(ctx, inputs, freq_bands, include_input, use_recurrence):
+        out = positional_encode(inputs, freq_bands, include_input, use_recurrence)
+        ctx.save_for_backward(out, freq_bands)
+        ctx.include_input = include_input
+        ctx.input_dims = inputs.shape[-1]
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        out, freq_bands = ctx.saved_tensors
+        d, L = ctx.input_dims, freq_bands.shape[0]
+        C = out.shape[-1]
+        offset = d if ctx.include_input else 0
+        enc = torch.reshape(out, [-1, C]).t()[offset:].view(L, 2, d, -1)  # feature-major again
+        grad = torch.reshape(grad_out, [-1, C]).t().contiguous()
+        grad_enc = grad[offset:].view(L, 2, d, -1)
+        grad_scaled = grad_enc[:, 0] * enc[:, 1] - grad_enc[:, 1] * enc[:, 0]  # [L, d, N]
+        grad_inputs = torch.sum(grad_scaled * freq_bands[:, None, None], 0)
+        if ctx.include_input:
+            grad_inputs = grad_inputs + grad[:d]
+        return torch.reshape(grad_inputs.t(), list(out.shape[:-1]) + [d]), None, None, None
+
+
+class PositionalEncoder(nn.Module):
+    """
+    Vectorized replacement for Embedder with sin/cos periodic functions.
+    The default path matches Embedder.embed bit-for-bit.
+    Args:
+        use_recurrence: bool. Compute octaves 1..L-1 with double-angle recurrences
+            (needs log sampling; not bit-exact, error grows ~2^k ulp).
+        analytic_grad: bool. Use _AnalyticPositionalEncoding's backward instead of autograd. Only applies
+            to inputs that require gradients (e.g. pose refinement), not to NeRF sample points.
+    """
+    def __init__(self, input_dims=3, max_freq_log2=9, num_freqs=10, include_input=True,
+                 log_sampling=True, use_recurrence=False, analytic_grad=False):
+        super(PositionalEncoder, self).__init__()
+        if log_sampling:
+            freq_bands = 2.**torch.linspace(0., max_freq_log2, steps=num_freqs)
+        else:
+            freq_bands = torch.linspace(2.**0., 2.**max_freq_log2, steps=num_freqs)
+        if use_recurrence and not (freq_bands[0] == 1. and torch.equal(freq_bands[1:], 2.*freq_bands[:-1])):
+            raise ValueError('use_recurrence needs octave frequency bands (log_sampling with max_freq_log2 = num_freqs-1)')
+        self.register_buffer('freq_bands', freq_bands)
+        self.input_dims = input_dims
+        self.include_input = include_input
+        self.use_recurrence = use_recurrence
+        self.analytic_grad = analytic_grad
+        self.out_dim = input_dims * (int(include_input) + 2*num_freqs)
+
+    def forward(self, inputs, out=None):
+        if not (torch.is_grad_enabled() and inputs.requires_grad):
+            return positional_encode(inputs, self.freq_bands, self.include_input, self.use_recurrence, out=out)
+        if self.analytic_grad:
+            return _AnalyticPositionalEncoding.apply(inputs, self.freq_bands, self.include_input, self.use_recurrence)
+
+        # plain autograd path, same feature-major layout as positional_encode
+        x = torch.reshape(inputs, [-1, inputs.shape[-1]]).t()  # [d, N]
+        if self.use_recurrence:
+            scaled = x * self.freq_bands[0]
+            sins, coss = [torch.sin(scaled)], [torch.cos(scaled)]
+            for _ in range(1, self.freq_bands.shape[0]):
+                s, c = sins[-1], coss[-1]
+                sins.append(2. * s * c)
+                coss.append((c - s) * (c + s))
+            enc = torch.stack([torch.stack(sins, 0), torch.stack(coss, 0)], 1)
+        else:
+            scaled = self.freq_bands[:, None, None] * x  # [L, d, N]
+            enc = torch.stack([torch.sin(scaled), torch.cos(scaled)], 1)  # [L, 2, d, N]
+        enc = torch.flatten(enc, 0, 2)
+        if self.include_input:
+            enc = torch.cat([x, enc], 0)
+        return torch.reshape(enc.t(), list(inputs.shape[:-1]) + [self.out_dim])
+
+
+def get_embedder(multires, i=0, use_recurrence=False, analytic_grad=False):
     if i == -1:
         return nn.Identity(), 3
-    
+
     embed_kwargs = {
                 'include_input' : True,
                 'input_dims' : 3,
                 'max_freq_log2' : multires-1,
                 'num_freqs' : multires,
                 'log_sampling' : True,
-                'periodic_fns' : [torch.sin, torch.cos],
+                'use_recurrence' : use_recurrence,
+                'analytic_grad' : analytic_grad,
     }
-    
-    embedder_obj = Embedder(**embed_kwargs)
-    embed = lambda x, eo=embedder_obj : eo.embed(x)
-    return embed, embedder_obj.out_dim
+
+    embedder_obj = PositionalEncoder(**embed_kwargs)
+    return embedder_obj, embedder_obj.out_dim
 
 
 # Model
+def broadcast_cat_linear(linear, x, y):
+    """
+    linear(torch.cat([x, y broadcast over the sample axis], -1)) without building the concatenation.
+    Args:
+        x: [..., N_samples, C_x]. Per sample features.
+        y: [..., C_y]. Per ray features, projected once per ray.
+    """
+    w = linear.weight
+    C_x = x.shape[-1]
+    return F.linear(x, w[:, :C_x], linear.bias) + F.linear(y, w[:, C_x:]).unsqueeze(-2)
+
+
 class NeRF(nn.Module):
     def __init__(self, D=8, W=256, input_ch=3, input_ch_views=3, output_ch=4, skips=[4], use_viewdirs=False):
         super(NeRF, self).__init__()
@@ -97,22 +224,29 @@ class NeRF(nn.Module):
         else:
             self.output_linear = nn.Linear(W, output_ch)
 
-    def forward(self, x):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
-        h = input_pts
-        for i, _ in enumerate(self.pts_linears):
-            h = self.pts_linears[i](h)
-            h = F.relu(h)
-            if i in self.skips:
-                h = torch.cat([input_pts, h], -1)
+    def forward(self, x, views=None):
+        """
+        x: [..., input_ch + input_ch_views] embedded points and directions, or only the
+            embedded points [..., N_samples, input_ch] when 'views' is given.
+        views: [..., input_ch_views]. One embedded direction per ray, broadcast over N_samples.
+        """
+        if views is None:
+            input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        else:
+            input_pts, input_views = x, views
+        h = self.pts_features(input_pts)
 
         if self.use_viewdirs:
             alpha = self.alpha_linear(h)
             feature = self.feature_linear(h)
-            h = torch.cat([feature, input_views], -1)
-        
-            for i, _ in enumerate(self.views_linears):
-                h = self.views_linears[i](h)
+            if views is None:
+                h = self.views_linears[0](torch.cat([feature, input_views], -1))
+            else:
+                h = broadcast_cat_linear(self.views_linears[0], feature, input_views)
+            h = F.relu(h)
+
+            for i, _ in enumerate(self.views_linears[1:]):
+                h = self.views_linears[i+1](h)
                 h = F.relu(h)
 
             rgb = self.rgb_linear(h)
@@ -122,6 +256,24 @@ class NeRF(nn.Module):
 
         return outputs    
 
+    def pts_features(self, input_pts):
+        h = input_pts
+        for i, _ in enumerate(self.pts_linears):
+            h = self.pts_linears[i](h)
+            h = F.relu(h)
+            if i in self.skips:
+                h = torch.cat([input_pts, h], -1)
+        return h
+
+    def density(self, x):
+        """
+        Raw density [..., 1] of embedded points x [..., input_ch], skipping the view branch.
+        """
+        h = self.pts_features(x)
+        if self.use_viewdirs:
+            return self.alpha_linear(h)
+        return self.output_linear(h)[...,3:4]
+
 
     def load_weights_from_keras(self, weights):
         assert self.use_viewdirs, "Not implemented if use_viewdirs=False"
@@ -153,6 +305,68 @@ class NeRF(nn.Module):
         self.alpha_linear.bias.data = torch.from_numpy(np.transpose(weights[idx_alpha_linear+1]))
 
 
+class NeRFSmall(nn.Module):
+    """
+    Small MLP for the hash grid encoding (i_embed=1): a density net giving sigma and a
+    geometric feature, followed by a color net on [geo_feat, embedded view direction].
+    'embedder' is only registered so its tables are optimized and checkpointed with
+    this network; the encoding itself is applied in run_network.
+    """
+    def __init__(self, num_layers=2, hidden_dim=64, geo_feat_dim=15, num_layers_color=3, hidden_dim_color=64,
+                 input_ch=3, input_ch_views=3, use_viewdirs=False, embedder=None):
+        super(NeRFSmall, self).__init__()
+        self.input_ch = input_ch
+        self.input_ch_views = input_ch_views
+        self.geo_feat_dim = geo_feat_dim
+        self.use_viewdirs = use_viewdirs
+        self.embedder = embedder
+
+        self.sigma_net = nn.ModuleList(
+            [nn.Linear(input_ch if i == 0 else hidden_dim, 1 + geo_feat_dim if i == num_layers-1 else hidden_dim, bias=False)
+             for i in range(num_layers)])
+
+        color_in = geo_feat_dim + (input_ch_views if use_viewdirs else 0)
+        self.color_net = nn.ModuleList(
+            [nn.Linear(color_in if i == 0 else hidden_dim_color, 3 if i == num_layers_color-1 else hidden_dim_color, bias=False)
+             for i in range(num_layers_color)])
+
+    def forward(self, x, views=None):
+        """
+        Same inputs as NeRF.forward.
+        """
+        if views is None:
+            input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        else:
+            input_pts, input_views = x, views
+        h = self.sigma_features(input_pts)
+        sigma, geo_feat = h[...,:1], h[...,1:]
+
+        for i, layer in enumerate(self.color_net):
+            if i == 0 and self.use_viewdirs:
+                h = layer(torch.cat([geo_feat, input_views], -1)) if views is None else \
+                    broadcast_cat_linear(layer, geo_feat, input_views)
+            else:
+                h = layer(geo_feat if i == 0 else h)
+            if i != len(self.color_net) - 1:
+                h = F.relu(h)
+
+        return torch.cat([h, sigma], -1)
+
+    def sigma_features(self, input_pts):
+        h = input_pts
+        for i, layer in enumerate(self.sigma_net):
+            h = layer(h)
+            if i != len(self.sigma_net) - 1:
+                h = F.relu(h)
+        return h
+
+    def density(self, x):
+        """
+        Raw density [..., 1] of embedded points x [..., input_ch], skipping the color net.
+        """
+        return self.sigma_features(x)[...,:1]
+
+
 # Ray helpers
 def get_rays(H, W, K, c2w):
     i, j = torch.meshgrid(torch.linspace(0, W-1, W), torch.linspace(0, H-1, H),indexing='ij')  # pytorch's meshgrid has indexing='ij'
@@ -166,6 +380,17 @@ def get_rays(H, W, K, c2w):
     return rays_o, rays_d
 
 
+def pixel_rays(K, c2w, i, j):
+    """
+    Rays through pixels (column i, row j) [N], each with its own camera c2w [N, 3, 4]
+    (or one camera [3, 4] for all). Same rays as get_rays at those pixels.
+    """
+    dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)  # [N, 3]
+    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[...,:3,:3], -1)
+    rays_o = c2w[...,:3,-1].expand(rays_d.shape)
+    return rays_o, rays_d
+
+
 def get_rays_np(H, W, K, c2w):
     i, j = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32), indexing='xy')
     dirs = np.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -np.ones_like(i)], -1)
@@ -196,6 +421,21 @@ def ndc_rays(H, W, focal, near, rays_o, rays_d):
     return rays_o, rays_d
 
 
+def ray_aabb_intersect(rays_o, rays_d, aabb):
+    """
+    Slab test of rays [..., 3] against the box aabb = (min_corner, max_corner).
+    Returns:
+        t_min, t_max: [...]. Entry and exit distance in units of rays_d, t_max < t_min if the ray misses.
+    """
+    box_min, box_max = torch.Tensor(aabb[0]), torch.Tensor(aabb[1])
+    inv_d = 1. / torch.where(torch.abs(rays_d) < 1e-10, torch.full_like(rays_d, 1e-10), rays_d)
+    t0 = (box_min - rays_o) * inv_d
+    t1 = (box_max - rays_o) * inv_d
+    t_min = torch.max(torch.minimum(t0, t1), -1)[0]
+    t_max = torch.min(torch.maximum(t0, t1), -1)[0]
+    return t_min, t_max
+
+
 # Hierarchical sampling (section 5.2)
 def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
     # Get pdf
@@ -0,0 +1,69 @@
+###############################################################################
+# Occupancy grid for empty-space skipping
+###############################################################################
+
+import torch
+import torch.nn as nn
+
+
+class OccupancyGrid(nn.Module):
+    """
+    Occupancy bitfield over the scene box, maintained from the network's density.
+    The grid starts fully occupied, so nothing is skipped before the first update.
+    Args:
+        bounding_box: (min_corner, max_corner) of the scene.
+        resolution: int. Cells per axis.
+        decay: float. Exponential decay of the running density per update.
+        threshold: float. Density below which a cell is empty (capped by the mean density).
+    """
+    def __init__(self, bounding_box, resolution=64, decay=0.95, threshold=0.01):
+        super(OccupancyGrid, self).__init__()
+        self.resolution = resolution
+        self.decay = decay
+        self.threshold = threshold
+        self.register_buffer('box_min', torch.Tensor(bounding_box[0]))
+        self.register_buffer('box_max', torch.Tensor(bounding_box[1]))
+        self.register_buffer('density', torch.zeros(resolution**3))
+        self.register_buffer('bitfield', torch.ones(resolution**3, dtype=torch.bool))
+
+    def cell_index(self, pts):
+        """
+        Flat cell index of pts [..., 3] and whether they are inside the box, faces included
+        (a density_grid lattice spanning the box looks up its last slice in the last cells).
+        """
+        x = (pts - self.box_min) / (self.box_max - self.box_min)
+        inside = torch.all((x >= 0.) & (x <= 1.), -1)
+        ijk = torch.clamp((x * self.resolution).long(), 0, self.resolution-1)
+        R = self.resolution
+        return ijk[...,0] + R * (ijk[...,1] + R * ijk[...,2]), inside
+
+    def occupied(self, pts):
+        """
+        Boolean mask [...] of pts [..., 3] that lie in occupied cells. The grid knows nothing about
+        points outside the box (e.g. from render poses beyond the training frusta), so they count as occupied.
+        """
+        idx, inside = self.cell_index(pts)
+        return self.bitfield[idx] | ~inside
+
+    @torch.no_grad()
+    def update(self, density_fn, chunk=1024*64):
+        """
+        Re-evaluates the density at one jittered point per cell.
+        Args:
+            density_fn: function mapping pts [N, 3] to density [N].
+        """
+        R = self.resolution
+        size = self.box_max - self.box_min
+        for i in range(0, R**3, chunk):
+            idx = torch.arange(i, min(i+chunk, R**3), device=self.density.device)
+            ijk = torch.stack([idx % R, (idx // R) % R, idx // (R*R)], -1)
+            pts = self.box_min + (ijk + torch.rand(ijk.shape, device=ijk.device)) / R * size
+            self.density[i:i+chunk] = torch.maximum(self.density[i:i+chunk] * self.decay, density_fn(pts))
+        threshold = min(self.threshold, self.density.mean().item())
+        self.bitfield = self.density > threshold
+
+    def occupancy(self):
+        """
+        Fraction of occupied cells.
+        """
+        return self.bitfield.float().mean().item()
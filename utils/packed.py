@@ -0,0 +1,51 @@
+###############################################################################
+# Packed (ragged) samples: a flat [M, ...] tensor plus per-ray offsets and counts
+###############################################################################
+
+import torch
+
+
+def pack(mask):
+    """
+    Packs the True entries of a dense sample mask in ray-major order.
+    Args:
+        mask: bool tensor [N_rays, N_samples]. Samples to keep.
+    Returns:
+        ray_indices: [M]. Ray of every packed sample.
+        offsets: [N_rays]. Index of the first packed sample of each ray.
+        counts: [N_rays]. Number of packed samples of each ray.
+    """
+    counts = torch.sum(mask, -1)
+    offsets = torch.cumsum(counts, 0) - counts
+    ray_indices = torch.nonzero(mask)[:,0]
+    return ray_indices, offsets, counts
+
+
+def unpack(values, mask, fill=0.):
+    """
+    Scatters packed values [M, ...] back to a dense [N_rays, N_samples, ...] tensor.
+    """
+    out = values.new_full(list(mask.shape) + list(values.shape[1:]), fill)
+    out[mask] = values
+    return out
+
+
+def segment_sum(values, ray_indices, n_rays):
+    """
+    Per-ray sum of packed values [M, ...] -> [n_rays, ...].
+    """
+    out = values.new_zeros([n_rays] + list(values.shape[1:]))
+    return out.index_add(0, ray_indices, values)
+
+
+def segment_cumsum(values, ray_indices, offsets, exclusive=False):
+    """
+    Cumulative sum of packed values [M] restarting at every ray.
+    Accumulated in float64, since one global cumsum is shared by all rays.
+    """
+    cs = torch.cumsum(values.double(), 0)
+    excl = cs - values.double()
+    out = excl - excl[offsets[ray_indices]]
+    if not exclusive:
+        out = out + values.double()
+    return out.to(values.dtype)
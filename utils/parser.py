@@ -37,6 +37,21 @@ def config_parser():
                         help='number of pts sent through network in parallel, decrease if running out of memory')
     parser.add_argument("--no_batching", action='store_true',
                         help='only take random rays from 1 image at a time')
+    parser.add_argument("--ray_sampler", type=str, default='memory', choices=['memory', 'cache', 'pixels'],
+                        help='rays of the batched path: memory builds them in RAM on every launch, cache streams '
+                             'them once to a memory-mapped file keyed by images, poses and split, pixels draws '
+                             'random pixels and builds their rays on the fly')
+    parser.add_argument("--ray_cache_dir", type=str, default=None,
+                        help='directory of the ray cache, default <basedir>/ray_cache')
+    parser.add_argument("--error_map", action='store_true',
+                        help='draw training rays in proportion to a low resolution per-image error map, with '
+                             'importance weights in the loss; replaces --ray_sampler, rays are built on the fly')
+    parser.add_argument("--error_map_res", type=int, default=64,
+                        help='cells of the error map along each image axis')
+    parser.add_argument("--error_map_uniform", type=float, default=0.5,
+                        help='share of rays drawn uniformly, bounds the importance weights by its inverse')
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help='ray batches prepared ahead on a background thread, 0 samples in the training loop')
     parser.add_argument("--no_reload", action='store_true',
                         help='do not reload weights from saved ckpt')
     parser.add_argument("--ft_path", type=str, default=None,
@@ -60,11 +75,55 @@ def config_parser():
     parser.add_argument("--use_viewdirs", action='store_true',
                         help='use full 5D input instead of 3D')
     parser.add_argument("--i_embed", type=int, default=0,
-                        help='set 0 for default positional encoding, -1 for none')
+                        help='set 0 for default positional encoding, 1 for multiresolution hash grid, -1 for none')
     parser.add_argument("--multires", type=int, default=10,
                         help='log2 of max freq for positional encoding (3D location)')
     parser.add_argument("--multires_views", type=int, default=4,
                         help='log2 of max freq for positional encoding (2D direction)')
+    parser.add_argument("--pe_recurrence", action='store_true',
+                        help='compute higher positional encoding octaves with double-angle recurrences')
+    # hash grid (i_embed=1) options
+    parser.add_argument("--n_levels", type=int, default=16,
+                        help='number of hash grid resolutions')
+    parser.add_argument("--n_features_per_level", type=int, default=2,
+                        help='feature width of every hash table entry')
+    parser.add_argument("--log2_hashmap_size", type=int, default=19,
+                        help='log2 of the hash table size per level')
+    parser.add_argument("--base_res", type=int, default=16,
+                        help='coarsest hash grid resolution')
+    parser.add_argument("--finest_res", type=int, default=512,
+                        help='finest hash grid resolution')
+    parser.add_argument("--sparse_hash", action='store_true',
+                        help='sparse hash table gradients, optimized with SparseAdam')
+    # occupancy grid options
+    parser.add_argument("--occupancy_grid", action='store_true',
+                        help='skip samples in empty cells of an occupancy grid maintained from the coarse network, samples outside its box are always queried')
+    parser.add_argument("--occ_res", type=int, default=64,
+                        help='occupancy grid cells per axis')
+    parser.add_argument("--occ_update_every", type=int, default=500,
+                        help='iterations between occupancy grid updates')
+    parser.add_argument("--occ_warmup", type=int, default=1000,
+                        help='first iteration at which the occupancy grid is updated')
+    parser.add_argument("--occ_threshold", type=float, default=0.01,
+                        help='density below which an occupancy cell is empty')
+    parser.add_argument("--occ_decay", type=float, default=0.95,
+                        help='decay of the running cell density per update')
+    parser.add_argument("--use_aabb", action='store_true',
+                        help='clip near/far per ray to the scene box from the loader (blender, pictures), not in NDC')
+    parser.add_argument("--packed", action='store_true',
+                        help='composite only the samples that survive skipping, as packed per-ray segments; '
+                             'not compatible with --ert_eps')
+    # baking options
+    parser.add_argument("--bake_res", type=int, default=128,
+                        help='voxels per axis of the baked grid')
+    parser.add_argument("--bake_sh_deg", type=int, default=2,
+                        help='spherical harmonics degree of the baked colour, at most 2')
+    parser.add_argument("--bake_dirs", type=int, default=32,
+                        help='view directions per voxel for fitting the baked colour')
+    parser.add_argument("--bake_threshold", type=float, default=1.,
+                        help='density below which a voxel is left out of the baked grid')
+    parser.add_argument("--baked_path", type=str, default=None,
+                        help='baked grid written by bake.py, used for test renders instead of the networks')
     parser.add_argument("--raw_noise_std", type=float, default=0.,
                         help='std dev of noise added to regularize sigma_a output, 1e0 recommended')
 
@@ -78,6 +137,39 @@ def config_parser():
                         help='render the network predictions as specified by --i_img')
     parser.add_argument("--render_factor", type=int, default=1,
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
+    parser.add_argument("--ert_eps", type=float, default=0.,
+                        help='early ray termination for test renders: stop rays once transmittance < ert_eps, 0 disables; '
+                             'not compatible with --packed')
+    parser.add_argument("--ert_segment", type=int, default=16,
+                        help='samples queried per ray between early ray termination checks')
+    parser.add_argument("--depth_range", nargs=2, type=float, default=None,
+                        help='fixed depth range of depth videos, default normalizes by the max depth of the path')
+    parser.add_argument("--save_depths", action='store_true',
+                        help='also save a depth PNG per rendered test frame')
+    parser.add_argument("--depth_16bit", action='store_true',
+                        help='save depth PNGs as 16 bit')
+    parser.add_argument("--io_workers", type=int, default=4,
+                        help='background threads encoding rendered PNGs')
+    parser.add_argument("--render_cache", action='store_true',
+                        help='serve render_only frames from an on-disk cache keyed by weights, pose and render settings')
+    parser.add_argument("--render_cache_size", type=int, default=1024,
+                        help='render cache size in MB, least recently used frames are evicted beyond it')
+    parser.add_argument("--render_batch_poses", type=int, default=1,
+                        help='poses whose rays are packed into shared chunks when rendering paths, for small frames')
+    parser.add_argument("--temporal_reuse", type=int, default=0,
+                        help='render video frames from the reprojected depth of the previous frame, with a full '
+                             'keyframe every this many frames (0 disables). Not for NDC')
+    parser.add_argument("--reuse_width", type=float, default=0.1,
+                        help='half width of the sampled interval around the reprojected depth, relative to the depth')
+    parser.add_argument("--reuse_samples", type=int, default=16,
+                        help='fine network samples per ray in the reprojected interval')
+    parser.add_argument("--preview_step", type=int, default=0,
+                        help='render training videos and validation images progressively from a lattice of every '
+                             'this many pixels, refining where the lattice is least smooth (0 disables)')
+    parser.add_argument("--preview_rays", type=float, default=0.25,
+                        help='ray budget of a progressive frame, as a fraction of its pixels')
+    parser.add_argument("--preview_time", type=float, default=None,
+                        help='time budget of a progressive frame in seconds')
     parser.add_argument("--render_poses_filter", nargs='+', type=int,default=None,
                         help='list numbs to render and save, e.g. [0,1,2,3]')
 
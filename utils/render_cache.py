@@ -0,0 +1,146 @@
+###############################################################################
+# On-disk cache of rendered frames, keyed by weights, pose and render settings
+###############################################################################
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from os.path import join as path_join
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def _update_tensor(h, t):
+    t = t.detach().cpu().contiguous()
+    h.update(str(t.dtype).encode())
+    h.update(str(tuple(t.shape)).encode())
+    h.update(t.numpy().tobytes())
+
+
+# args held inside the embedder closures of network_query_fn, they change pixels but not render_kwargs
+EMBED_ARGS = ['i_embed', 'multires', 'multires_views', 'pe_recurrence',
+              'n_levels', 'n_features_per_level', 'log2_hashmap_size', 'base_res', 'finest_res']
+
+
+def embed_settings(args):
+    """
+    The EMBED_ARGS of parsed 'args', see settings_digest.
+    """
+    return {k : getattr(args, k) for k in EMBED_ARGS if hasattr(args, k)}
+
+
+def settings_digest(render_kwargs, settings=None):
+    """
+    Hash of everything in render_kwargs that changes a render: the weights and buffers
+    of every module (including the one behind a bound network_query_fn, e.g. a baked grid)
+    and every plain setting. Functions are skipped, they only control chunking, so settings
+    captured by them (e.g. embed_settings(args)) must be passed in 'settings'.
+    """
+    h = hashlib.sha1()
+    if settings:
+        h.update(repr(sorted(settings.items())).encode())
+    for k in sorted(render_kwargs):
+        v = render_kwargs[k]
+        module = getattr(v, '__self__', v)
+        h.update(k.encode())
+        if isinstance(module, nn.Module):
+            for name, t in sorted(module.state_dict().items()):
+                h.update(name.encode())
+                _update_tensor(h, t)
+        elif isinstance(v, torch.Tensor):
+            _update_tensor(h, v)
+        elif not callable(v):
+            h.update(repr(v).encode())
+    return h.hexdigest()
+
+
+def is_deterministic(render_kwargs):
+    """
+    Renders with stratified sampling or density noise are random and never cached.
+    """
+    return render_kwargs.get('perturb', 0.) == 0. and render_kwargs.get('raw_noise_std', 0.) == 0.
+
+
+class RenderCache:
+    """
+    Content-addressed store of rendered frames, one .npz per frame under 'cache_dir'.
+    The least recently used entries are evicted once the cache exceeds 'max_bytes'.
+    'settings' are hashed into every digest next to render_kwargs, see settings_digest.
+    """
+    def __init__(self, cache_dir, max_bytes=1024**3, settings=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.settings = settings
+        os.makedirs(cache_dir, exist_ok=True)
+        # LRU index of entry sizes, oldest first, so eviction never rescans the directory
+        self.sizes = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+        entries = []
+        for f in os.listdir(cache_dir):
+            if f.endswith('.npz') and not f.endswith('.tmp.npz'):
+                stat = os.stat(path_join(cache_dir, f))
+                entries.append((stat.st_mtime, f[:-len('.npz')], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.sizes[key] = size
+            self.total += size
+
+    def key(self, digest, c2w, H, W, K, render_factor):
+        """
+        Key of one frame, 'digest' is settings_digest(render_kwargs).
+        """
+        h = hashlib.sha1(digest.encode())
+        h.update(np.asarray(c2w.cpu() if isinstance(c2w, torch.Tensor) else c2w, dtype=np.float64).tobytes())
+        h.update(np.asarray(K, dtype=np.float64).tobytes())
+        h.update(repr((int(H), int(W), render_factor)).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return path_join(self.cache_dir, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """
+        Dict of arrays stored under 'key', or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {k : entry[k] for k in entry.files}
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if key in self.sizes:
+                self.sizes.move_to_end(key)  # mark as recently used
+        os.utime(path)  # keeps the order across runs
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Stores 'arrays' under 'key', then evicts down to max_bytes. Safe to call from writer threads.
+        """
+        tmp_path = self.path(key) + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.path(key))  # readers never see a partial entry
+        with self.lock:
+            self.total += size - self.sizes.pop(key, 0)
+            self.sizes[key] = size
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes. Called with 'lock' held.
+        """
+        while self.total > self.max_bytes and self.sizes:
+            key, size = self.sizes.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
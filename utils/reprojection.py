@@ -0,0 +1,60 @@
+###############################################################################
+# Reprojection of a rendered depth map into a nearby camera
+###############################################################################
+
+import torch
+
+from utils.nerf_helpers import get_rays
+
+
+def project(pts, H, W, K, c2w):
+    """
+    Pixel coordinates (u, v) and camera depth z of world points [N, 3] seen from c2w [3, 4].
+    z is also the ray parameter of the point along get_rays' (unnormalized) direction.
+    """
+    pts_cam = (pts - c2w[:3,-1]) @ c2w[:3,:3]  # world to camera, R^T (x - t)
+    z = -pts_cam[...,2]
+    u = K[0][0] * pts_cam[...,0] / z + K[0][2]
+    v = -K[1][1] * pts_cam[...,1] / z + K[1][2]
+    return u, v, z
+
+
+def splat_depth(u, v, z, H, W):
+    """
+    Z-buffered forward splat of depths z at pixel coordinates (u, v). Every point covers
+    the 2x2 pixels around it, which closes the cracks left by slight magnification.
+    Returns:
+        depth: [H*W], nearest depth per pixel, inf where nothing landed.
+    """
+    depth = torch.full([H*W], float('inf'), device=z.device)
+    x0, y0 = torch.floor(u).long(), torch.floor(v).long()
+    for dx in (0, 1):
+        for dy in (0, 1):
+            x, y = x0 + dx, y0 + dy
+            valid = (z > 0) & (x >= 0) & (x < W) & (y >= 0) & (y < H)
+            depth.scatter_reduce_(0, (y * W + x)[valid], z[valid], reduce='amin')
+    return depth
+
+
+def reproject(depth, acc, c2w_prev, c2w, H, W, K, far, acc_thresh=0.5):
+    """
+    Carries a rendered frame into camera c2w.
+    Args:
+        depth, acc: [H, W]. depth_map and acc_map rendered from c2w_prev [3, 4]. Surfaces are
+            placed at depth / acc, depth_map being weighted by acc.
+        far: float. Pixels of the previous frame with acc < acc_thresh are background,
+            placed at this distance.
+    Returns:
+        surface_depth: [H*W]. Expected ray parameter of the surface, inf where no surface lands.
+        background: [H*W] bool. Pixels covered by background and by no surface.
+    """
+    rays_o, rays_d = get_rays(H, W, K, c2w_prev)
+    rays_o, rays_d = rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)
+    depth, acc = depth.reshape(-1), acc.reshape(-1)
+    fg = acc >= acc_thresh
+
+    u, v, z = project(rays_o[fg] + (depth[fg] / acc[fg])[:,None] * rays_d[fg], H, W, K, c2w)
+    surface_depth = splat_depth(u, v, z, H, W)
+    u, v, z = project(rays_o[~fg] + far * rays_d[~fg], H, W, K, c2w)
+    background = torch.isfinite(splat_depth(u, v, z, H, W)) & ~torch.isfinite(surface_depth)
+    return surface_depth, background
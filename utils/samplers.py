@@ -0,0 +1,380 @@
+###############################################################################
+# Training ray samplers, sample(i) returns the rays and target colours of step i
+###############################################################################
+
+import hashlib
+import os
+from os.path import join as path_join
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from load.image_store import composite
+from utils.nerf_helpers import get_rays_np, pixel_rays
+
+
+def torch_generator(device=None, seed=None):
+    """
+    A torch.Generator of its own on 'device', seeded with 'seed' (randomly if None).
+    Samplers draw from their own generators, so a Prefetcher thread and the training
+    loop never share random state.
+    """
+    generator = torch.Generator(device=device or 'cpu')
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+
+class FeistelPermutation:
+    """
+    Pseudo-random permutation of range(n), evaluated only at the positions asked for.
+    A balanced Feistel network permutes the smallest even number of bits covering n and
+    values outside range(n) are cycle-walked back in, so no index array is ever stored.
+    reseed() draws a new permutation from 'rng', a np.random.Generator.
+    """
+    def __init__(self, n, rounds=4, rng=None):
+        self.n = n
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.rounds = rounds
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.reseed()
+
+    def reseed(self):
+        self.keys = [int(k) for k in self.rng.integers(0, 2**31, self.rounds)]
+
+    def _round(self, x, key):
+        # integer hash, every product stays below 2**62
+        x = ((x ^ key) * 0x2C1B3C6D) & 0x7FFFFFFF
+        x = x ^ (x >> 12)
+        x = (x * 0x297A2D39) & 0x7FFFFFFF
+        return (x ^ (x >> 15)) & self.mask
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __call__(self, positions):
+        """
+        Permuted indices [N] of positions [N] (long tensor).
+        """
+        out = self._encrypt(positions)
+        outside = out >= self.n
+        while torch.any(outside):
+            out[outside] = self._encrypt(out[outside])
+            outside = out >= self.n
+        return out
+
+
+class RayBatchSampler:
+    """
+    Random rays over all training images from an in-memory [N, ro+rd+rgb, 3] tensor.
+    The tensor is never moved, batches are gathered through a FeistelPermutation that
+    is reseeded after every epoch.
+    """
+    def __init__(self, rays_rgb, N_rand, seed=None):
+        self.rays_rgb = rays_rgb
+        self.N_rand = N_rand
+        self.perm = FeistelPermutation(rays_rgb.shape[0], rng=np.random.default_rng(seed))
+        self.i_batch = 0
+
+    def sample(self, i):
+        n = self.rays_rgb.shape[0]
+        idx = self.perm(torch.arange(self.i_batch, min(self.i_batch+self.N_rand, n), device=self.rays_rgb.device))
+        batch = self.rays_rgb[idx]  # [B, 2+1, 3*?]
+        batch = torch.transpose(batch, 0, 1)
+        batch_rays, target_s = batch[:2], batch[2]
+
+        self.i_batch += self.N_rand
+        if self.i_batch >= n:
+            print("Shuffle data after an epoch!")
+            self.perm.reseed()
+            self.i_batch = 0
+        return batch_rays, target_s
+
+
+def ray_cache_key(images, poses, K, H, W, i_train):
+    """
+    Hash of everything the cached rays depend on: the training images, their poses and the intrinsics.
+    """
+    h = hashlib.sha1()
+    h.update(repr((int(H), int(W), [int(i) for i in i_train])).encode())
+    h.update(np.asarray(K, dtype=np.float64).tobytes())
+    for i in i_train:
+        h.update(np.asarray(poses[i,:3,:4], dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(images[i][...,:3], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def build_ray_cache(cache_dir, images, poses, K, H, W, i_train):
+    """
+    Writes the rays and colours of the training images to <cache_dir>/<key>.npy, a float32
+    [len(i_train)*H*W, ro+rd+rgb, 3] array, one image at a time. Nothing is written if the
+    file exists. Returns its path.
+    """
+    path = path_join(cache_dir, ray_cache_key(images, poses, K, H, W, i_train) + '.npy')
+    if os.path.exists(path):
+        print(f'[Ray cache] found {path}')
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + '.tmp'
+    rays_rgb = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(i_train)*H*W, 3, 3))
+    for n, i in enumerate(i_train):
+        rays_o, rays_d = get_rays_np(H, W, K, poses[i,:3,:4])
+        rays_rgb[n*H*W:(n+1)*H*W] = np.stack([rays_o, rays_d, images[i][...,:3]], -2).reshape(-1, 3, 3)
+    rays_rgb.flush()
+    del rays_rgb
+    os.replace(tmp_path, path)  # a crashed build never leaves a partial cache behind
+    print(f'[Ray cache] wrote {path}')
+    return path
+
+
+class CachedRaySampler:
+    """
+    Random rays over all training images read from a ray cache written by build_ray_cache.
+    The file is memory-mapped, only the rows of a batch are read, in FeistelPermutation order.
+    """
+    def __init__(self, path, N_rand, device, seed=None):
+        self.rays_rgb = np.load(path, mmap_mode='r')
+        self.N_rand = N_rand
+        self.device = device
+        self.perm = FeistelPermutation(self.rays_rgb.shape[0], rng=np.random.default_rng(seed))
+        self.i_batch = 0
+
+    def sample(self, i):
+        idx = self.perm(torch.arange(self.i_batch, min(self.i_batch+self.N_rand, self.rays_rgb.shape[0])))
+        idx = np.sort(idx.numpy())  # sorted rows read sequentially
+        batch = torch.from_numpy(self.rays_rgb[idx]).to(self.device)
+        batch = torch.transpose(batch, 0, 1)
+        batch_rays, target_s = batch[:2], batch[2]
+
+        self.i_batch += self.N_rand
+        if self.i_batch >= self.rays_rgb.shape[0]:
+            print("Shuffle data after an epoch!")
+            self.perm.reseed()
+            self.i_batch = 0
+        return batch_rays, target_s
+
+
+class PixelRaySampler:
+    """
+    Random rays over all training images computed on the fly: only the uint8 images of an
+    ImageStore, poses and K are kept on the device, rays are built for the N_rand drawn pixels.
+    """
+    def __init__(self, images, poses, K, i_train, N_rand, device, seed=None):
+        self.rgb = torch.from_numpy(images.rgb[i_train]).to(device)  # [N, H, W, 3]
+        self.alpha = None if images.alpha is None else torch.from_numpy(images.alpha[i_train]).to(device)
+        self.white_bkgd = images.white_bkgd
+        self.poses = torch.Tensor(np.stack([poses[i,:3,:4] for i in i_train], 0)).to(device)
+        self.K = K
+        self.N_rand = N_rand
+        self.device = device
+        self.generator = torch_generator(device, seed)
+
+    def sample(self, i):
+        N, H, W, _ = self.rgb.shape
+        idx = torch.randint(0, N*H*W, [self.N_rand], device=self.device, generator=self.generator)
+        img, row, col = idx // (H*W), (idx // W) % H, idx % W
+        rays_o, rays_d = pixel_rays(self.K, self.poses[img], col.float(), row.float())
+        target_s = composite(self.rgb[img, row, col], None if self.alpha is None else self.alpha[img, row, col],
+                             self.white_bkgd)
+        return torch.stack([rays_o, rays_d], 0), target_s
+
+
+class ImageRaySampler:
+    """
+    N_rand random rays from one random training image per step (no_batching), from the
+    central crop of the images for the first precrop_iters steps. Distinct pixels are drawn
+    directly and rays are built for those pixels only, a step costs O(N_rand) whatever H x W.
+    """
+    def __init__(self, images, poses, K, i_train, N_rand, H, W, precrop_iters=0, precrop_frac=.5, start=0, device=None,
+                 seed=None):
+        self.images = images
+        self.rng = np.random.default_rng(seed)
+        self.i_train = np.asarray(i_train)
+        self.poses = torch.as_tensor(poses[self.i_train, :3,:4], dtype=torch.float32, device=device)  # [N, 3, 4]
+        self.K = K
+        self.N_rand = N_rand
+        self.precrop_iters = precrop_iters
+        self.start = start
+        self.device = device
+        # (row0, col0, rows, cols) of the sampled window
+        dH, dW = int(H//2 * precrop_frac), int(W//2 * precrop_frac)
+        self.crop = (H//2 - dH, W//2 - dW, 2*dH, 2*dW)
+        self.full = (0, 0, H, W)
+        if precrop_iters > start:
+            print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {precrop_iters}")
+
+    def draw(self, n):
+        """
+        N_rand distinct indices of range(n): draws with replacement and redraws duplicates,
+        O(N_rand) for N_rand << n, a permutation otherwise.
+        """
+        if self.N_rand > n:
+            raise ValueError(f'cannot draw {self.N_rand} distinct pixels from {n}')
+        if 2 * self.N_rand > n:
+            return self.rng.permutation(n)[:self.N_rand]
+        inds = np.unique(self.rng.integers(0, n, self.N_rand))
+        while len(inds) < self.N_rand:
+            inds = np.unique(np.concatenate([inds, self.rng.integers(0, n, self.N_rand - len(inds))]))
+        return self.rng.permutation(inds)
+
+    def sample(self, i):
+        n = self.rng.integers(len(self.i_train))
+        row0, col0, h, w = self.crop if i < self.precrop_iters else self.full
+        inds = self.draw(h * w)
+        rows, cols = row0 + inds // w, col0 + inds % w
+        rows_t = torch.from_numpy(rows).to(self.device)
+        cols_t = torch.from_numpy(cols).to(self.device)
+        rays_o, rays_d = pixel_rays(self.K, self.poses[n], cols_t.float(), rows_t.float())  # (N_rand, 3)
+        batch_rays = torch.stack([rays_o, rays_d], 0)
+        target_s = self.images.pixels(self.i_train[n], rows, cols, self.device)  # (N_rand, 3)
+        return batch_rays, target_s
+
+
+class ErrorMapSampler:
+    """
+    Random rays drawn in proportion to a low-resolution error map of every training image
+    ([N, res, res] cells, mixed with a 'uniform' share of uniform sampling). Each ray has the
+    importance weight p_uniform / p_drawn, so the weighted mean of the per-ray losses stays
+    an unbiased estimate of the uniform one. sample(i) keeps the cells and weights of step i
+    until update(i, ray_loss) blends the per-ray losses into the map.
+    per_image draws from one random image per step (no_batching), the first warmup_iters
+    steps are then drawn by 'warmup' instead, e.g. an ImageRaySampler with precrop.
+    """
+    def __init__(self, images, poses, K, i_train, N_rand, device, res=64, uniform=.5, decay=.5,
+                 per_image=False, warmup=None, warmup_iters=0, seed=None):
+        self.rgb = torch.from_numpy(images.rgb[i_train]).to(device)  # [N, H, W, 3]
+        self.alpha = None if images.alpha is None else torch.from_numpy(images.alpha[i_train]).to(device)
+        self.white_bkgd = images.white_bkgd
+        self.poses = torch.Tensor(np.stack([poses[i,:3,:4] for i in i_train], 0)).to(device)
+        self.K = K
+        self.N_rand = N_rand
+        self.device = device
+        self.uniform = uniform
+        self.decay = decay
+        self.per_image = per_image
+        self.warmup = warmup
+        self.warmup_iters = warmup_iters
+        self.generator = torch_generator(device, seed)
+
+        N, H, W, _ = self.rgb.shape
+        rows, cols = min(res, H), min(res, W)
+        # first pixel row (column) of every cell, cells split the image as evenly as possible
+        self.row_start = torch.tensor([-(-c * H // rows) for c in range(rows + 1)], device=device)
+        self.col_start = torch.tensor([-(-c * W // cols) for c in range(cols + 1)], device=device)
+        self.cell_pixels = (self.row_start.diff()[:,None] * self.col_start.diff()[None]).float()  # [rows, cols]
+        self.error = torch.ones(N, rows, cols, device=device)
+        self.pending = {}
+
+    def sample(self, i):
+        if i < self.warmup_iters and self.warmup is not None:
+            return self.warmup.sample(i)
+        N, H, W, _ = self.rgb.shape
+        rows, cols = self.error.shape[1:]
+        first = torch.randint(0, N, [1], device=self.device, generator=self.generator).item() if self.per_image else 0
+        error = self.error[first:first+1] if self.per_image else self.error
+
+        # cells drawn by their share of the error, or uniformly by their share of the pixels
+        total = error * self.cell_pixels
+        p = (1 - self.uniform) * total / total.sum() + self.uniform * self.cell_pixels / (len(error) * H * W)
+        p = p.flatten()
+        cells = torch.multinomial(p, self.N_rand, replacement=True, generator=self.generator)
+        img = first + cells // (rows * cols)
+        cell_row, cell_col = (cells // cols) % rows, cells % cols
+        # a uniform pixel of each cell
+        row0, col0 = self.row_start[cell_row], self.col_start[cell_col]
+        u = torch.rand(2, self.N_rand, device=self.device, generator=self.generator)
+        row = row0 + (u[0] * (self.row_start[cell_row+1] - row0)).long()
+        col = col0 + (u[1] * (self.col_start[cell_col+1] - col0)).long()
+        weights = self.cell_pixels[cell_row, cell_col] / (p[cells] * len(error) * H * W)
+
+        rays_o, rays_d = pixel_rays(self.K, self.poses[img], col.float(), row.float())
+        target_s = composite(self.rgb[img, row, col], None if self.alpha is None else self.alpha[img, row, col],
+                             self.white_bkgd)
+        self.pending[i] = (img * rows * cols + cell_row * cols + cell_col, weights)
+        return torch.stack([rays_o, rays_d], 0), target_s
+
+    def weights(self, i):
+        """
+        Importance weights [N_rand] of the rays of step i, None if they were drawn uniformly.
+        """
+        return self.pending[i][1] if i in self.pending else None
+
+    def update(self, i, ray_loss):
+        """
+        Blends the mean loss of the rays of step i in each of their cells into the error map.
+        """
+        if i not in self.pending:
+            return
+        cells, _ = self.pending.pop(i)
+        sums = torch.zeros(self.error.numel(), device=self.device).index_add_(0, cells, ray_loss.detach())
+        counts = torch.zeros(self.error.numel(), device=self.device).index_add_(0, cells, torch.ones_like(ray_loss))
+        hit = counts > 0
+        error = self.error.view(-1)
+        error[hit] = self.decay * error[hit] + (1 - self.decay) * sums[hit] / counts[hit]
+
+
+class Prefetcher:
+    """
+    Runs sampler.sample(i) for steps start..end-1 on a background thread, up to 'depth'
+    batches ahead of the training loop, and counts how often the loop waits for a batch.
+    The sampler must draw from its own generators (see torch_generator), not the global ones.
+    """
+    def __init__(self, sampler, start, end, depth=2):
+        self.sampler = sampler
+        self.batches = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.n_batches = 0
+        self.n_waits = 0
+        self.wait_time = 0.
+        self.thread = threading.Thread(target=self._run, args=(start, end), daemon=True)
+        self.thread.start()
+
+    def _run(self, start, end):
+        try:
+            for i in range(start, end):
+                batch = self.sampler.sample(i)
+                while not self.stop.is_set():
+                    try:
+                        self.batches.put((i, batch), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop.is_set():
+                    return
+        except Exception as e:
+            self.batches.put((None, e))  # re-raised by sample
+
+    def sample(self, i):
+        t = time.perf_counter()
+        if self.batches.empty():
+            self.n_waits += 1
+        j, batch = self.batches.get()
+        self.wait_time += time.perf_counter() - t
+        self.n_batches += 1
+        if j is None:
+            raise batch
+        assert j == i, f'prefetched batch of step {j}, expected {i}'
+        return batch
+
+    def stats(self):
+        """
+        Fraction of steps that waited for their batch and the mean wait in seconds,
+        since the last call.
+        """
+        n = max(self.n_batches, 1)
+        stats = self.n_waits / n, self.wait_time / n
+        self.n_batches, self.n_waits, self.wait_time = 0, 0, 0.
+        return stats
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
@@ -0,0 +1,130 @@
+###############################################################################
+# Streaming frame writers, frames are encoded as soon as they are rendered
+###############################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+import imageio
+import numpy as np
+
+from utils.nerf_helpers import to8b
+
+to16b = lambda x : (65535*np.clip(x,0,1)).astype(np.uint16)
+
+
+class VideoWriter:
+    """
+    Appends float frames in [0, 1] to a video file one at a time.
+    """
+    def __init__(self, path, fps=30, quality=8):
+        self.path = path
+        self.writer = imageio.get_writer(path, fps=fps, quality=quality)
+
+    def append(self, frame):
+        self.writer.append_data(to8b(frame))
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DepthVideoWriter:
+    """
+    Depth video normalized to a fixed 'depth_range' (lo, hi), encoded frame by frame.
+    Without a range, frames are spooled to disk as float16 and encoded on close,
+    normalized by the max over all frames (two passes, no frame is kept in memory).
+    """
+    def __init__(self, path, depth_range=None, fps=30, quality=8):
+        self.path = path
+        self.depth_range = depth_range
+        self.fps, self.quality = fps, quality
+        self.video = VideoWriter(path, fps=fps, quality=quality) if depth_range is not None else None
+        self.spool_path = path + '.spool'
+        self.spool = None
+        self.shape = None
+        self.max = 0.
+
+    def append(self, depth):
+        if self.video is not None:
+            lo, hi = self.depth_range
+            self.video.append((depth - lo) / (hi - lo))
+            return
+        if self.spool is None:
+            self.spool = open(self.spool_path, 'wb')
+            self.shape = depth.shape
+        self.max = max(self.max, float(np.max(depth)))
+        self.spool.write(np.asarray(depth, dtype=np.float16).tobytes())
+
+    def close(self):
+        if self.video is not None:
+            self.video.close()
+            return
+        if self.spool is None:
+            return
+        self.spool.close()
+        frames = np.memmap(self.spool_path, dtype=np.float16, mode='r').reshape([-1] + list(self.shape))
+        scale = 1. / self.max if self.max > 0. else 1.
+        with VideoWriter(self.path, fps=self.fps, quality=self.quality) as video:
+            for depth in frames:
+                video.append(depth.astype(np.float32) * scale)
+        del frames
+        os.remove(self.spool_path)
+        self.spool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncWriter:
+    """
+    Runs I/O jobs (PNG encoding, video appends) on background threads, off the render loop.
+    At most 'max_pending' jobs are queued, submit blocks beyond that (backpressure).
+    Jobs run in submission order if num_workers is 1.
+    """
+    def __init__(self, num_workers=4, max_pending=16):
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def close(self):
+        """
+        Waits for the queue to drain, re-raises the first error of a job.
+        """
+        self.pool.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_depth_png(filename, depth, depth_range, bit16=False):
+    """
+    Writes depth normalized to depth_range (lo, hi) as an 8 or 16 bit PNG.
+    """
+    lo, hi = depth_range
+    depth = (depth - lo) / (hi - lo)
+    imageio.imwrite(filename, to16b(depth) if bit16 else to8b(depth))